@@ -19,6 +19,9 @@ import os
 import bmw
 from spiceypy import gdpool, str2et, timout, furnsh
 
+from ephemeris import get_ephemeris, ephemeris_position
+from frames import fit_frame, frame_rotation, transform_states
+
 furnsh('kernels/Ranger7Background.tm')
 
 # mu_moon=4904.8695     #Value from Vallado of gravitational parameter of Moon in km and s
@@ -376,16 +379,11 @@ def process_trajectory(traj):
     return (t,GeoState,SelenoState)
 
 def convertImageACanonical(rs,vs,ts):
-    rcus=np.zeros((len(ts),3))
-    vcus=np.zeros((len(ts),3))
-    tcus=np.zeros( len(ts)   )
-    for (i,(r,v,t)) in enumerate(zip(rs,vs,ts)):
-        M=sxform("IAU_MOON","ECI_TOD",t)
-        s=np.concatenate((r,v))
-        Ms=np.matmul(M,s)
-        rcus[i,:]=bmw.su_to_cu(Ms[0:3],r_moon,mu_moon,1, 0)
-        vcus[i,:]=bmw.su_to_cu(Ms[3:6],r_moon,mu_moon,1,-1)
-        tcus[i  ]=bmw.su_to_cu(t-ts[0],r_moon,mu_moon,0, 1)
+    frame=fit_frame("IAU_MOON","ECI_TOD",np.min(ts),np.max(ts))
+    (rs_eci,vs_eci)=transform_states(frame,ts,rs.T,vs.T)
+    rcus=bmw.su_to_cu(rs_eci.T,r_moon,mu_moon,1, 0)
+    vcus=bmw.su_to_cu(vs_eci.T,r_moon,mu_moon,1,-1)
+    tcus=bmw.su_to_cu(ts-ts[0],r_moon,mu_moon,0, 1)
     return (rcus,vcus,tcus)
 
 def wrap_kepler(r0,v0,ts):
@@ -541,18 +539,15 @@ def cache_earth(ts):
                acceleration of the moon towards the earth in the same frame and units
                as above. Same even/odd breakdown too.
     """
-    rEarth=np.zeros((ts.size*2-1,3),np.float64)
-    dvdtEM=np.zeros((ts.size*2-1,3),np.float64)
-    for i in range(ts.size):
-        (xEarth, _) = spkezr('399', ts[i], 'ECI_TOD', 'NONE', '301')
-        rEarth[i*2,:] = bmw.su_to_cu(xEarth[0:3], r_moon, mu_moon, 1, 0)
-        # acceleration of the *moon*  from the gravity of the Earth. This isn't quite right,
-        # as it doesn't take into account the non-negligible mass of the moon.
-        dvdtEM[i*2,:] = (mu_earth/mu_moon)*rEarth[i*2,:]/np.linalg.norm(rEarth[i*2,:]) ** 3
-        if i<tas.size-1:
-            (xEarth, _) = spkezr('399', (ts[i]+ts[i+1])/2, 'ECI_TOD', 'NONE', '301')
-            rEarth[i*2+1,:] = bmw.su_to_cu(xEarth[0:3], r_moon, mu_moon, 1, 0)
-            dvdtEM[i*2+1,:] = (mu_earth/mu_moon)*rEarth[i*2,:]/np.linalg.norm(rEarth[i*2,:]) ** 3
+    # Every requested time, with the midpoint between each pair of consecutive times in between
+    ts_all=np.zeros(ts.size*2-1,np.float64)
+    ts_all[0::2]=ts
+    ts_all[1::2]=(ts[:-1]+ts[1:])/2
+    earth=get_ephemeris('399')
+    rEarth = bmw.su_to_cu(ephemeris_position(earth, ts_all).T, r_moon, mu_moon, 1, 0)
+    # acceleration of the *moon*  from the gravity of the Earth. This isn't quite right,
+    # as it doesn't take into account the non-negligible mass of the moon.
+    dvdtEM = (mu_earth/mu_moon)*rEarth/np.linalg.norm(rEarth, axis=1, keepdims=True) ** 3
     return rEarth, dvdtEM
 
 def gradient_descent(F,x0,args=(),delta=1e-14,gamma0=1e-12,adapt=False,plot=False):
@@ -1002,14 +997,16 @@ tN_b=np.cross(p_b,tE_b)
 tN_b/=np.linalg.norm(tN_b)
 t_r_mep=np.array([0.0,0.0,1.0])
 
+#Moon orientation at every row, from one fit over the table rather than a pxform() per row
+ets_ck=np.array([gmt_to_et(row.GMT) for row in image_a])
+M_mep_ecis=frame_rotation(fit_frame("IAU_MOON","ECI_TOD",np.min(ets_ck),np.max(ets_ck)),ets_ck)
+
 with open('Ranger7ck.txt','w') as ouf_ck:
-    for row in image_a:
+    for row,et,M_mep_eci in zip(image_a,ets_ck,M_mep_ecis):
         azn=np.radians(row.azn-90)
         t_b=tN_b*np.cos(azn)+tE_b*np.sin(azn)
-        et=gmt_to_et(row.GMT)
         #Point 2 on reference surface of Moon
         p2_mep = llr_to_xyz(lat=row.p2_lat, lon=row.p2_lon, deg=True, radius=r_moon)
-        M_mep_eci=pxform("IAU_MOON","ECI_TOD",et)
         p2_eci=np.dot(M_mep_eci,p2_mep)
         sc_eci,_=spkezr("-1007",et,"ECI_TOD","NONE","301")
         p_r=p2_eci-sc_eci[0:3]
@@ -1034,12 +1031,10 @@ furnsh("Ranger7.bc")
 furnsh("Ranger7.tf")
 furnsh("Ranger7.tsc")
 
-for row in image_a:
+for row, et, M_mep_eci in zip(image_a, ets_ck, M_mep_ecis):
     azn = np.radians(row.azn)
     t_b = tN_b * np.cos(azn) + tE_b * np.sin(azn)
-    et = gmt_to_et(row.GMT)
     # Point 2 on reference surface of Moon
-    M_mep_eci = pxform("IAU_MOON", "ECI_TOD", et)
     p2_eci = np.dot(M_mep_eci, p2_mep)
     sc_eci, _ = spkezr("-1007", et, "ECI_TOD", "NONE", "301")
     p_r = sc_eci[0:3] - p2_eci
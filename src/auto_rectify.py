@@ -2,24 +2,34 @@
 Use what we have learned from image correlation to try to automatically find
 all of the reticle markings in a Ranger image.
 """
+import os
 import re
+import threading
+import time
+from argparse import ArgumentParser
+from collections import namedtuple
 from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 from glob import glob
-from os import mkdir, unlink, remove
+from os import mkdir, remove
 
 import numpy as np
 from PIL import Image
-from matplotlib import image as mpimg, pyplot as plt
+from matplotlib import pyplot as plt
 from matplotlib.backend_bases import MouseButton
-from scipy.interpolate import RegularGridInterpolator
-from scipy.optimize import minimize
-# Give this function a weird alias so that we aren't tempted to use it.
-# Use transform_image() below instead, and only use affine_pull_transform()
-# inside transform_image().
-from scipy.ndimage import affine_transform as affine_pull_transform
+from scipy.fft import set_workers
 
-from kwanmath.vector import vdot, vcomp, vdecomp
-from correlate import img_offset, cross_image
+from lattice import lattice_config, get_lattice, fit_lattice
+from correlate import prepare_templates, cross_images, img_offsets, pyramid_offsets, pyramid_templates, template_tuple
+from warp import affine_warp, remap
+from frame_cache import cached_array, file_hash, load_frame, load_reduced_frame
+from rect_manifest import manifest_path, setup_key, load_manifest, save_manifest, make_record, is_current
+from pipeline import Stage, run_pipeline
+from frame_stack import stack_path, table_path, open_stack, write_frame, save_table
+from reticle_tracker import ReticleTracker
+from reticle_detect import detect_reticle
+from distortion import fit_distortion, cached_warp_map
 
 # Series 7A has the "top" row of reticle marks chopped off by the top of the frame. We will rectify using
 # the rest of the marks, numbering them from left to right along the top row full row starting at 0, then
@@ -28,7 +38,8 @@ from correlate import img_offset, cross_image
 # convertible to that numbering.
 
 
-def transform_image(img:np.ndarray,M_to_from:np.ndarray,*,output_shape:tuple[int,int]=None)->np.ndarray:
+def transform_image(img:np.ndarray,M_to_from:np.ndarray,*,output_shape:tuple[int,int]=None,
+                    dtype:np.dtype=np.float32)->np.ndarray:
     """
     Perform an affine transform on an image. Original image is in the *from* frame,
     and the new coordinate for each pixel is found by multiplying the from coordinate
@@ -39,8 +50,9 @@ def transform_image(img:np.ndarray,M_to_from:np.ndarray,*,output_shape:tuple[int
                       corresponding image in the *to* frame. For each coordinate x_from,
                       the pixel in the new image at x_to=M_to_from@x_from will be the
                       same color as the pixel in the old image at x_from.
-    :param args:      Extra un-named arguments passed along to scipy.ndimage.affine_transform()
-    :param kwargs:    Extra named arguments passed along to scipy.ndimage.affine_transform()
+    :param output_shape: Shape of output image, default is same as input
+    :param dtype: Output pixel type, np.float32 (default) or np.uint8 are the useful ones.
+                  Integer types are rounded and saturated.
     :return: Transformed image
 
     The *sole* reason we are doing this is that scipy.ndimage.affine_transform() uses the matrix
@@ -53,39 +65,12 @@ def transform_image(img:np.ndarray,M_to_from:np.ndarray,*,output_shape:tuple[int
     > Affine transformations are often described in the ‘push’ (or ‘forward’) direction, transforming input
     > to output. If you have a matrix for the ‘push’ transformation, use its inverse (numpy.linalg.inv) in
     > this function.
+
+    The actual resampling is done by warp.affine_warp(), which does the same pull
+    resampling with a bilinear kernel, a block of output rows at a time, so that
+    we never build a full-size coordinate array for either image.
     """
-    #naming convention: in* is a point originally in input space.
-    #                   out* is a point originally in output space
-    #                   - No matter how you transform it, it remains an in* or out* quantity.
-    #                   *from is a point now in input (from) space
-    #                   *to is a point now in output (to) space
-    #                   - Must follow the frame of the space that the quantity currently is in.
-    #                   *x* is a 1D array of x (horizontal, IE column) coordinates
-    #                   *y* is a 1D array of y (vertical, IE row) coordinates
-    # so, in or out won't change during a transformation, but from or to must.
-    iny1dfrom=np.arange(img.shape[0])
-    inx1dfrom=np.arange(img.shape[1])
-    rgi=RegularGridInterpolator((iny1dfrom,inx1dfrom),img,bounds_error=False,fill_value=0)
-    inxfrom=np.broadcast_to(inx1dfrom,img.shape)
-    inyfrom=np.broadcast_to(iny1dfrom.reshape(-1,1),img.shape)
-    if output_shape is None:
-        output_shape=img.shape
-    outy1dto=np.arange(output_shape[0])
-    outx1dto=np.arange(output_shape[1])
-    outxto=np.broadcast_to(outx1dto,output_shape)
-    outyto=np.broadcast_to(outy1dto.reshape(-1,1),output_shape)
-
-    # Will be a 2D stack of column vectors, so [inrows,3,incols]
-    invfrom=vcomp((inxfrom,inyfrom,np.broadcast_to(1,img.shape)))
-    # Will be a 2D stack of column vectors, so [outrows,3,outcols]
-    outvto=vcomp((outxto,outyto,np.broadcast_to(1,output_shape)))
-    invto=M_to_from @ invfrom
-    # Coordinates of each output pixel in input space. We will sample the input image at each point.
-    M_from_to=np.linalg.inv(M_to_from)
-    outvfrom=M_from_to @ outvto
-    outxfrom,outyfrom,_=vdecomp(outvfrom)
-    outimg=rgi((outyfrom,outxfrom))
-    return outimg
+    return affine_warp(img,M_to_from,output_shape=output_shape,dtype=dtype)
 
 
 def calc_M_img_big(shape:np.ndarray,n_scanlines:int)->np.ndarray:
@@ -107,10 +92,31 @@ def scaledown(img:np.ndarray,n_scanlines:int)->np.ndarray:
     """
     M_img_big=calc_M_img_big(img.shape,n_scanlines)
     outshape=(int(n_scanlines / img.shape[1] * img.shape[0]), n_scanlines)
-    outimg = transform_image(img, M_img_big, output_shape=outshape).astype(np.uint8)
+    outimg = transform_image(img, M_img_big, output_shape=outshape, dtype=np.uint8)
     return outimg
 
 
+def load_scaled_frame(infn:str,n_scanlines:int)->np.ndarray:
+    """
+    Load a raw image and scale it down, through the frame cache. This is about the
+    same as scaledown(mpimg.imread(infn),n_scanlines), but the image is decoded at
+    reduced resolution by load_reduced_frame(), so only a small residual resampling
+    is left to do, and after the first time it is just a memory map of a file in the
+    cache.
+
+    :param infn: Raw image filename
+    :param n_scanlines: Width of scaled image
+    :return: Read-only scaled image
+    """
+    def make():
+        reduced=load_reduced_frame(infn,n_scanlines)
+        big_shape=reduced.big_shape
+        M_img_red=calc_M_img_big(big_shape,n_scanlines)@reduced.M_big_img
+        outshape=(int(n_scanlines / big_shape[1] * big_shape[0]), n_scanlines)
+        return transform_image(reduced.img,M_img_red,output_shape=outshape,dtype=np.uint8)
+    return cached_array(f"{file_hash(infn)}_scaled_draft{n_scanlines}",make)
+
+
 def get_synthetic_masks(mission:int,channel:str)->list[np.ndarray]:
     def synthetic_mark(*,
                        r: int = 50, l: int = 30, w2: int = 2,
@@ -154,37 +160,79 @@ def get_synthetic_masks(mission:int,channel:str)->list[np.ndarray]:
     ]
     return synthetic_masks
 
-lattice_config={7:{"A":((-2,-1,0,1,2),(-1,0,1,2)),
-                   "B":((-2,-1,0,1,2),(-1,0,1,2))},
-                8:{"A":((-2,-1,0,1,2),(-1,0,1,2)),
-                   "B":((-2,-1,0,1,2),(-1,0,1,2))}}
+@lru_cache
+def get_masks(mission:int,channel:str,box_r:int=50)->np.ndarray:
+    """
+    Get the synthetic reticle masks for a channel as one stack, to match search boxes
+    of the given size.
+
+    :param mission: Mission number, IE 7=Ranger 7, etc.
+    :param channel: Either A, B, or P
+    :param box_r: Square radius of the search boxes. If this is smaller than the masks,
+                  the masks are cropped to the same size around their centers.
+    :return: Stack of masks, shape [n,2*box_r,2*box_r] (or the full mask size, if smaller)
+    """
+    masks=np.stack(get_synthetic_masks(mission,channel))
+    mask_r=masks.shape[1]//2
+    if box_r<mask_r:
+        masks=masks[:,mask_r-box_r:mask_r+box_r,mask_r-box_r:mask_r+box_r]
+    return masks
 
 
-def get_lattice(mission:int,channel:str)->list[tuple[int,int]]:
+@lru_cache
+def get_mask_templates(mission:int,channel:str,box_r:int=50)->template_tuple:
     """
+    Get the synthetic reticle masks for a channel, already Fourier-transformed for
+    correlation against search boxes of the given size. This is cached, so each
+    process only transforms the masks once per channel.
 
-    :param mission:
-    :param channel:
-    :return:
+    :param mission: Mission number, IE 7=Ranger 7, etc.
+    :param channel: Either A, B, or P
+    :param box_r: Square radius of the search boxes that will be correlated against the masks.
+                  If this is smaller than the masks, the masks are cropped to the same size
+                  around their centers, which keeps the FFTs small.
+    :return: Precomputed templates to pass to correlate.cross_images()
     """
-    xlattice,ylattice=lattice_config[mission][channel]
-    n_lattice=len(xlattice)*len(ylattice)
-    lattice=[None]*n_lattice
-    for i_y, y in enumerate(ylattice):
-        for i_x, x in enumerate(xlattice):
-            i = i_y * 5 + i_x
-            lattice[i]=(i_x,i_y)
-    return lattice
+    return prepare_templates(get_masks(mission,channel,box_r),(2*box_r,2*box_r))
 
 
-def get_manual_reticle(mission:int,channel:str,img1:np.ndarray)->list[tuple[float,float]]:
+@lru_cache
+def get_pyramid_templates(mission:int,channel:str,box_r:int,levels:int)->template_tuple:
+    """
+    Get the synthetic reticle masks for a channel, already shrunk and Fourier-transformed
+    for the coarse search of correlate.pyramid_offsets(). Cached the same way as
+    get_mask_templates().
+
+    :param mission: Mission number, IE 7=Ranger 7, etc.
+    :param channel: Either A, B, or P
+    :param box_r: Square radius of the search boxes that will be searched
+    :param levels: Number of halvings of the coarse search
+    :return: Precomputed templates to pass to pyramid_offsets() as coarse_templates
+    """
+    return pyramid_templates(get_masks(mission,channel,box_r),(2*box_r,2*box_r),levels=levels)
+
+
+def _select_templates(templates:template_tuple,index:np.ndarray)->template_tuple:
+    """
+    Pick out the templates of some of the reticle marks
+    """
+    return templates._replace(spectra=templates.spectra[index],energy=templates.energy[index])
+
+
+def get_manual_reticle(mission:int,channel:str,img1:np.ndarray,*,click:bool=False)->list[tuple[float,float]]:
     """
 
     :param mission: Mission number, IE 7=Ranger 7, etc.
     :param channel: Either A, B, or P
     :param img1: image from tab1, scaled to its nominal size (IE 1150 wide for A and B)
+    :param click: For a channel which doesn't have clicks below yet, if True, show img1
+                  and have the user right-click each reticle mark. If False (default),
+                  find the marks automatically with reticle_detect.detect_reticle().
     :return: A list of tuples, each of which is the x and y location of a manual click
              on the scaled images.
+
+    Either way, the new points are printed in the same form as the lists below, so
+    that they can be checked and pasted in.
     """
 
     manual_tab1_reticles={7:{
@@ -288,6 +336,11 @@ def get_manual_reticle(mission:int,channel:str,img1:np.ndarray)->list[tuple[floa
         # Clicks have already been collected. The clicks below are from
         # TAB 1, scaled to have a horizontal size of 1150 pixels.
         manual_tab1_reticle=manual_tab1_reticles[mission][channel]
+    elif not click:
+        detected=detect_reticle(img1,get_synthetic_masks(mission,channel),get_lattice(mission,channel))
+        manual_tab1_reticle=[(float(x),float(y)) for x,y in detected.points]
+        for i,((x,y),confidence) in enumerate(zip(manual_tab1_reticle,detected.confidence)):
+            print(f"    ({x:8.3f},  {y:8.3f}), # {i:2d}, confidence {confidence:5.2f}")
     else:
         # Collect the clicks
         xlattice, ylattice = lattice_config[mission][channel]
@@ -313,67 +366,38 @@ def get_manual_reticle(mission:int,channel:str,img1:np.ndarray)->list[tuple[floa
     return manual_tab1_reticle
 
 
-def calc_M_im_lat(reticle_points:np.ndarray, img:np.ndarray=None)->np.ndarray:
+def calc_M_im_lat(reticle_points:Iterable[tuple[float,float]], img:np.ndarray=None,*,
+                  mission:int, channel:str)->np.ndarray:
     """
     # Find the best fit matrix which reproduces the grid.
 
     :param reticle_points: Image coordinates of integer lattice points
+    :param img: If passed, plot the fit lattice on top of this image
+    :param mission: Mission number, used to look up the lattice
+    :param channel: Channel, used to look up the lattice
     :return: Matrix which transforms integer lattice coordinates to image coordinates
 
-    We are going to use a nonlinear minimizer even though the problem is linear,
-    because it is easier to express the problem as a nonlinear cost.
-
     If the data were perfect, we would be able to scale each vector
-    on the integer lattice with -2<=x<=2 and -2<=y<=1. We would have
+    on the integer lattice with -2<=x<=2 and -1<=y<=2. We would have
     [a b c][x] [xd]
     [d e f][y]=[yd]
     [0 0 1][1] [1 ]
     where xd is the image coordinates of the reticle points. We will call that
-    matrix [A], the left-side vector [x], and the right side data [B]. The cost
-    for one point is vdot([A][x]-[B],[A][x]-[B]) and the cost for all points is
-    therefore the sum of that dot product over all points.
-
-    The cost function is in the form:
-     J(x,*args)->float
-    In our case, x is the parameters we are trying to minimize (a,b,c,d,e,f),
-    and *args isn't needed.
-    """
-    def J(abcdef:np.ndarray)->float:
-        cost=0.0
-        a,b,c,d,e,f=abcdef
-        A=np.array([[a,b,c],
-                    [d,e,f],
-                    [0,0,1]])
-
-        for i_y,y in enumerate((-1,0,1,2)):
-            for i_x,x in enumerate((-2,-1,0,1,2)):
-                i=i_y*5+i_x
-                x=np.array([[x],
-                            [y],
-                            [1]])
-                Ax=A@x
-                B=np.array([[reticle_points[i][0]],
-                            [reticle_points[i][1]],
-                            [1]])
-                cost+=vdot(Ax-B,Ax-B)
-        return cost
-
-    result=minimize(J,(1,0,0,0,1,0))
-    a,b,c,d,e,f=result.x
-    A = np.array([[a, b, c],
-                  [d, e, f],
-                  [0, 0, 1]])
+    matrix [A], the left-side vector [x], and the right side data [B]. The problem
+    is linear in (a,b,c,d,e,f), so lattice.fit_lattice() solves it in closed form
+    by least squares, throwing out any reticle points which are way off. Use
+    fit_lattice() directly to get the residuals, or to fit many images at once.
+    """
+    lattice=get_lattice(mission,channel)
+    A=fit_lattice(reticle_points,lattice).M_im_lat
     if img is not None:
         print(A)
         plt.imshow(img)
-        for i_y, y in enumerate((-1, 0, 1, 2)):
-            for i_x, x in enumerate((-2, -1, 0, 1, 2)):
-                i = i_y * 5 + i_x
-                x = np.array([[x],
-                              [y],
-                              [1]])
-                Ax = A @ x
-                plt.plot(Ax[0,0],Ax[1,0],'b+')
+        for x,y in lattice:
+            Ax = A @ np.array([[x],
+                               [y],
+                               [1]])
+            plt.plot(Ax[0,0],Ax[1,0],'b+')
         plt.show()
     return A
 
@@ -413,128 +437,723 @@ def sample_img_boxes(img:np.ndarray,
     return img_boxes
 
 
-def auto_rectify(mission:int,channel:str):
+def warp_img_boxes(bigimg:np.ndarray,
+                   M_img_big:np.ndarray,
+                   reticle_points:Iterable[tuple[float,float]],
+                   box_r:int=50)->list[np.ndarray]:
     """
+    Sample the region around each reticle point, resampling directly from
+    the full-resolution image. This gives nearly the same boxes as
+    sample_img_boxes(scaledown(bigimg,...),...) but only resamples the pixels
+    inside the boxes, rather than the whole frame. Since we are resampling
+    anyway, each box is centered exactly on its reticle point, so pixel
+    [box_r,box_r] of the box is the reticle point itself, rather than the pixel
+    it falls in. An offset found by correlating the box is then an offset from
+    the reticle point.
 
-    :param mission:
-    :param channel:
-    :return:
+    :param bigimg: Full-resolution image to sample
+    :param M_img_big: Matrix which transforms a coordinate in bigimg to the
+                      coordinate space that reticle_points are in, IE the
+                      result of calc_M_img_big()
+    :param reticle_points: List of reticle points to sample around, in img
+                           coordinates.
+    :param box_r: Square radius to sample around each reticle point
+    :return: List of uint8 images, each 2*box_r square. Parts of a box outside
+             of the image are zero.
+    """
+    img_boxes=[None]*len(reticle_points)
+    for i_reticle, (click_x,click_y) in enumerate(reticle_points):
+        # Box coordinates are image coordinates, shifted so that the corner
+        # of the box is at the origin.
+        M_box_img=np.array([[1,0,box_r-click_x],
+                            [0,1,box_r-click_y],
+                            [0,0,1]])
+        img_boxes[i_reticle]=affine_warp(bigimg,M_box_img@M_img_big,
+                                         output_shape=(2*box_r,2*box_r),dtype=np.uint8)
+    return img_boxes
+
+
+image_sizes={7:{"A":1150,"B":1150},8:{"A":1150,"B":1150},9:{"A":1150,"B":1150}}
+
+# Version of the rectification algorithm. Bump this whenever a change would make
+# rectify_tab() produce a different result, so that incremental runs redo every TAB.
+pipeline_version=10
+
+channel_tuple=namedtuple('channel_tuple','mission,channel,image_size,manual_tab1_reticle,M_im1_lat,setup_key,img1,outputs,slots,distortion')
+
+
+def rect_filename(mission:int,channel:str,tab:int)->str:
+    return f"rect_images/{mission:1d}{channel}/Rect{mission:1d}{channel}{tab:03d}.png"
+
+
+def prepare_channel(mission:int,channel:str,*,incremental:bool=True,outputs:tuple[str,...]=("png",),
+                    click:bool=False,distortion:str=None)->channel_tuple:
+    """
+    Do the once-per-channel work based on TAB 1. This is done in the main process,
+    since it may need the user to click on the reticle marks.
+
+    :param mission: Mission number, IE 7=Ranger 7, etc.
+    :param channel: Either A, B, or P
+    :param incremental: If False, delete all existing rectified images and the manifest
+                        for this channel, so that everything is redone.
+    :param outputs: Where to write rectified images. Any of "png" for a separate PNG
+                    per TAB, and "stack" for one frame stack for the channel (see frame_stack.py)
+    :param click: Passed to get_manual_reticle()
+    :param distortion: If set, the kind of distortion model ("poly" or "tps") to fit to the
+                       reticle marks of each TAB, see distortion.py. If None (default), each
+                       TAB is rectified with the affine lattice fit alone.
+    :return: Everything that rectify_tab() needs to know about this channel. The slot
+             of each TAB in the frame stack is filled in later, once the TABs are listed.
     """
-    # A is now the matrix which best converts integer lattice points to reticle coordinates
-    # on an 1150-column image. Name it according to our convention M_to_from -- Matrix which
-    # transforms the lattice onto image1
     tab = 1
     infn = f"raw_images/{mission:1d}{channel}/Ranger{mission:1d}{channel}{tab:03d}.jpg"
-    bigimg1 = mpimg.imread(infn)
-    image_sizes={7:{"A":1150,"B":1150},8:{"A":1150,"B":1150},9:{"A":1150,"B":1150}}
     try:
         mkdir(f"rect_images/{mission:1d}{channel}")
     except FileExistsError:
-        oufns=glob("rect_images/{mission:1d}{channel}/*.png")
-        for oufn in oufns:
-            remove(oufn)
+        if not incremental:
+            oufns=(glob(f"rect_images/{mission:1d}{channel}/*.png")+glob(manifest_path(mission,channel))
+                   +glob(stack_path(mission,channel))+glob(table_path(mission,channel)))
+            for oufn in oufns:
+                remove(oufn)
     image_size=image_sizes[mission][channel]
-    img1 = scaledown(bigimg1,image_size)
+    img1 = load_scaled_frame(infn,image_size)
 
     print(f"{infn},{img1.shape},{img1.dtype}")
 
-    manual_tab1_reticle=get_manual_reticle(mission,channel,img1)
-    M_im1_lat = calc_M_im_lat(manual_tab1_reticle)
+    manual_tab1_reticle=get_manual_reticle(mission,channel,img1,click=click)
+    # M_im1_lat is the matrix which best converts integer lattice points to reticle coordinates
+    # on an 1150-column image. Name it according to our convention M_to_from -- Matrix which
+    # transforms the lattice onto image1
+    M_im1_lat = calc_M_im_lat(manual_tab1_reticle,mission=mission,channel=channel)
 
-    img1_boxes = sample_img_boxes(img1, manual_tab1_reticle)
+    return channel_tuple(mission=mission,channel=channel,image_size=image_size,
+                         manual_tab1_reticle=manual_tab1_reticle,M_im1_lat=M_im1_lat,
+                         setup_key=setup_key(file_hash(infn),manual_tab1_reticle,distortion),
+                         img1=img1,outputs=tuple(outputs),slots=None,distortion=distortion)
 
-    synthetic_masks=get_synthetic_masks(mission,channel)
 
-    # For each subsequent image:
-    infns=sorted(glob(f"raw_images/{mission:1d}{channel}/Ranger{mission:1d}{channel}*.jpg"))
-    box_r=50
-    xbox=np.array([-1,1,1,-1,-1])*box_r
-    ybox=np.array([-1,-1,1,1,-1])*box_r
+def list_tabs(setup:channel_tuple)->list[tuple[int,str]]:
+    """
+    Find all of the raw images for a channel
 
-    for infn in infns:
+    :param setup: Channel setup from prepare_channel()
+    :return: List of (TAB number, filename) tuples, sorted by TAB number
+    """
+    mission,channel=setup.mission,setup.channel
+    result=[]
+    for infn in sorted(glob(f"raw_images/{mission:1d}{channel}/Ranger{mission:1d}{channel}*.jpg")):
         if match:=re.match(f".*/Ranger{mission:1d}{channel}(?P<tab>[0-9][0-9][0-9]).jpg",infn):
-            tab=int(match.group("tab"))
+            result.append((int(match.group("tab")),infn))
         else:
             raise ValueError("Couldn't get TAB number out of filename")
-        oufn = f"rect_images/{mission:1d}{channel}/Rect{mission:1d}{channel}{tab:03d}.png"
-        # Scale down to 1150 lines
-        bigimgn=mpimg.imread(infn)
-        M_imn_big=calc_M_img_big(bigimgn.shape,image_size)
-        imgn = scaledown(bigimgn,image_size)
+    return result
+
+
+tab_result=namedtuple('tab_result','tab,M_im1_imn,reticle,residuals,inliers,confidence,distortion',defaults=(None,))
+
+
+def correlate_marks(setup:channel_tuple,srcimgn:np.ndarray,M_imn_src:np.ndarray,centers:np.ndarray,
+                    marks:np.ndarray,*,box_r:int,bbox_r:int,levels:int)->tuple[np.ndarray,np.ndarray]:
+    """
+    Correlate some of the reticle marks of an image against their masks
+
+    :param setup: Channel setup from prepare_channel()
+    :param srcimgn: Raw image, at full or reduced resolution
+    :param M_imn_src: Matrix which transforms a coordinate in srcimgn to imn
+    :param centers: Where to search for each of these marks, in imn coordinates, shape [n,2]
+    :param marks: Index of each of these marks in the reticle, shape [n]
+    :param box_r: Square radius of the box sampled around each search center
+    :param bbox_r: Square radius around each search center to look for the correlation peak
+    :param levels: Coarse-to-fine levels, see register_tab()
+    :return: Tuple of offset (row,col) of each mark from its center, shape [n,2], and
+             peak-to-sidelobe ratio of each, shape [n]
+    """
+    mission,channel=setup.mission,setup.channel
+    # Dig out the region around each reticle mark using the search centers
+    imgn_boxes=np.stack(warp_img_boxes(srcimgn,M_imn_src,centers,box_r=box_r))
+    # Use image correlation to match the synthetic reticle mask to each reticle mark. All
+    # of the marks are done at once in one batched FFT.
+    if levels==0:
+        templates=_select_templates(get_mask_templates(mission,channel,box_r),marks)
+        crosses=cross_images(255-imgn_boxes,templates,normalized=True)
+        return img_offsets(crosses,bbox_r=bbox_r,subpixel=True,confidence=True)
+    return pyramid_offsets(255-imgn_boxes,get_masks(mission,channel,box_r)[marks],bbox_r=bbox_r,
+                           levels=levels,confidence=True,normalized=True,
+                           coarse_templates=_select_templates(get_pyramid_templates(mission,channel,box_r,levels),marks))
+
+
+def register_tab(setup:channel_tuple,tab:int,srcimgn:np.ndarray,M_imn_src:np.ndarray,*,
+                 centers:np.ndarray=None,box_r:int=50,bbox_r:int=20,levels:int=0,
+                 escalate:tuple[tuple[int,int,int],...]=(),min_psr:float=4.0,
+                 min_found:int=6)->tab_result:
+    """
+    Find the reticle marks in one image, and fit the matrix which takes it into the
+    space of TAB 1.
+
+    :param setup: Channel setup from prepare_channel()
+    :param tab: TAB number of this image
+    :param srcimgn: Raw image, at full or reduced resolution, IE from load_reduced_frame()
+    :param M_imn_src: Matrix which transforms a coordinate in srcimgn to the matching
+                      coordinate in the scaled image imn
+    :param centers: Where to search for each reticle mark, in imn coordinates. Default
+                    is the TAB 1 clicks.
+    :param box_r: Square radius of the box sampled around each search center
+    :param bbox_r: Square radius around each search center to look for the correlation peak
+    :param levels: If 0, correlate at full resolution only. Otherwise, use a coarse-to-fine
+                   search with this many halvings, see correlate.pyramid_offsets(). Either
+                   way, the peak is refined to a fraction of a pixel.
+    :param escalate: Further (box_r,bbox_r,levels) searches to try, in order, on only the
+                     marks whose correlation peak is not confident enough, or is on the
+                     edge of the search area.
+    :param min_psr: Peak-to-sidelobe ratio below which a peak is not confident
+    :param min_found: After the last search, marks which still aren't confident are
+                      treated as not found, as long as at least this many marks are left.
+    :return: tab_result with the TAB number, the matrix M_im1_imn which transforms this
+             image into TAB 1 space, the reticle points found in this image (in scaled
+             image coordinates, NaN if not found), the lattice fit residuals and inlier
+             flags for each reticle point, and the peak-to-sidelobe ratio of each. If the
+             setup asks for a distortion model, it is fit to the inlier marks, and is
+             used by warp_tab() instead of M_im1_imn.
+
+    This way, every mark of a clean frame gets only the cheap first search, while dark
+    or blemished marks automatically get more effort.
+    """
+    mission,channel=setup.mission,setup.channel
+    if centers is None:
+        centers=setup.manual_tab1_reticle
+    centers=np.asarray(centers,dtype=np.float64)
+    offsets=np.zeros((len(centers),2))
+    psr=np.zeros(len(centers))
+    todo=np.arange(len(centers))
+    for step_box_r,step_bbox_r,step_levels in ((box_r,bbox_r,levels),)+tuple(escalate):
+        step_offsets,step_psr=correlate_marks(setup,srcimgn,M_imn_src,centers[todo],todo,
+                                              box_r=step_box_r,bbox_r=step_bbox_r,levels=step_levels)
+        offsets[todo]=step_offsets
+        psr[todo]=step_psr
+        # Peaks are searched for from -bbox_r to bbox_r-1, then refined by up to half a pixel
+        on_edge=np.any(np.abs(step_offsets)>step_bbox_r-1.5,axis=-1)
+        todo=todo[(step_psr<min_psr)|on_edge]
+        if len(todo)==0:
+            break
+    # Offsets are (row,col), reticle points are (x,y)
+    auto_tabn_reticle=centers+offsets[:,::-1]
+    confident=psr>=min_psr
+    if np.sum(confident)>=min_found:
+        auto_tabn_reticle[~confident]=np.nan
+    # * Do a linear least-squares fit to find the best-fit matrix M_imn_lat which maps the lattice
+    #   to this image, throwing out any marks that didn't correlate properly
+    lattice=get_lattice(mission,channel)
+    fit=fit_lattice(auto_tabn_reticle,lattice)
+    M_imn_lat=fit.M_im_lat
+    if not np.all(fit.inliers):
+        print(f"{mission:1d}{channel}{tab:03d}: rejected marks {np.flatnonzero(~fit.inliers)}, "
+              f"residuals {fit.residuals[~fit.inliers]}, confidence {psr[~fit.inliers]}")
+    # * Get the matrix which transforms from imn to im1:
+    M_lat_imn=np.linalg.inv(M_imn_lat)
+    M_im1_imn=setup.M_im1_lat@M_lat_imn
+    distortion=None
+    if setup.distortion is not None:
+        try:
+            distortion=fit_distortion(auto_tabn_reticle,lattice,inliers=fit.inliers,kind=setup.distortion)
+        except ValueError as e:
+            print(f"{mission:1d}{channel}{tab:03d}: {e}, using the affine fit alone")
+    return tab_result(tab=tab,M_im1_imn=M_im1_imn,reticle=auto_tabn_reticle,
+                      residuals=fit.residuals,inliers=fit.inliers,confidence=psr,distortion=distortion)
+
+
+def search_tab(setup:channel_tuple,tab:int,infn:str,*,
+               ladder:tuple[tuple[int,int,int],...]=((32,8,0),(50,20,2)))->tab_result:
+    """
+    Register one image against TAB 1, decoding it only at the reduced resolution
+    needed for the reticle search.
+
+    :param setup: Channel setup from prepare_channel()
+    :param tab: TAB number of this image
+    :param infn: Filename of raw image
+    :param ladder: Searches to do around each TAB 1 reticle mark, each a tuple of
+                   (box_r,bbox_r,levels) as passed to register_tab(). Every mark gets the
+                   first search, and only the marks which weren't found confidently go
+                   on to the next one.
+    :return: tab_result from register_tab()
+    """
+    reduced=load_reduced_frame(infn,setup.image_size)
+    # We never actually make the scaled-down image imn, except to look at it. Instead
+    # we keep the matrix M_imn_red which would make it from the reduced image, and
+    # fold it into the resampling of each reticle box.
+    M_imn_red=calc_M_img_big(reduced.big_shape,setup.image_size)@reduced.M_big_img
+    (box_r,bbox_r,levels),*escalate=ladder
+    return register_tab(setup,tab,reduced.img,M_imn_red,box_r=box_r,bbox_r=bbox_r,levels=levels,
+                        escalate=tuple(escalate))
+
+
+def track_tab(setup:channel_tuple,tab:int,infn:str,tracker:ReticleTracker,*,
+              box_r:int=32,bbox_r:int=8,escalate:tuple[tuple[int,int,int],...]=((50,20,2),),
+              max_excess:float=1.0,max_lost:int=2)->tab_result:
+    """
+    Register one image against TAB 1, searching small boxes around where the tracker
+    predicts the reticle marks are. Falls back to the full search with search_tab()
+    when there is no prediction yet, or when the tracked search looks like it failed.
+
+    :param setup: Channel setup from prepare_channel()
+    :param tab: TAB number of this image. TABs must be tracked in increasing order.
+    :param infn: Filename of raw image
+    :param tracker: Tracker for this channel, updated with the result
+    :param box_r: Square radius of the box sampled around each predicted mark
+    :param bbox_r: Square radius around each predicted mark to look for the correlation peak
+    :param escalate: Wider searches around the predicted marks for marks which aren't found
+                     confidently by the first search, see register_tab()
+    :param max_excess: Fall back if the RMS residual of the lattice fit spikes more than this
+                       many pixels above its usual level, see ReticleTracker.is_spike()
+    :param max_lost: Fall back if more marks than this were not found or were rejected
+                     from the lattice fit, even after escalating.
+    :return: tab_result from register_tab()
+    """
+    M_imn_lat=tracker.predict(tab)
+    if M_imn_lat is not None:
+        reduced=load_reduced_frame(infn,setup.image_size)
+        M_imn_red=calc_M_img_big(reduced.big_shape,setup.image_size)@reduced.M_big_img
+        lattice=np.array(get_lattice(setup.mission,setup.channel))
+        centers=lattice@M_imn_lat[0:2,0:2].T+M_imn_lat[0:2,2]
+        result=register_tab(setup,tab,reduced.img,M_imn_red,centers=centers,box_r=box_r,bbox_r=bbox_r,
+                            escalate=escalate)
+        lost=np.sum(~result.inliers)
+        rms=_rms_residual(result)
+        if lost<=max_lost and not tracker.is_spike(rms,max_excess):
+            tracker.update(tab,np.linalg.inv(result.M_im1_imn)@setup.M_im1_lat,rms,tracked=True)
+            return result
+        print(f"{setup.mission:1d}{setup.channel}{tab:03d}: lost track ({lost} marks lost, "
+              f"RMS residual {rms:.2f}), falling back to full search")
+        tracker.fall_back()
+    result=search_tab(setup,tab,infn)
+    tracker.update(tab,np.linalg.inv(result.M_im1_imn)@setup.M_im1_lat,_rms_residual(result))
+    return result
+
+
+def _rms_residual(result:tab_result)->float:
+    """
+    RMS lattice fit residual of the marks used in the fit
+    """
+    return float(np.sqrt(np.mean(result.residuals[result.inliers]**2)))
+
+
+def warp_tab(setup:channel_tuple,result:tab_result,bigimgn:np.ndarray)->np.ndarray:
+    """
+    Use the affine transform to map an image into the same space as TAB 1. This is
+    the one and only full-frame resampling of this image.
+
+    :param setup: Channel setup from prepare_channel()
+    :param result: Registration of this image, from register_tab()
+    :param bigimgn: Raw image, at full or any reduced resolution
+    :return: Rectified image, uint8 1150x1150
+
+    If the registration has a distortion model, the image is instead pulled through
+    its warp map. The map is in imn coordinates and kept in the frame cache, so it is
+    only computed once per TAB no matter what resolution of the image is warped.
+    """
+    M_imn_big=calc_M_img_big(bigimgn.shape,setup.image_size)
+    if result.distortion is None:
+        return transform_image(bigimgn, result.M_im1_imn@M_imn_big, output_shape=(1150,1150), dtype=np.uint8)
+    map_xy=cached_warp_map(result.distortion,np.linalg.inv(setup.M_im1_lat),(1150,1150))
+    return remap(bigimgn,map_xy,M_src_map=np.linalg.inv(M_imn_big),dtype=np.uint8)
+
+
+def save_tab(setup:channel_tuple,tab:int,rectified:np.ndarray):
+    """
+    Write a rectified image to rect_images/, as a PNG, into the frame stack, or both,
+    depending on setup.outputs
+
+    :param setup: Channel setup from prepare_channel()
+    :param tab: TAB number of this image
+    :param rectified: Rectified image from warp_tab()
+    """
+    if "png" in setup.outputs:
+        Image.fromarray(rectified, mode='L').save(rect_filename(setup.mission,setup.channel,tab))
+    if "stack" in setup.outputs:
+        write_frame(setup.mission,setup.channel,setup.slots[tab],rectified)
+
+
+def rectify_tab(setup:channel_tuple,tab:int,infn:str,*,plot:bool=False,box_r:int=50,
+                tracker:ReticleTracker=None)->tab_result:
+    """
+    Find the reticle marks in one image, and use them to rectify the image into
+    the same space as TAB 1. This is the per-TAB unit of work, and is safe to run
+    in a worker process as long as plot is False.
+
+    :param setup: Channel setup from prepare_channel()
+    :param tab: TAB number of this image
+    :param infn: Filename of raw image
+    :param plot: If True, show the intermediate results in matplotlib windows. Only
+                 do this in the main process.
+    :param box_r: Square radius to search around each TAB 1 reticle mark
+    :param tracker: If passed, use track_tab() with this tracker to find the marks,
+                    otherwise do the full search. A tracker only makes sense in the
+                    process which sees every TAB of the channel in order.
+    :return: tab_result from register_tab()
+    """
+    manual_tab1_reticle=setup.manual_tab1_reticle
+    if plot:
+        imgn = load_scaled_frame(infn,setup.image_size)
+        xbox=np.array([-1,1,1,-1,-1])*box_r
+        ybox=np.array([-1,-1,1,1,-1])*box_r
         plt.figure(2)
         plt.clf()
         plt.imshow(imgn)
         plt.title(f"TAB {tab}")
-
         for x,y in manual_tab1_reticle:
             plt.plot(x+xbox,y+ybox,'r-')
-        auto_tabn_reticle = [None]*20
-
-        # Dig out the region around each reticle mark using click centers from TAB 1
-        imgn_boxes=sample_img_boxes(imgn,manual_tab1_reticle,box_r=box_r)
-        for i_reticle,(this_box,this_mark,(x_img1,y_img1)) in enumerate(zip(imgn_boxes,synthetic_masks,manual_tab1_reticle)):
-            # Use image correlation to match the reticle mask from TAB 1 to each reticle mark
-            cross=cross_image(im=255-this_box,im_ref=this_mark)
-            yofs,xofs=img_offset(cross=cross,bbox_r=20)
-            auto_tabn_reticle[i_reticle]=(x_img1+xofs,y_img1+yofs)
-            if tab==3 and False:
-                plt.figure(4)
-                plt.clf()
-                plt.subplot(2,2,1)
-                plt.imshow(255-this_box)
-                plt.title(f"This box")
-                plt.plot(box_r+xofs,box_r+yofs,'r+')
-                plt.subplot(2,2,2)
-                plt.title(f"img1 box")
-                plt.imshow(255-img1_boxes[i_reticle])
-                plt.subplot(2,2,3)
-                plt.title(f"synthetic mask")
-                plt.imshow(synthetic_masks[i_reticle])
-                plt.subplot(2,2,4)
-                plt.title(f"cross")
-                plt.imshow(cross)
-                plt.figure(5)
-                plt.plot(x_img1+xofs,y_img1+yofs,'r+')
-                plt.pause(0.001)
-        if tab==3 and False:
-            plt.show()
+    if tracker is None:
+        result=search_tab(setup,tab,infn)
+    else:
+        result=track_tab(setup,tab,infn,tracker)
+    if plot:
         plt.figure(2)
-        plt.plot([x for x,y in auto_tabn_reticle],[y for x,y in auto_tabn_reticle],'w+')
+        plt.plot(result.reticle[:,0],result.reticle[:,1],'w+')
         plt.pause(0.1)
-
-        # * Do a nonlinear minimization to find the best-fit matrix M_imn_lat which maps the lattice
-        #   to this image
-        M_imn_lat=calc_M_im_lat(auto_tabn_reticle)
-        # * Get the matrix which transforms from imn to im1:
-        M_lat_imn=np.linalg.inv(M_imn_lat)
-        M_im1_imn=M_im1_lat@M_lat_imn
-        M_im1_big=M_im1_imn@M_imn_big
         # Now if we transform auto_tabn_reticle with M_im1_imn, it *should* approximately
         # hit the reticle marks on img1. So, plot this and find out.
         plt.figure(1)
         plt.clf()
-        plt.imshow(img1)
+        plt.imshow(setup.img1)
         plt.title(f"TAB 1 with transformed TAB {tab} reticle points")
-        for x,y in auto_tabn_reticle:
+        for x,y in result.reticle:
             v_imn=np.array([[x],[y],[1]])
-            v_im1=M_im1_imn @ v_imn
+            v_im1=result.M_im1_imn @ v_imn
             plt.plot(v_im1[0,0],v_im1[1,0],'w+')
-        print(M_im1_imn)
-        # * Use the affine transform to map this image into the same space as image1
-        rectified = transform_image(bigimgn, M_im1_big, output_shape=(1150,1150))
+    rectified=warp_tab(setup,result,load_frame(infn))
+    if plot:
         plt.figure(3)
         plt.clf()
         plt.imshow(rectified)
         plt.title(f"rectified TAB {tab}")
         plt.plot([x for x,y in manual_tab1_reticle],[y for x,y in manual_tab1_reticle],'r+')
         plt.pause(0.1)
-        Image.fromarray(rectified.astype(np.uint8), mode='L').save(oufn)
+    save_tab(setup,tab,rectified)
+    return result
+
+
+def finish_tab(setup:channel_tuple,result:tab_result,infn:str)->tab_result:
+    """
+    Warp and save one image which is already registered. This is the unit of work
+    done in worker processes when the registration is done by tracking in the main
+    process.
+
+    :param setup: Channel setup from prepare_channel()
+    :param result: Registration of this image, from search_tab() or track_tab()
+    :param infn: Filename of raw image
+    :return: result, unchanged
+    """
+    save_tab(setup,result.tab,warp_tab(setup,result,load_frame(infn)))
+    return result
+
+
+def _result_from_record(tab:int,record:dict)->tab_result:
+    """
+    Rebuild the tab_result of a TAB which was skipped, from its manifest record
+    """
+    return tab_result(tab=tab,M_im1_imn=np.array(record["M_im1_imn"]),
+                      reticle=np.array(record["reticle"],dtype=np.float64),
+                      residuals=np.array(record["residuals"],dtype=np.float64),
+                      confidence=np.array(record["confidence"],dtype=np.float64),
+                      inliers=np.array(record["inliers"]))
+
+
+class _Batch:
+    """
+    Bookkeeping shared by batch_rectify() and stream_rectify(): the setup of each
+    channel, which TABs need doing, and the results and manifests as they come in.
+    Only ever touched from the main process. In stream_rectify(), tracker_for() is
+    called from the search thread while finish() is called from the main thread, so
+    both hold the lock. The tracker itself is then only used by the one search thread,
+    until close().
+    """
+    def __init__(self,channels:Iterable[tuple[int,str]],*,incremental:bool,outputs:tuple[str,...],
+                 track:bool,click:bool,distortion:str):
+        self.setups=[prepare_channel(mission,channel,incremental=incremental,outputs=outputs,click=click,
+                                     distortion=distortion)
+                     for mission,channel in channels]
+        self.results={(setup.mission,setup.channel):{} for setup in self.setups}
+        self.manifests={(setup.mission,setup.channel):load_manifest(manifest_path(setup.mission,setup.channel))
+                        for setup in self.setups}
+        # Figure out which TABs need to be done
+        self.jobs=[]
+        for i_setup,setup in enumerate(self.setups):
+            key=(setup.mission,setup.channel)
+            tabs=list_tabs(setup)
+            stack_intact=True
+            if "stack" in outputs:
+                # Allocate the whole stack now, so that each worker can write its own frame
+                _,stack_intact=open_stack(setup.mission,setup.channel,[tab for tab,_ in tabs])
+                setup=setup._replace(slots={tab:i for i,(tab,_) in enumerate(tabs)})
+                self.setups[i_setup]=setup
+            for tab,infn in tabs:
+                input_hash=file_hash(infn)
+                record=self.manifests[key]["tabs"].get(tab)
+                oufn=rect_filename(setup.mission,setup.channel,tab) if "png" in outputs else None
+                if incremental and stack_intact and is_current(record,input_hash=input_hash,
+                                                               setup_key=setup.setup_key,
+                                                               pipeline_version=pipeline_version,oufn=oufn):
+                    self.results[key][tab]=_result_from_record(tab,record)
+                else:
+                    self.jobs.append((setup,tab,infn,input_hash))
+        print(f"{len(self.jobs)} TABs to rectify, {sum(len(r) for r in self.results.values())} already up to date")
+        self.trackers={(setup.mission,setup.channel):ReticleTracker() for setup in self.setups} if track else None
+        # TABs which were skipped, which the trackers still need to hear about
+        self.untracked={key:sorted(results) for key,results in self.results.items()}
+        self.lock=threading.Lock()
+
+    def tracker_for(self,setup:channel_tuple,tab:int)->ReticleTracker|None:
+        """
+        Get the tracker for a channel, ready to track the given TAB. Must be called
+        for the TABs of each channel in increasing order.
+
+        :return: Tracker, or None if not tracking
+        """
+        if self.trackers is None:
+            return None
+        key=(setup.mission,setup.channel)
+        with self.lock:
+            tracker=self.trackers[key]
+            # Catch the tracker up with any TABs before this one which were skipped
+            untracked=self.untracked[key]
+            while untracked and untracked[0]<tab:
+                skipped=untracked.pop(0)
+                result=self.results[key][skipped]
+                tracker.update(skipped,np.linalg.inv(result.M_im1_imn)@setup.M_im1_lat,_rms_residual(result))
+        return tracker
+
+    def finish(self,setup:channel_tuple,input_hash:str,result:tab_result):
+        """
+        Record one finished TAB, and rewrite its channel manifest
+        """
+        key=(setup.mission,setup.channel)
+        print(f"{setup.mission:1d}{setup.channel}{result.tab:03d}")
+        with self.lock:
+            self.results[key][result.tab]=result
+            self.manifests[key]["tabs"][result.tab]=make_record(input_hash=input_hash,setup_key=setup.setup_key,
+                                                                 pipeline_version=pipeline_version,
+                                                                 reticle=result.reticle,M_im1_imn=result.M_im1_imn,
+                                                                 residuals=result.residuals,inliers=result.inliers,
+                                                                 confidence=result.confidence)
+            save_manifest(manifest_path(*key),self.manifests[key])
+
+    def close(self):
+        """
+        Write the frame stack table of each channel, once all of its frames are done
+        """
+        if self.trackers is not None:
+            for (mission,channel),tracker in self.trackers.items():
+                print(f"{mission:1d}{channel}: {tracker.n_tracked} TABs tracked, "
+                      f"{tracker.n_fallback} fell back to full search")
+        for setup in self.setups:
+            if "stack" not in setup.outputs:
+                continue
+            results=[self.results[(setup.mission,setup.channel)][tab] for tab in setup.slots]
+            save_table(setup.mission,setup.channel,np.array(list(setup.slots)),
+                       M_im1_imn=np.stack([result.M_im1_imn for result in results]),
+                       residuals=np.stack([result.residuals for result in results]),
+                       inliers=np.stack([result.inliers for result in results]))
+
+
+def batch_rectify(channels:Iterable[tuple[int,str]],*,plot:bool=False,n_workers:int=None,
+                  incremental:bool=True,outputs:tuple[str,...]=("png",),
+                  track:bool=True,click:bool=False,distortion:str=None)->dict[tuple[int,str],dict[int,tab_result]]:
+    """
+    Rectify every TAB of several channels.
+
+    :param channels: Iterable of (mission,channel) tuples, IE ((7,"A"),(7,"B"))
+    :param plot: If True, process every TAB one after another in this process and
+                 show the intermediate results. If False (default), run headless
+                 and spread the TABs over a pool of worker processes.
+    :param n_workers: Number of worker processes. Default is one per CPU. Pass 1
+                      to process everything in this process without a pool.
+    :param incremental: If True (default), skip every TAB whose manifest record shows
+                        that its raw image, the TAB 1 setup, and the algorithm version
+                        are all unchanged since it was last rectified. If False, wipe
+                        the channel and redo everything.
+    :param outputs: Any of "png" to write a PNG for each TAB (default), and "stack"
+                    to write each channel into one frame stack, see frame_stack.py
+    :param track: If True (default), track the reticle from TAB to TAB with a
+                  ReticleTracker, searching small boxes around the predicted marks,
+                  see track_tab(). If False, do the full search on every TAB.
+    :param click: If True, have the user click the reticle marks of any channel which
+                  doesn't have clicks yet. If False (default), find them automatically.
+                  See get_manual_reticle().
+    :param distortion: Passed to prepare_channel()
+    :return: Dictionary keyed by (mission,channel). Each value is a dictionary keyed
+             by TAB number, where each value is the tab_result for that TAB.
+
+    All of the TAB 1 setup is done first, so that any channel which still needs manual
+    reticle clicks (with click=True) asks for them before the long unattended part starts. All TABs from
+    all channels go into the same pool, so that the tail end of one channel overlaps
+    the start of the next.
+
+    The manifest is rewritten as each TAB finishes, so an interrupted run picks up
+    where it left off.
+
+    Tracking needs each channel to be registered in TAB order, so when tracking, the
+    registration is done here in the main process, and only the warping and saving
+    are sent to the pool.
+    """
+    batch=_Batch(channels,incremental=incremental,outputs=outputs,track=track,click=click,distortion=distortion)
+    if plot or n_workers==1:
+        # Only one process, so let its FFTs use every CPU. Pool workers, and the main
+        # process while the pool is busy, stay at the scipy.fft default of one thread.
+        with set_workers(-1):
+            for setup,tab,infn,input_hash in batch.jobs:
+                batch.finish(setup,input_hash,rectify_tab(setup,tab,infn,plot=plot,tracker=batch.tracker_for(setup,tab)))
+        batch.close()
+        return batch.results
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures={}
+        for setup,tab,infn,input_hash in batch.jobs:
+            # Workers don't plot, so don't bother shipping TAB 1 to each one
+            worker_setup=setup._replace(img1=None)
+            if track:
+                result=track_tab(setup,tab,infn,batch.tracker_for(setup,tab))
+                futures[pool.submit(finish_tab,worker_setup,result,infn)]=(setup,input_hash)
+            else:
+                futures[pool.submit(rectify_tab,worker_setup,tab,infn)]=(setup,input_hash)
+        for future in as_completed(futures):
+            setup,input_hash=futures[future]
+            batch.finish(setup,input_hash,future.result())
+    batch.close()
+    return batch.results
+
+
+def stream_rectify(channels:Iterable[tuple[int,str]],*,n_decode:int=2,n_compute:int=None,n_encode:int=2,
+                   queue_size:int=4,incremental:bool=True,outputs:tuple[str,...]=("png",),
+                   track:bool=True,click:bool=False,distortion:str=None,
+                   report_every:float=None)->dict[tuple[int,str],dict[int,tab_result]]:
+    """
+    Rectify every TAB of several channels with a streaming pipeline, so that reading
+    and decoding the next frames, registering and warping the current ones, and
+    encoding and writing the finished ones all happen at the same time.
+
+    :param channels: Iterable of (mission,channel) tuples, IE ((7,"A"),(7,"B"))
+    :param n_decode: Number of threads doing the reticle search on reduced-resolution
+                     decodes, and also the number decoding full-resolution images. When
+                     tracking, the search is always done by one thread, since it has to
+                     see the TABs in order.
+    :param n_compute: Number of threads warping. Default is one per CPU.
+    :param n_encode: Number of threads encoding and writing rectified images
+    :param queue_size: Maximum number of frames waiting in front of each stage. This
+                       bounds the number of decoded frames in memory at once.
+    :param incremental: Same as batch_rectify()
+    :param outputs: Same as batch_rectify()
+    :param track: Same as batch_rectify()
+    :param click: Same as batch_rectify()
+    :param distortion: Same as batch_rectify()
+    :param report_every: If set, print the per-stage statistics this often, in seconds
+    :return: Same as batch_rectify()
+
+    This does the same work as batch_rectify() with the same results, but in threads
+    in one process rather than in a process pool. Each frame is decoded at full
+    resolution only once its reticle search is done, into memory that the later
+    stages share, rather than being pickled between processes.
+    When the run is over, the per-stage statistics are printed, showing which stage
+    is the bottleneck: it is the one which is busy all the time, while the stages
+    before it are blocked and the ones after it are starved.
+    """
+    batch=_Batch(channels,incremental=incremental,outputs=outputs,track=track,click=click,distortion=distortion)
+    if n_compute is None:
+        n_compute=os.cpu_count()
+
+    # The FFTs in search() are left at the scipy.fft default of one thread, since
+    # the other stages are keeping the rest of the CPUs busy.
+    def search(job):
+        setup,tab,infn,input_hash=job
+        if track:
+            return setup,infn,input_hash,track_tab(setup,tab,infn,batch.tracker_for(setup,tab))
+        return setup,infn,input_hash,search_tab(setup,tab,infn)
+
+    def decode(item):
+        setup,infn,input_hash,result=item
+        # Actually pull the pixels in here, rather than leaving a memory map to be
+        # paged in by the compute stage.
+        return setup,input_hash,result,np.array(load_frame(infn))
+
+    def compute(item):
+        setup,input_hash,result,bigimgn=item
+        return setup,input_hash,result,warp_tab(setup,result,bigimgn)
+
+    def encode(item):
+        setup,input_hash,result,rectified=item
+        save_tab(setup,result.tab,rectified)
+        return setup,input_hash,result
+
+    stages=[Stage("search",search,n_threads=1 if track else n_decode,maxsize=queue_size),
+            Stage("decode",decode,n_threads=n_decode,maxsize=queue_size),
+            Stage("compute",compute,n_threads=n_compute,maxsize=queue_size),
+            Stage("encode",encode,n_threads=n_encode,maxsize=queue_size)]
+    t0=time.perf_counter()
+    for setup,input_hash,result in run_pipeline(batch.jobs,stages,report_every=report_every):
+        batch.finish(setup,input_hash,result)
+    batch.close()
+    wall=time.perf_counter()-t0
+    for stage in stages:
+        print(stage.report(wall))
+    return batch.results
+
+
+def auto_rectify(mission:int,channel:str,*,plot:bool=False,n_workers:int=None,
+                 incremental:bool=True,outputs:tuple[str,...]=("png",),track:bool=True,
+                 click:bool=False,distortion:str=None)->dict[int,tab_result]:
+    """
+    Rectify every TAB of one channel into the space of TAB 1
+
+    :param mission: Mission number, IE 7=Ranger 7, etc.
+    :param channel: Either A, B, or P
+    :param plot: Passed to batch_rectify()
+    :param n_workers: Passed to batch_rectify()
+    :param incremental: Passed to batch_rectify()
+    :param outputs: Passed to batch_rectify()
+    :param track: Passed to batch_rectify()
+    :param click: Passed to batch_rectify()
+    :param distortion: Passed to batch_rectify()
+    :return: Dictionary keyed by TAB number, where each value is the tab_result for that TAB.
+    """
+    return batch_rectify(((mission,channel),),plot=plot,n_workers=n_workers,
+                         incremental=incremental,outputs=outputs,track=track,click=click,
+                         distortion=distortion)[(mission,channel)]
 
 
 def main():
-    # auto_rectify(7,"A")
-    auto_rectify(8,"B")
+    parser=ArgumentParser(description="Rectify Ranger images into the space of TAB 1")
+    parser.add_argument("channels",nargs="*",default=["8B"],
+                        help="Mission and channel to process, IE 7A 7B 8A 8B")
+    parser.add_argument("--plot",action="store_true",
+                        help="Show intermediate results. Processes one TAB at a time.")
+    parser.add_argument("--workers",type=int,default=None,
+                        help="Number of worker processes, default is one per CPU")
+    parser.add_argument("--all",action="store_true",
+                        help="Redo every TAB, rather than only the ones whose inputs changed")
+    parser.add_argument("--stream",action="store_true",
+                        help="Use the threaded streaming pipeline, overlapping decode, compute, and encode. "
+                             "--workers is then the number of compute threads.")
+    parser.add_argument("--report",type=float,default=None,
+                        help="With --stream, print per-stage statistics this often, in seconds")
+    parser.add_argument("--output",choices=["png","stack","both"],default="png",
+                        help="Write a PNG per TAB (default), one frame stack per channel, or both")
+    parser.add_argument("--no-track",dest="track",action="store_false",
+                        help="Do the full reticle search on every TAB, rather than tracking the reticle")
+    parser.add_argument("--click",action="store_true",
+                        help="For a channel without stored TAB 1 reticle clicks, click the marks by hand "
+                             "rather than finding them automatically")
+    parser.add_argument("--distortion",choices=["poly","tps"],default=None,
+                        help="Also fit a polynomial or thin-plate spline distortion model to the reticle marks "
+                             "of each TAB, and rectify with it rather than with the affine fit alone")
+    args=parser.parse_args()
+    if args.stream and args.plot:
+        parser.error("--plot can't be used with --stream")
+    channels=[(int(arg[:-1]),arg[-1]) for arg in args.channels]
+    outputs=("png","stack") if args.output=="both" else (args.output,)
+    if args.stream:
+        stream_rectify(channels,n_compute=args.workers,incremental=not args.all,outputs=outputs,
+                       track=args.track,click=args.click,distortion=args.distortion,report_every=args.report)
+    else:
+        batch_rectify(channels,plot=args.plot,n_workers=args.workers,incremental=not args.all,outputs=outputs,
+                      track=args.track,click=args.click,distortion=args.distortion)
 
 
 if __name__=="__main__":
-    main()
\ No newline at end of file
+    main()
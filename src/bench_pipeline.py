@@ -0,0 +1,315 @@
+"""
+Benchmark the image pipeline on synthetic Ranger frames.
+
+The real LPI scans are a big download, so this makes its own: a smooth random
+"surface" with the synthetic reticle masks drawn onto it at the TAB 1 click
+positions, then for each TAB pushed through a known, slowly drifting affine
+distortion, enlarged to scan resolution, given some noise, and saved as JPEG.
+Since we know the true matrix for every TAB, we can measure not only how fast
+each stage is but also how well the registration does.
+
+Each stage is timed on its own, then auto_rectify is run end to end (both with
+batch_rectify() and stream_rectify()) in a scratch folder. For every run we
+record the time, frames per second, and the peak memory allocated, as reported
+by tracemalloc. Results go to a JSON file, so that runs before and after a change
+can be compared on any machine. Run it from the root of the repository:
+
+python src/bench_pipeline.py --scales 1 2 --frames 5 20
+"""
+import json
+import os
+import platform
+import resource
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from collections import namedtuple
+from collections.abc import Callable
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from PIL import Image
+from matplotlib import image as mpimg
+from scipy.ndimage import gaussian_filter
+
+from auto_rectify import (get_synthetic_masks, get_manual_reticle, get_masks, get_mask_templates, calc_M_img_big,
+                          calc_M_im_lat, transform_image, scaledown, warp_img_boxes, prepare_channel,
+                          register_tab, batch_rectify, stream_rectify)
+from block_flow import stack_flow
+from correlate import cross_image, img_offset, cross_images, img_offsets, pyramid_offsets
+from distortion import fit_distortion, warp_map
+from frame_cache import load_reduced_frame
+from lattice import get_lattice, fit_lattice
+from warp import affine_warp, remap
+
+synthetic_channel_tuple=namedtuple('synthetic_channel_tuple','tabs,M_imn_im1,big_shape')
+
+
+def make_scene(mission:int,channel:str,*,image_size:int=1150,seed:int=3217)->np.ndarray:
+    """
+    Make a synthetic TAB 1 image, in the scaled image space
+
+    :param mission: Mission number, IE 7=Ranger 7, etc.
+    :param channel: Either A or B
+    :param image_size: Width and height of the scene
+    :param seed: Random seed for the surface texture
+    :return: float32 image, bright surface with dark reticle marks
+
+    Each mark is drawn so that pixel [box_r,box_r] of its synthetic mask lands
+    exactly on the TAB 1 click, which is where the correlation says a mark is when
+    it lines up with its mask.
+    """
+    rng=np.random.default_rng(seed)
+    # Smooth blotchy "surface", roughly 60 to 200 DN
+    surface=gaussian_filter(rng.normal(size=(image_size,image_size)),8).astype(np.float32)
+    surface=130+70*surface/np.max(np.abs(surface))
+    marks=np.zeros_like(surface)
+    for (x,y),mask in zip(get_manual_reticle(mission,channel,None),get_synthetic_masks(mission,channel)):
+        r=mask.shape[0]//2
+        M_scene_mask=np.array([[1,0,x-r],[0,1,y-r],[0,0,1]])
+        marks=np.maximum(marks,affine_warp(mask,M_scene_mask,output_shape=surface.shape))
+    return surface*(1-0.8*marks/255)
+
+
+def true_M_imn_im1(tab:int,rng:np.random.Generator)->np.ndarray:
+    """
+    Make the distortion of one TAB. The frame drifts smoothly from TAB to TAB, the
+    way the real camera does, with a little jitter on top.
+
+    :param tab: TAB number. TAB 1 is undistorted.
+    :param rng: Random number source for the jitter
+    :return: Matrix which transforms TAB 1 coordinates to this TAB's coordinates
+    """
+    if tab==1:
+        return np.eye(3)
+    t=tab-1
+    scale=1+0.004*np.sin(t/7)+rng.normal(scale=0.0005)
+    theta=0.003*np.sin(t/11)+rng.normal(scale=0.0005)
+    dx=8*np.sin(t/9)+rng.normal(scale=0.5)
+    dy=6*np.sin(t/13+1)+rng.normal(scale=0.5)
+    c,s=scale*np.cos(theta),scale*np.sin(theta)
+    # Rotate and scale about the center of the frame
+    M_rot=np.array([[c,-s,0],[s,c,0],[0,0,1]])
+    M_center=np.array([[1,0,575],[0,1,575],[0,0,1]])
+    return np.array([[1,0,dx],[0,1,dy],[0,0,1]])@M_center@M_rot@np.linalg.inv(M_center)
+
+
+def make_synthetic_channel(mission:int,channel:str,n_frames:int,*,scale:float=2.0,noise:float=3.0,
+                           quality:int=90,seed:int=3217,image_size:int=1150)->synthetic_channel_tuple:
+    """
+    Write a synthetic channel of raw images to raw_images/ under the current folder
+
+    :param mission: Mission number, IE 7=Ranger 7, etc.
+    :param channel: Either A or B
+    :param n_frames: Number of TABs to make, numbered from 1
+    :param scale: Size of the raw images relative to the scaled images, IE 2.0 makes
+                  raw images 2300 wide
+    :param noise: Standard deviation of noise added to each raw image, in DN
+    :param quality: JPEG quality
+    :param seed: Random seed
+    :param image_size: Width of scaled images
+    :return: synthetic_channel_tuple of the TAB numbers, the true matrix M_imn_im1 of
+             each one (shape [n_frames,3,3]), and the shape of the raw images
+    """
+    rng=np.random.default_rng(seed)
+    scene=make_scene(mission,channel,image_size=image_size,seed=seed)
+    big_shape=(int(round(image_size*scale)),)*2
+    # Use exactly the same scaling as auto_rectify will
+    M_big_img=np.linalg.inv(calc_M_img_big(big_shape,image_size))
+    os.makedirs(f"raw_images/{mission:1d}{channel}",exist_ok=True)
+    tabs=list(range(1,n_frames+1))
+    M_imn_im1=np.stack([true_M_imn_im1(tab,rng) for tab in tabs])
+    for tab,M in zip(tabs,M_imn_im1):
+        big=affine_warp(scene,M_big_img@M,output_shape=big_shape)
+        big+=rng.normal(scale=noise,size=big.shape).astype(np.float32)
+        Image.fromarray(np.clip(np.round(big),0,255).astype(np.uint8),mode='L').save(
+            f"raw_images/{mission:1d}{channel}/Ranger{mission:1d}{channel}{tab:03d}.jpg",quality=quality)
+    return synthetic_channel_tuple(tabs=tabs,M_imn_im1=M_imn_im1,big_shape=big_shape)
+
+
+def registration_error(M_im1_imn:np.ndarray,M_imn_im1:np.ndarray,points:np.ndarray)->np.ndarray:
+    """
+    Measure how far a fitted registration is from the truth
+
+    :param M_im1_imn: Fitted matrices, shape [...,3,3]
+    :param M_imn_im1: True matrices, same shape
+    :param points: TAB 1 points to measure at, shape [n,2]
+    :return: RMS distance in pixels between each point and where it lands after going
+             out through the true distortion and back through the fitted one, shape [...]
+    """
+    v=np.hstack((points,np.ones((len(points),1))))
+    round_trip=np.einsum('...ij,...jk,nk->...ni',M_im1_imn,M_imn_im1,v)[...,0:2]
+    return np.sqrt(np.mean(np.sum((round_trip-points)**2,axis=-1),axis=-1))
+
+
+def measure(func:Callable,repeat:int=3)->dict:
+    """
+    Time a function and measure its peak memory allocation
+
+    :param func: Function with no arguments
+    :param repeat: Number of timed calls
+    :return: Dictionary of best and mean time in seconds, and peak bytes allocated
+             during one extra call. That call is separate from the timed ones,
+             since tracing allocations slows things down.
+    """
+    tracemalloc.start()
+    func()
+    _,peak=tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    times=[]
+    for i in range(repeat):
+        t0=time.perf_counter()
+        func()
+        times.append(time.perf_counter()-t0)
+    return {"best_s":min(times),"mean_s":float(np.mean(times)),"peak_bytes":peak}
+
+
+def bench_stages(mission:int,channel:str,synth:synthetic_channel_tuple,*,repeat:int=3)->dict:
+    """
+    Time each stage of the pipeline on its own, on TAB 2 of a synthetic channel
+    """
+    image_size=1150
+    infn=f"raw_images/{mission:1d}{channel}/Ranger{mission:1d}{channel}{min(2,len(synth.tabs)):03d}.jpg"
+    big=mpimg.imread(infn)
+    img=scaledown(big,image_size)
+    M_img_big=calc_M_img_big(big.shape,image_size)
+    reticle=get_manual_reticle(mission,channel,None)
+    lattice=get_lattice(mission,channel)
+    masks=get_synthetic_masks(mission,channel)
+    templates=get_mask_templates(mission,channel)
+    boxes=np.stack(warp_img_boxes(big,M_img_big,reticle))
+    crosses=cross_images(255-boxes,templates)
+    offsets=img_offsets(crosses,bbox_r=20)
+    points=[(x+xofs,y+yofs) for (x,y),(yofs,xofs) in zip(reticle,offsets)]
+    setup=prepare_channel(mission,channel)
+    reduced=load_reduced_frame(infn,image_size)
+    M_img_red=calc_M_img_big(reduced.big_shape,image_size)@reduced.M_big_img
+    model=fit_distortion(points,lattice,kind="tps")
+    M_lat_img=np.linalg.inv(calc_M_im_lat(points,mission=mission,channel=channel))
+    map_xy=warp_map(model,M_lat_img,(image_size,image_size))
+    M_big_img=np.linalg.inv(M_img_big)
+    frame_pair=np.stack((scaledown(mpimg.imread(f"raw_images/{mission:1d}{channel}/Ranger{mission:1d}{channel}001.jpg"),
+                                   image_size),img))
+    stages={
+        "decode_full":lambda:mpimg.imread(infn),
+        "decode_reduced":lambda:_decode_reduced(infn,image_size),
+        "scaledown":lambda:scaledown(big,image_size),
+        "transform_image":lambda:transform_image(big,M_img_big,output_shape=(image_size,image_size),dtype=np.uint8),
+        "warp_map_tps":lambda:warp_map(model,M_lat_img,(image_size,image_size)),
+        "remap":lambda:remap(big,map_xy,M_src_map=M_big_img,dtype=np.uint8),
+        "warp_img_boxes":lambda:warp_img_boxes(big,M_img_big,reticle),
+        "cross_image":lambda:[cross_image(255-box,mask) for box,mask in zip(boxes,masks)],
+        "img_offset":lambda:[img_offset(cross=cross,bbox_r=20) for cross in crosses],
+        "cross_images":lambda:cross_images(255-boxes,templates),
+        "cross_images_normalized":lambda:cross_images(255-boxes,templates,normalized=True),
+        "img_offsets":lambda:img_offsets(crosses,bbox_r=20),
+        "calc_M_im_lat":lambda:calc_M_im_lat(points,mission=mission,channel=channel),
+        "fit_lattice":lambda:fit_lattice(points,lattice),
+        "pyramid_offsets":lambda:pyramid_offsets(255-boxes,get_masks(mission,channel),bbox_r=20,levels=2),
+        "register_tab":lambda:register_tab(setup,2,reduced.img,M_img_red),
+        "register_tab_pyramid":lambda:register_tab(setup,2,reduced.img,M_img_red,levels=2),
+        # Same, with the small search used when tracking
+        "register_tab_tracked":lambda:register_tab(setup,2,reduced.img,M_img_red,centers=points,box_r=32,bbox_r=8),
+        # Small search first, then a wide pyramid search for only the unconfident marks
+        "register_tab_escalate":lambda:register_tab(setup,2,reduced.img,M_img_red,box_r=32,bbox_r=8,
+                                                    escalate=((50,20,2),)),
+        # Flow field and expansion fit between TAB 1 and TAB 2
+        "stack_flow":lambda:stack_flow(frame_pair),
+    }
+    return {name:measure(func,repeat) for name,func in stages.items()}
+
+
+def _decode_reduced(infn:str,min_width:int)->np.ndarray:
+    """
+    Decode a JPEG the way load_reduced_frame() does, but without the cache
+    """
+    with Image.open(infn) as im:
+        im.draft(im.mode,(min_width,min_width))
+        return np.asarray(im)
+
+
+def bench_pipeline(mission:int,channel:str,synth:synthetic_channel_tuple,*,n_workers:int=None)->dict:
+    """
+    Run auto_rectify end to end on a synthetic channel, with a cold frame cache each time
+    """
+    result={}
+    points=np.array(get_manual_reticle(mission,channel,None))
+    n_frames=len(synth.tabs)
+    runs={"batch_serial":lambda:batch_rectify(((mission,channel),),n_workers=1,incremental=False),
+          "batch_serial_no_track":lambda:batch_rectify(((mission,channel),),n_workers=1,incremental=False,
+                                                       track=False),
+          "batch_pool":lambda:batch_rectify(((mission,channel),),n_workers=n_workers,incremental=False),
+          "stream":lambda:stream_rectify(((mission,channel),),n_compute=n_workers,incremental=False)}
+    for name,run in runs.items():
+        for fn in os.listdir("scratch/frame_cache") if os.path.exists("scratch/frame_cache") else []:
+            os.remove(os.path.join("scratch/frame_cache",fn))
+        tracemalloc.start()
+        t0=time.perf_counter()
+        results=run()[(mission,channel)]
+        dt=time.perf_counter()-t0
+        _,peak=tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        M_im1_imn=np.stack([results[tab].M_im1_imn for tab in synth.tabs])
+        error=registration_error(M_im1_imn,synth.M_imn_im1,points)
+        result[name]={"seconds":dt,"frames_per_second":n_frames/dt,
+                      # tracemalloc only sees this process, not the pool workers
+                      "peak_bytes":peak,
+                      "registration_error_px":{"mean":float(np.mean(error)),"max":float(np.max(error))}}
+    return result
+
+
+def run_benchmark(*,scales:list[float],frame_counts:list[int],repeat:int=3,n_workers:int=None,
+                  mission:int=7,channel:str="A")->dict:
+    """
+    Run the whole benchmark, each scale and frame count in a fresh scratch folder
+
+    :return: Dictionary of results, ready to write as JSON
+    """
+    report={"platform":{"python":platform.python_version(),"machine":platform.machine(),
+                        "processor":platform.processor(),"cpus":os.cpu_count(),
+                        "numpy":np.__version__},
+            "mission":mission,"channel":channel,"runs":[]}
+    cwd=os.getcwd()
+    for scale in scales:
+        for n_frames in frame_counts:
+            with TemporaryDirectory() as tmp:
+                os.chdir(tmp)
+                try:
+                    os.mkdir("rect_images")
+                    print(f"scale {scale}, {n_frames} frames")
+                    synth=make_synthetic_channel(mission,channel,n_frames,scale=scale)
+                    run={"scale":scale,"n_frames":n_frames,"raw_shape":synth.big_shape,
+                         "stages":bench_stages(mission,channel,synth,repeat=repeat),
+                         "pipeline":bench_pipeline(mission,channel,synth,n_workers=n_workers)}
+                finally:
+                    os.chdir(cwd)
+            report["runs"].append(run)
+    # ru_maxrss is in kilobytes on Linux
+    report["max_rss_bytes"]=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+    return report
+
+
+def main():
+    parser=ArgumentParser(description="Benchmark the rectification pipeline on synthetic frames")
+    parser.add_argument("--scales",type=float,nargs="+",default=[1.0,2.0],
+                        help="Raw image size relative to the 1150-pixel scaled images")
+    parser.add_argument("--frames",type=int,nargs="+",default=[5,20],help="Numbers of TABs to run")
+    parser.add_argument("--repeat",type=int,default=3,help="Number of timed calls of each stage")
+    parser.add_argument("--workers",type=int,default=None,help="Worker processes or compute threads")
+    parser.add_argument("--output",default="scratch/bench_pipeline.json",help="JSON file to write")
+    args=parser.parse_args()
+    report=run_benchmark(scales=args.scales,frame_counts=args.frames,repeat=args.repeat,n_workers=args.workers)
+    with open(args.output,"wt") as ouf:
+        json.dump(report,ouf,indent=1)
+    for run in report["runs"]:
+        print(f"scale {run['scale']}, {run['n_frames']} frames")
+        for name,stage in run["stages"].items():
+            print(f"  {name:>16s}: {stage['best_s']*1000:9.2f} ms, peak {stage['peak_bytes']/1024**2:8.1f} MiB")
+        for name,pipe in run["pipeline"].items():
+            print(f"  {name:>16s}: {pipe['frames_per_second']:7.2f} frames/s, "
+                  f"error {pipe['registration_error_px']['mean']:.3f} px mean, "
+                  f"{pipe['registration_error_px']['max']:.3f} px max")
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,319 @@
+"""
+Dense block-matching flow between consecutive rectified frames.
+
+Each frame is cut into a grid of square tiles, and each tile is found in the next
+frame by normalized cross-correlation. The result is a displacement (flow)
+vector at every grid point. The tiles of many frame pairs are correlated at
+once, in one batched FFT call with correlate.cross_images(), so a whole frame
+stack takes seconds rather than the minutes of correlating each tile in a loop.
+
+Since consecutive frames are mostly a zoom about the focus of expansion (point 1,
+see Ranger7.processImageA()), the flow field of each pair is then fit by least
+squares with an expansion about a point plus a small rotation. The expansion rate
+can be checked against the slant range to point 1 in the trajectory tables, and
+the focus of expansion against where the tables put point 1 in the frame.
+
+This is done twice. The first pass works on the frames shrunk by half, and
+searches only a small window around zero flow, which is enough near the focus of
+expansion, where little moves. It is cheap, since the tiles have a quarter of
+the pixels. The fit from that pass then predicts where each tile has gone, and
+the second pass searches around the prediction at full resolution, so that tiles
+near the edges of the late frames, which move a long way, are found too.
+
+Run it from the root of the repository on a channel whose frame stack has been
+written by auto_rectify --output stack:
+
+python src/block_flow.py 7A
+"""
+from argparse import ArgumentParser
+from collections import namedtuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.fft import set_workers
+
+from correlate import prepare_templates, cross_images, img_offsets, downsample2
+from fourier_mellin import table_zoom, focus_of_expansion
+from frame_stack import load_stack
+from lattice import get_lattice, fit_lattice
+from tables import load_table
+from auto_rectify import get_manual_reticle
+
+flow_tuple=namedtuple('flow_tuple','centers,flow,psr')
+expansion_tuple=namedtuple('expansion_tuple','scale,rotation,foe,M_next_prev,residuals,inliers')
+
+
+def tile_centers(shape:tuple[int,int],tile_r:int,step:int)->np.ndarray:
+    """
+    Centers of a grid of tiles covering a frame
+
+    :param shape: Frame shape (rows,cols)
+    :param tile_r: Square radius of each tile
+    :param step: Distance between tile centers
+    :return: Integer (x,y) of each tile center, shape [m,2]. Every tile is entirely
+             inside the frame.
+    """
+    rows,cols=shape
+    ys=np.arange(tile_r,rows-tile_r+1,step)
+    xs=np.arange(tile_r,cols-tile_r+1,step)
+    yy,xx=np.meshgrid(ys,xs,indexing='ij')
+    return np.stack((xx.ravel(),yy.ravel()),axis=1)
+
+
+def _cut_tiles(frames:np.ndarray,centers:np.ndarray,tile_r:int)->np.ndarray:
+    """
+    Cut tiles out of a stack of frames
+
+    :param frames: Frames, shape [n,rows,cols]
+    :param centers: Integer (x,y) of each tile center in each frame, shape [n,m,2] or [m,2]
+    :param tile_r: Square radius of each tile
+    :return: Tiles, shape [n,m,2*tile_r,2*tile_r]. Pixel [tile_r,tile_r] of each is its center.
+    """
+    n,rows,cols=frames.shape
+    centers=np.broadcast_to(centers,(n,)+centers.shape[-2:])
+    # Keep every tile inside the frame
+    x0=np.clip(centers[...,0]-tile_r,0,cols-2*tile_r)
+    y0=np.clip(centers[...,1]-tile_r,0,rows-2*tile_r)
+    windows=sliding_window_view(frames,(2*tile_r,2*tile_r),axis=(1,2))
+    return windows[np.arange(n)[:,None],y0,x0]
+
+
+def block_flow(prevs:np.ndarray,nexts:np.ndarray,centers:np.ndarray,*,tile_r:int=32,bbox_r:int=12,
+               predicted:np.ndarray=None)->tuple[np.ndarray,np.ndarray]:
+    """
+    Find how far each tile moved from one frame to the next, for many frame pairs at once
+
+    :param prevs: Earlier frame of each pair, shape [n,rows,cols]
+    :param nexts: Later frame of each pair, same shape
+    :param centers: Integer (x,y) of each tile center in the earlier frames, shape [m,2]
+    :param tile_r: Square radius of each tile
+    :param bbox_r: Square radius around the predicted position to look for each tile
+    :param predicted: Predicted flow of each tile, shape [n,m,2], or None to predict zero
+    :return: Tuple of the flow (dx,dy) of each tile, shape [n,m,2], and the
+             peak-to-sidelobe ratio of each match, shape [n,m]. Tiles which are
+             predicted to have left the later frame have a ratio of zero.
+    """
+    n=len(prevs)
+    m=len(centers)
+    shift=np.zeros((n,m,2),dtype=int) if predicted is None else np.round(predicted).astype(int)
+    rows,cols=nexts.shape[1:]
+    predicted_centers=centers+shift
+    next_centers=predicted_centers.copy()
+    next_centers[...,0]=np.clip(next_centers[...,0],tile_r,cols-tile_r)
+    next_centers[...,1]=np.clip(next_centers[...,1],tile_r,rows-tile_r)
+    on_frame=np.all(next_centers==predicted_centers,axis=-1)
+    size=(2*tile_r,2*tile_r)
+    prev_tiles=_cut_tiles(prevs,centers,tile_r).reshape((n*m,)+size)
+    next_tiles=_cut_tiles(nexts,next_centers,tile_r).reshape((n*m,)+size)
+    crosses=cross_images(next_tiles,prepare_templates(prev_tiles,size),normalized=True)
+    offsets,psr=img_offsets(crosses,bbox_r=bbox_r,subpixel=True,confidence=True)
+    # Offsets are (row,col), flow is (dx,dy)
+    flow=offsets[:,::-1].reshape(n,m,2)+(next_centers-centers)
+    return flow,np.where(on_frame,psr.reshape(n,m),0.0)
+
+
+def fit_expansion(centers:np.ndarray,flow:np.ndarray,valid:np.ndarray,*,
+                  reject_sigma:float=3.0,reject_floor:float=0.5,min_inliers:int=8,
+                  min_tiles:int=4,max_iter:int=5)->expansion_tuple:
+    """
+    Fit the flow of each frame pair with an expansion about a point, plus a rotation
+
+    :param centers: (x,y) of each tile center, shape [m,2]
+    :param flow: Flow (dx,dy) of each tile in each pair, shape [n,m,2]
+    :param valid: True for each flow vector to use, shape [n,m]
+    :param reject_sigma: A tile is rejected if its residual is more than this many times
+                         the robust RMS residual of the tiles in the current fit.
+    :param reject_floor: Never reject a tile with a residual smaller than this many pixels
+    :param min_inliers: Stop rejecting tiles when only this many are left
+    :param min_tiles: Pairs with fewer valid tiles than this (IE where one frame is blank)
+                      aren't fit, and get NaN for everything
+    :param max_iter: Maximum number of fit-and-reject passes
+    :return: expansion_tuple of, for each pair:
+      * scale - How much bigger the later frame is, shape [n]
+      * rotation - Rotation of the later frame, radians, shape [n]
+      * foe - (x,y) of the focus of expansion, shape [n,2]
+      * M_next_prev - Matrix which takes coordinates in the earlier frame to the later one, shape [n,3,3]
+      * residuals - Distance in pixels from each flow vector to the fit, shape [n,m]
+      * inliers - True for each tile used in the final fit, shape [n,m]
+
+    The model is a similarity transform,
+    [x'] [a -b][x] [c]
+    [y']=[b  a][y]+[d]
+    which is linear in (a,b,c,d), so each pair is solved in closed form with the
+    normal equations. Outliers (tiles on moving shadows, blemishes, or featureless
+    ground which matched the wrong place) are rejected iteratively the same way as
+    in lattice.fit_lattice().
+    """
+    centers=np.asarray(centers,dtype=np.float64)
+    flow=np.asarray(flow,dtype=np.float64)
+    x,y=centers[:,0],centers[:,1]
+    zero,one=np.zeros_like(x),np.ones_like(x)
+    # Design matrices for the x and y components of the moved points, shape [m,2,4]
+    design=np.stack((np.stack((x,-y,one,zero),axis=1),np.stack((y,x,zero,one),axis=1)),axis=1)
+    moved=centers+np.where(valid[...,None],flow,0.0)
+    inliers=valid.copy()
+    # Rejection never leaves fewer than min_inliers tiles, so this stays the same through every pass
+    fit=np.sum(valid,axis=-1)>=min_tiles
+    params=np.full((len(flow),4),np.nan)
+    sigma=np.full((len(flow),1),np.nan)
+    for i_iter in range(max_iter):
+        w=inliers[fit].astype(np.float64)
+        AtWA=np.einsum('mki,nm,mkj->nij',design,w,design)
+        AtWb=np.einsum('mki,nm,nmk->ni',design,w,moved[fit])
+        params[fit]=np.linalg.solve(AtWA,AtWb[...,None])[...,0]
+        residuals=np.linalg.norm(np.einsum('mki,ni->nmk',design,params)-moved,axis=-1)
+        if i_iter==max_iter-1:
+            break
+        sigma[fit]=1.2011*np.nanmedian(np.where(inliers[fit],residuals[fit],np.nan),axis=-1,keepdims=True)
+        new_inliers=valid & (residuals<=np.maximum(reject_sigma*sigma,reject_floor))
+        new_inliers=np.where(np.sum(new_inliers,axis=-1,keepdims=True)>=min_inliers,new_inliers,inliers)
+        if np.array_equal(new_inliers,inliers):
+            break
+        inliers=new_inliers
+    a,b,c,d=params.T
+    M_next_prev=np.zeros((len(params),3,3))
+    M_next_prev[:,0,:]=np.stack((a,-b,c),axis=1)
+    M_next_prev[:,1,:]=np.stack((b,a,d),axis=1)
+    M_next_prev[:,2,2]=1
+    return expansion_tuple(scale=np.hypot(a,b),rotation=np.arctan2(b,a),foe=focus_of_expansion(M_next_prev),
+                           M_next_prev=M_next_prev,residuals=np.where(valid,residuals,np.nan),inliers=inliers)
+
+
+def stack_flow(frames:np.ndarray,*,tile_r:int=24,step:int=48,bbox_r:int=12,min_psr:float=4.0,
+               chunk:int=8)->tuple[flow_tuple,expansion_tuple]:
+    """
+    Measure the flow between every pair of consecutive frames, and fit each
+
+    :param frames: Frames in order, shape [n,rows,cols], IE the frames of a frame stack
+    :param tile_r: Square radius of each tile
+    :param step: Distance between tile centers
+    :param bbox_r: Square radius around the predicted position to look for each tile
+    :param min_psr: Matches with a peak-to-sidelobe ratio lower than this (IE on
+                    featureless ground, or off the edge of the picture) aren't used
+    :param chunk: Number of frame pairs to correlate in each batch, which bounds the memory used
+    :return: Tuple of:
+      * flow_tuple of the tile centers (shape [m,2]), and the flow (shape [n-1,m,2]) and
+        peak-to-sidelobe ratio (shape [n-1,m]) of each tile in each pair
+      * expansion_tuple from fit_expansion() of the second pass
+    """
+    centers=tile_centers(frames.shape[1:],tile_r,step)
+    flows=[]
+    psrs=[]
+    for i in range(0,len(frames)-1,chunk):
+        chunk_frames=np.asarray(frames[i:i+chunk+1],dtype=np.float32)
+        prevs,nexts=chunk_frames[:-1],chunk_frames[1:]
+        # The search box is the same number of shrunk pixels, so covers twice as far
+        coarse=downsample2(chunk_frames)
+        flow,psr=block_flow(coarse[:-1],coarse[1:],centers//2,tile_r=tile_r//2,bbox_r=bbox_r)
+        fit=fit_expansion(centers,2*flow,psr>=min_psr)
+        predicted=np.einsum('nij,mj->nmi',fit.M_next_prev[:,0:2,0:2],centers)+fit.M_next_prev[:,None,0:2,2]-centers
+        # Where the coarse pass couldn't be fit, search around no motion at all
+        predicted=np.where(np.isfinite(predicted),predicted,0.0)
+        flow,psr=block_flow(prevs,nexts,centers,tile_r=tile_r,bbox_r=bbox_r,predicted=predicted)
+        flows.append(flow)
+        psrs.append(psr)
+    flow=np.concatenate(flows)
+    psr=np.concatenate(psrs)
+    return flow_tuple(centers=centers,flow=flow,psr=psr),fit_expansion(centers,flow,psr>=min_psr)
+
+
+def project_pinhole(targets:np.ndarray,centers:np.ndarray,rights:np.ndarray,
+                    pix_center:np.ndarray,pix_right:np.ndarray)->np.ndarray:
+    """
+    Find where a direction falls in a picture from a pinhole camera, given where two
+    other directions fall in it
+
+    :param targets: Directions from the camera to the points to project, shape [n,3]
+    :param centers: Directions to the point on the optical axis, shape [n,3]
+    :param rights: Directions to a second point, shape [n,3]
+    :param pix_center: (x,y) of the point on the optical axis in the picture
+    :param pix_right: (x,y) of the second point in the picture
+    :return: (x,y) of each target in the picture, shape [n,2]
+
+    The camera frame has z along the optical axis, x towards the second point, and
+    y=z cross x, which is down in the picture when x is to the right. The focal length
+    in pixels comes from the angle between the two known directions and the distance
+    between them in the picture. Pixels are assumed to be square.
+    """
+    def unit(v):
+        return v/np.linalg.norm(v,axis=-1,keepdims=True)
+    z=unit(centers)
+    x=unit(rights-np.sum(rights*z,axis=-1,keepdims=True)*z)
+    y=np.cross(z,x)
+    e=np.asarray(pix_right,dtype=np.float64)-pix_center
+    ex=e/np.linalg.norm(e)
+    ey=np.array((-ex[1],ex[0]))
+    rights=unit(rights)
+    f=np.linalg.norm(e)*np.sum(rights*z,axis=-1)/np.sum(rights*x,axis=-1)
+    dz=np.sum(targets*z,axis=-1)
+    u=f*np.sum(targets*x,axis=-1)/dz
+    v=f*np.sum(targets*y,axis=-1)/dz
+    return pix_center+u[:,None]*ex+v[:,None]*ey
+
+
+# Radius of the reference sphere of the terminal tables, in km, see tables/readme.md
+table_r0=1735.455
+
+
+def table_foe(mission:int,channel:str,tabs:np.ndarray,M_im1_lat:np.ndarray)->np.ndarray:
+    """
+    Where point 1 of the trajectory table falls in each rectified frame, IE where the
+    focus of expansion should be
+
+    :param mission: Mission number, IE 7=Ranger 7
+    :param channel: Channel, IE A
+    :param tabs: TAB numbers, shape [n]
+    :param M_im1_lat: Matrix which takes lattice coordinates to TAB 1 image coordinates,
+                      which places the reticle marks in every rectified frame
+    :return: (x,y) of point 1 in each frame, shape [n,2]
+
+    Table point 2 is the center reticle mark, at lattice (0,0), which is taken to be on
+    the optical axis. Table point 18 is the right end of the center row, at lattice
+    (2,0). The directions from the spacecraft to the three points then place point 1
+    with project_pinhole().
+    """
+    table=load_table(f"terminal_{mission:1d}{channel.lower()}")
+
+    def at_tabs(name:str)->np.ndarray:
+        return np.interp(tabs,table.TAB,table[name])
+
+    def xyz(lat:np.ndarray,lon:np.ndarray,r:np.ndarray)->np.ndarray:
+        lat,lon=np.radians(lat),np.radians(lon)
+        return np.asarray(r)[...,None]*np.stack((np.cos(lat)*np.cos(lon),np.cos(lat)*np.sin(lon),np.sin(lat)),axis=-1)
+
+    sc=xyz(at_tabs("ssc_lat"),at_tabs("ssc_lon"),table_r0+at_tabs("alt"))
+    p1,p2,p18=[xyz(at_tabs(f"{pt}_lat"),at_tabs(f"{pt}_lon"),table_r0)-sc for pt in ("pt1","pt2","p18")]
+    return project_pinhole(p1,p2,p18,(M_im1_lat@(0,0,1))[0:2],(M_im1_lat@(2,0,1))[0:2])
+
+
+def main():
+    parser=ArgumentParser(description="Measure the block-matching flow between consecutive frames of a frame stack")
+    parser.add_argument("channels",nargs="+",help="Mission and channel to measure, IE 7A 7B 8A 8B")
+    parser.add_argument("--tile",type=int,default=24,help="Square radius of each tile")
+    parser.add_argument("--step",type=int,default=48,help="Distance between tile centers")
+    args=parser.parse_args()
+    for arg in args.channels:
+        mission,channel=int(arg[:-1]),arg[-1]
+        stack=load_stack(mission,channel)
+        flow,fit=stack_flow(stack.frames,tile_r=args.tile,step=args.step)
+        np.savez(f"rect_images/{mission:1d}{channel}/flow.npz",tab=stack.tab,**flow._asdict(),**fit._asdict())
+        try:
+            expected=table_zoom(mission,channel,stack.tab)
+            M_im1_lat=fit_lattice(get_manual_reticle(mission,channel,None),get_lattice(mission,channel)).M_im_lat
+            # Point 1 moves a little between TABs, so compare to where it is halfway
+            foe=table_foe(mission,channel,stack.tab,M_im1_lat)
+            expected_foe=(foe[:-1]+foe[1:])/2
+        except FileNotFoundError:
+            expected=np.full(len(fit.scale),np.nan)
+            expected_foe=np.full((len(fit.scale),2),np.nan)
+        for tab0,tab1,scale,table_scale,(x,y),(table_x,table_y),n_used in zip(
+                stack.tab[:-1],stack.tab[1:],fit.scale,expected,fit.foe,expected_foe,np.sum(fit.inliers,axis=1)):
+            print(f"{mission:1d}{channel}{tab0:03d}-{tab1:03d}: scale {scale:8.5f} (table {table_scale:8.5f}), "
+                  f"focus of expansion ({x:7.1f},{y:7.1f}) (table point 1 ({table_x:7.1f},{table_y:7.1f})) "
+                  f"from {n_used} tiles")
+
+
+if __name__=="__main__":
+    # This is the only process, so let its FFTs use every CPU
+    with set_workers(-1):
+        main()
@@ -0,0 +1,109 @@
+"""
+Piecewise Chebyshev interpolants of smooth functions of time.
+
+This is the same form that the SPICE ephemeris kernels themselves use: the time
+span is cut into segments, and within each segment every component of the
+function is a Chebyshev series in the time scaled to [-1,1]. A smooth function
+(a rotation, or a planet's position over a few days) is fit to near machine
+precision with a dozen or so terms per segment, and evaluating it is a few
+multiply-adds per term, so a whole array of times is done at once with no
+per-time calls back to SPICE.
+
+The fit is by interpolation at the Chebyshev nodes of each segment, so the
+function only needs to be sampled there. Call cheby_sample_times() to get the
+times, sample the function at each of them however is convenient, then hand the
+samples to fit_cheby().
+"""
+from collections import namedtuple
+
+import numpy as np
+from numpy.polynomial import chebyshev
+
+cheby_tuple=namedtuple('cheby_tuple','breaks,coef')
+
+
+def cheby_nodes(degree:int)->np.ndarray:
+    """
+    Chebyshev nodes of the first kind, where a Chebyshev series is interpolated
+
+    :param degree: Degree of the series
+    :return: degree+1 nodes in (-1,1), in increasing order
+    """
+    return -np.cos(np.pi*(np.arange(degree+1)+0.5)/(degree+1))
+
+
+def cheby_sample_times(t0:float,t1:float,*,n_seg:int,degree:int)->tuple[np.ndarray,np.ndarray]:
+    """
+    Times at which to sample a function to fit it
+
+    :param t0: Start of time span
+    :param t1: End of time span
+    :param n_seg: Number of equal segments to cut the span into
+    :param degree: Degree of the series in each segment
+    :return: Tuple of:
+      * Segment boundaries, shape [n_seg+1], from t0 to t1
+      * Sample times, shape [n_seg,degree+1], in increasing order through the whole span
+    """
+    breaks=np.linspace(t0,t1,n_seg+1)
+    mid=(breaks[1:]+breaks[:-1])/2
+    half=(breaks[1:]-breaks[:-1])/2
+    return breaks,mid[:,None]+half[:,None]*cheby_nodes(degree)
+
+
+def fit_cheby(breaks:np.ndarray,values:np.ndarray)->cheby_tuple:
+    """
+    Fit Chebyshev series to samples of a function
+
+    :param breaks: Segment boundaries, from cheby_sample_times()
+    :param values: Function at each of the sample times from cheby_sample_times(), shape
+                   [n_seg,degree+1,...]. The trailing axes are the components of the function,
+                   IE [n_seg,degree+1,3] for a vector.
+    :return: cheby_tuple of:
+      * breaks - Segment boundaries, shape [n_seg+1]
+      * coef - Coefficients of each series, shape [n_seg,degree+1,...]
+    """
+    values=np.asarray(values,dtype=np.float64)
+    degree=values.shape[1]-1
+    V_inv=np.linalg.inv(chebyshev.chebvander(cheby_nodes(degree),degree))
+    return cheby_tuple(breaks=np.asarray(breaks,dtype=np.float64),coef=np.einsum('kj,sj...->sk...',V_inv,values))
+
+
+def eval_cheby(model:cheby_tuple,ts:np.ndarray,*,deriv:int=0)->np.ndarray:
+    """
+    Evaluate a piecewise Chebyshev fit
+
+    :param model: Fit from fit_cheby()
+    :param ts: Times to evaluate at, any shape. Must all be inside the span of the fit.
+    :param deriv: Order of derivative with respect to time to evaluate. 0 is the function itself.
+    :return: Function (or derivative) at each time, shape ts.shape+component shape
+    """
+    ts=np.asarray(ts,dtype=np.float64)
+    breaks,coef=model
+    if np.any(ts<breaks[0]) or np.any(ts>breaks[-1]):
+        raise ValueError(f"Times must be within the span of the fit, {breaks[0]} to {breaks[-1]}")
+    seg=np.clip(np.searchsorted(breaks,ts.ravel(),side='right')-1,0,len(breaks)-2)
+    half=(breaks[seg+1]-breaks[seg])/2
+    x=(ts.ravel()-(breaks[seg]+half))/half
+    if deriv>0:
+        coef=chebyshev.chebder(coef,m=deriv,axis=1)
+    degree=coef.shape[1]-1
+    result=np.einsum('nk,nk...->n...',chebyshev.chebvander(x,degree),coef[seg])
+    # Chain rule through the scaling of time to x in each segment
+    result/=(half**deriv).reshape((-1,)+(1,)*(result.ndim-1))
+    return result.reshape(ts.shape+coef.shape[2:])
+
+
+def cheby_check_times(model:cheby_tuple,n_per_seg:int=None)->np.ndarray:
+    """
+    Times to check a fit against the function it was fit to
+
+    :param model: Fit from fit_cheby()
+    :param n_per_seg: Number of check times in each segment. Default is one more than
+                      the number of terms, so the check times fall between the nodes.
+    :return: Check times, shape [n_seg*n_per_seg], spread evenly through each segment
+    """
+    breaks=model.breaks
+    if n_per_seg is None:
+        n_per_seg=model.coef.shape[1]+1
+    frac=(np.arange(n_per_seg)+0.5)/n_per_seg
+    return (breaks[:-1,None]+(breaks[1:]-breaks[:-1])[:,None]*frac).ravel()
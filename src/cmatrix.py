@@ -10,6 +10,8 @@ from kwanmath.geodesy import llr2xyz, xyz2llr
 from kwanmath.vector import vnormalize, vcomp, vcross, vdot, vlength
 from numpy.linalg import inv
 
+from tables import load_table
+
 moon_r0=1735.455 # distance from Moon center of mass to Ranger 7 impact point, km
 r7_timp=datetime(year=1964,month=7,day=31,hour=13,minute=25,second=48,microsecond=799000,tzinfo=timezone.utc)
 
@@ -173,25 +175,19 @@ def lvlh_to_xyz(*,r:np.ndarray, spd:float, fpa:float, az:float, deg:bool=True):
 
 
 def main():
-    points={}
-    with open("tables/camera_7a_reticle.csv") as inf:
-        header=inf.readline().strip().split(",")
-        for line in inf:
-            parts=line.strip().split(",")
-            i_point=int(parts[0].strip())
-            points[i_point]=ReticlePoint(line=line)
-    trajectory={}
-    with open("tables/trajectory_7a.csv") as inf:
-        header=inf.readline().strip().split(",")
-        for line in inf:
-            parts=line.strip().split(",")
-            i_tab=int(parts[0].strip())
-            trajectory[i_tab]=TrajectoryPoint(line=line)
+    points={row.pt:ReticlePoint(lat=row.lat,lon=row.lon,srange=row.srange)
+            for row in load_table("camera_7a_reticle")}
+    trajectory={row.TAB:TrajectoryPoint(timp=row.Timp,alt=row.alt,ssc_lat=row.ssc_lat,ssc_lon=row.ssc_lon,
+                                         spd=row.v,fpa=row.pth,az=row.az,
+                                         reticle={1:ReticlePoint(lat=row.pt1_lat,lon=row.pt1_lon,srange=row.pt1_srange),
+                                                  2:ReticlePoint(lat=row.pt2_lat,lon=row.pt2_lon,srange=row.pt2_srange),
+                                                  18:ReticlePoint(lat=row.p18_lat,lon=row.p18_lon,srange=row.p18_srange)})
+                for row in load_table("terminal_7a")}
     # TAB number of camera7A reticle table
     tab_complete=143
     traj_complete=trajectory[143]
     # Position of spacecraft in Moon body-fixed frame
-    rsc=tab143.r()
+    rsc=traj_complete.r()
     # Position of reticles in same frame
     v_ret={}
     for i_pt, pt in points.items():
@@ -202,7 +198,7 @@ def main():
     # If the spacecraft is not rotating, then the images will appear to expand around
     # this point. The following code verifies that the velocity vector given in the table
     # does in fact intersect the ground
-    v_xyz = lvlh_to_xyz(r=rsc,spd=tab143.spd,fpa=tab143.fpa,az=tab143.az,deg=True)
+    v_xyz = lvlh_to_xyz(r=rsc,spd=traj_complete.spd,fpa=traj_complete.fpa,az=traj_complete.az,deg=True)
     rsurf_xyz_a=ray_sphere_intersect(rsc,v_xyz)
     rsurf_xyz_b=points[1].r()
     lon_a,lat_a,r_a=xyz2llr(rsurf_xyz_a,deg=True)
@@ -1,5 +1,9 @@
+from collections import namedtuple
+
 import numpy as np
 import scipy
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.fft import rfft2, irfft2, next_fast_len
 
 def cross_image(im:np.array, im_ref:np.array)->np.array:
     """
@@ -33,7 +37,8 @@ def cross_image(im:np.array, im_ref:np.array)->np.array:
     return scipy.signal.fftconvolve(im-np.mean(im), im_ref[::-1,::-1]-np.mean(im_ref), mode='same')
 
 
-def img_offset(im:np.array=None,im_ref:np.array=None,cross:np.array=None,bbox_r:int=None)->np.array:
+def img_offset(im:np.array=None,im_ref:np.array=None,cross:np.array=None,bbox_r:int=None,
+               subpixel:bool=False,confidence:bool=False)->np.ndarray|tuple[np.ndarray,float]:
     """
     Calculate the image offset between two images. If a rolled copy of a reference image
     is compared to the reference, the offset should exactly equal the roll. This is calculated
@@ -43,11 +48,14 @@ def img_offset(im:np.array=None,im_ref:np.array=None,cross:np.array=None,bbox_r:
     :param im:
     :param im_ref:
     :param cross: Optional pre-calculated cross-correlation, should equal cross_image(im,im_ref)
+    :param subpixel: If True, refine the peak to a fraction of a pixel, see subpixel_peaks()
+    :param confidence: If True, also return the peak-to-sidelobe ratio of the peak, see
+                       peak_to_sidelobe()
     :return: 2D vector offset -- first element is vertical offset, where positive means that
              the rolled image is above the reference. Second element is horizontal offset, where
              positive means that the rolled image is to the right of the reference. If you use
              the result as the argument of np.roll(), it will roll the reference image onto the
-             rolled image.
+             rolled image. If confidence is set, a tuple of this and the peak-to-sidelobe ratio.
 
     example:
     img=...
@@ -57,6 +65,11 @@ def img_offset(im:np.array=None,im_ref:np.array=None,cross:np.array=None,bbox_r:
     """
     if cross is None:
         cross=cross_image(im,im_ref)
+    if subpixel or confidence:
+        result=img_offsets(cross[None,...],bbox_r=bbox_r,subpixel=subpixel,confidence=confidence)
+        if confidence:
+            return result[0][0],result[1][0]
+        return result[0]
     if bbox_r is not None:
         cross_rx=cross.shape[1]//2
         cross_ry=cross.shape[0]//2
@@ -65,3 +78,435 @@ def img_offset(im:np.array=None,im_ref:np.array=None,cross:np.array=None,bbox_r:
     return offset
 
 
+
+
+template_tuple=namedtuple('template_tuple','spectra,fshape,im_shape,ref_shape,energy')
+
+
+def prepare_templates(im_refs:np.ndarray,im_shape:tuple[int,int],*,workers:int=None)->template_tuple:
+    """
+    Precompute the Fourier transforms of a set of reference images, so that many
+    images can be correlated against them with cross_images() without transforming
+    the references again.
+
+    :param im_refs: Stack of reference images, shape [n,rows,cols]
+    :param im_shape: Shape (rows,cols) of the images which will be compared against
+                     these references. Does not need to be the same as the reference
+                     shape.
+    :param workers: Number of threads for the FFT, passed to scipy.fft. Default is the
+                    scipy.fft default, which is one thread unless raised with
+                    scipy.fft.set_workers(). Callers that already run one process or
+                    thread per CPU should leave it at one, so as not to oversubscribe
+                    the CPUs.
+    :return: template_tuple to pass to cross_images()
+
+    The references are flipped and have their mean subtracted here, exactly as
+    cross_image() does, and are padded to a fast FFT size big enough that the
+    circular convolution equals the linear convolution. The sum of squares of each
+    mean-subtracted reference is kept too, for normalized correlation.
+    """
+    im_refs=np.asarray(im_refs,dtype=np.float64)
+    ref_shape=im_refs.shape[1:]
+    fshape=tuple(next_fast_len(s+t-1,real=True) for s,t in zip(im_shape,ref_shape))
+    kernels=im_refs[:,::-1,::-1]-np.mean(im_refs,axis=(1,2),keepdims=True)
+    spectra=rfft2(kernels,s=fshape,workers=workers)
+    return template_tuple(spectra=spectra,fshape=fshape,im_shape=tuple(im_shape),ref_shape=ref_shape,
+                          energy=np.sum(kernels**2,axis=(1,2)))
+
+
+def window_sums(ims:np.ndarray,ref_shape:tuple[int,int])->np.ndarray:
+    """
+    Sum of each image under a reference-sized window, at every offset of the correlation
+
+    :param ims: Stack of images, shape [n,rows,cols]
+    :param ref_shape: Shape (rows,cols) of the reference the images are correlated against
+    :return: Stack of sums, shape [n,rows,cols]. Element [i,y,x] is the sum of the window
+             of ims[i] under the reference at the offset of element [i,y,x] of the
+             cross-correlation from cross_images(). Outside the image counts as zero,
+             the same as it does in the correlation.
+
+    The window is a box, so the sum is done one axis at a time, each as the difference
+    of two elements of a cumulative sum. This costs a few operations per pixel no matter
+    how big the reference, and only the axis being summed is padded each time.
+    """
+    ref_rows,ref_cols=ref_shape
+    n,rows,cols=ims.shape
+    # The window for output pixel [y,x] covers image rows y-ref_rows+1+row0 to y+row0,
+    # where row0 is the same crop offset that cross_images() uses. Pad one more zero on
+    # the top, so that the window of output pixel [y,x] is the difference of
+    # cumulative sums [y+ref_rows] and [y].
+    row0=(ref_rows-1)//2
+    col0=(ref_cols-1)//2
+    table=np.cumsum(np.pad(ims,((0,0),(ref_rows-row0,row0),(0,0))),axis=1)
+    sums=table[:,ref_rows:ref_rows+rows,:]-table[:,0:rows,:]
+    table=np.cumsum(np.pad(sums,((0,0),(0,0),(ref_cols-col0,col0))),axis=2)
+    return table[:,:,ref_cols:ref_cols+cols]-table[:,:,0:cols]
+
+
+def local_energy(ims:np.ndarray,ref_shape:tuple[int,int])->np.ndarray:
+    """
+    Sum of squared deviations from the mean of each image under a reference-sized
+    window, at every offset of the correlation
+
+    :param ims: Stack of images, shape [n,rows,cols], already with their mean subtracted
+                the same way cross_images() does
+    :param ref_shape: Shape (rows,cols) of the reference the images are correlated against
+    :return: Stack of energies, shape [n,rows,cols], indexed the same way as window_sums()
+
+    Both the sum and the sum of squares under every window come from window_sums().
+    """
+    s1=window_sums(ims,ref_shape)
+    s2=window_sums(ims**2,ref_shape)
+    return np.maximum(s2-s1**2/(ref_shape[0]*ref_shape[1]),0.0)
+
+
+def _normalize(crosses:np.ndarray,energy:np.ndarray,ref_energy:np.ndarray)->np.ndarray:
+    """
+    Turn correlations into normalized correlations, between -1 and 1. Where either
+    the window or the reference is flat, the result is zero.
+    """
+    denom=np.sqrt(energy*ref_energy.reshape(-1,1,1))
+    # Anything below roundoff of the image energy counts as flat
+    flat=denom<=1e-9*np.max(denom,axis=(-2,-1),keepdims=True)
+    return np.where(flat,0.0,crosses/np.where(flat,1.0,denom))
+
+
+def cross_images(ims:np.ndarray,templates:template_tuple,*,normalized:bool=False,workers:int=None)->np.ndarray:
+    """
+    Batched version of cross_image(). Cross-correlate each image in a stack against
+    the matching precomputed reference, in one multi-threaded FFT call.
+
+    :param ims: Stack of images, shape [n,rows,cols]. Image i is correlated against
+                reference i. (rows,cols) must match the im_shape the templates were
+                prepared for, and n must not be more than the number of references.
+                May also be a single image, shape [rows,cols], which is then transformed
+                once and correlated against every reference.
+    :param templates: Precomputed reference transforms from prepare_templates()
+    :param normalized: If True, return the normalized cross-correlation instead, see below
+    :param workers: Number of threads for the FFT, passed to scipy.fft
+    :return: Stack of cross-correlation images, shape [n,rows,cols]. Each one is
+             equal to cross_image(ims[i],im_refs[i]) to within roundoff. For a
+             single image, there is one for each reference.
+
+    The plain correlation is bigger wherever the image is brighter or more contrasty,
+    whether or not it looks like the reference. The normalized correlation divides
+    each element by the RMS deviation of the image window under the reference, and
+    of the reference itself, so it is 1 for a window which is an exact copy of the
+    reference at any brightness and contrast, and 0 for one unrelated to it. The
+    window statistics come from local_energy(), computed once for each image and
+    shared by every reference that image is correlated against.
+    """
+    ims=np.asarray(ims,dtype=np.float64)
+    if ims.ndim==2:
+        ims=ims[None,...]
+        spectra=templates.spectra
+    else:
+        spectra=templates.spectra[:ims.shape[0]]
+    ims=ims-np.mean(ims,axis=(1,2),keepdims=True)
+    full=irfft2(rfft2(ims,s=templates.fshape,workers=workers)*spectra,
+                s=templates.fshape,workers=workers)
+    # Crop the center out the same way as fftconvolve(mode='same'). The full linear
+    # convolution starts at the top left of the padded array and is im+ref-1 in size.
+    (rows,cols),(ref_rows,ref_cols)=templates.im_shape,templates.ref_shape
+    row0=(ref_rows-1)//2
+    col0=(ref_cols-1)//2
+    crosses=full[:,row0:row0+rows,col0:col0+cols]
+    if normalized:
+        crosses=_normalize(crosses,local_energy(ims,templates.ref_shape),templates.energy[:len(crosses)])
+    return crosses
+
+
+def phase_crosses(ims:np.ndarray,im_refs:np.ndarray,*,peak_sigma:float=None,workers:int=None)->np.ndarray:
+    """
+    Batched phase correlation of each image in a stack against its reference
+
+    :param ims: Stack of images, shape [n,rows,cols]
+    :param im_refs: Stack of reference images, same shape as ims
+    :param peak_sigma: If set, widen the peak into a Gaussian of this standard deviation,
+                       in pixels. A bare phase correlation peak is nearly a single pixel,
+                       which subpixel_peaks() can't locate between pixels, while a peak
+                       a pixel or two wide can be located to a small fraction of a pixel.
+    :param workers: Number of threads for the FFT, passed to scipy.fft
+    :return: Stack of phase correlation images, shape [n,rows,cols], laid out like
+             cross_images() so that img_offsets() reads the offsets off the same way.
+
+    Phase correlation throws away the amplitude of the cross-power spectrum, keeping
+    only its phase, so every spatial frequency gets an equal vote. The peak is then
+    a sharp spike even for smooth images, which is what is wanted for matching whole
+    frames rather than a small mark against a template. The correlation is circular,
+    so the images should be windowed down to zero at their edges first.
+    """
+    ims=np.asarray(ims,dtype=np.float64)
+    im_refs=np.asarray(im_refs,dtype=np.float64)
+    rows,cols=ims.shape[1:]
+    cross_power=rfft2(ims,workers=workers)*np.conj(rfft2(im_refs,workers=workers))
+    # Floor the magnitude relative to each pair's own spectrum, so that one pair doesn't
+    # set the floor for the others, and a blank pair gives zero rather than 0/0
+    magnitude=np.abs(cross_power)
+    cross_power/=magnitude+1e-12*np.max(magnitude,axis=(1,2),keepdims=True)+np.finfo(np.float64).tiny
+    if peak_sigma is not None:
+        fy=np.fft.fftfreq(rows)[:,None]
+        fx=np.fft.rfftfreq(cols)[None,:]
+        cross_power*=np.exp(-2*(np.pi*peak_sigma)**2*(fy**2+fx**2))
+    # Zero offset goes from the top left corner to the center, where img_offsets() expects it
+    return np.fft.fftshift(irfft2(cross_power,s=(rows,cols),workers=workers),axes=(1,2))
+
+
+def img_offsets(crosses:np.ndarray,bbox_r:int=None,*,subpixel:bool=False,
+                confidence:bool=False)->np.ndarray|tuple[np.ndarray,np.ndarray]:
+    """
+    Batched version of img_offset(), given a stack of precomputed cross-correlations
+
+    :param crosses: Stack of cross-correlation images, shape [n,rows,cols], IE from cross_images()
+    :param bbox_r: If set, only look for the peak within this square radius of the center
+    :param subpixel: If True, refine each peak to a fraction of a pixel, see subpixel_peaks()
+    :param confidence: If True, also return the peak-to-sidelobe ratio of each peak
+    :return: Array of offsets, shape [n,2]. Row i is the same as img_offset(cross=crosses[i],bbox_r=bbox_r).
+             Integer unless subpixel is set. If confidence is set, a tuple of this and
+             an array of peak-to-sidelobe ratios, shape [n].
+    """
+    n,rows,cols=crosses.shape
+    center=np.array((rows,cols))//2
+    search=crosses
+    corner=np.zeros(2,dtype=int)
+    if bbox_r is not None:
+        corner=center-bbox_r
+        search=crosses[:,corner[0]:corner[0]+2*bbox_r,corner[1]:corner[1]+2*bbox_r]
+    i_peak=search.reshape(n,-1).argmax(axis=1)
+    peaks=np.stack(np.unravel_index(i_peak,search.shape[1:]),axis=1)+corner
+    offsets=subpixel_peaks(crosses,peaks)-center if subpixel else peaks-center
+    if confidence:
+        return offsets,peak_to_sidelobe(crosses,peaks)
+    return offsets
+
+
+def peak_to_sidelobe(crosses:np.ndarray,peaks:np.ndarray,exclude_r:int=5)->np.ndarray:
+    """
+    Measure how clearly each correlation peak stands out
+
+    :param crosses: Stack of cross-correlation images, shape [n,rows,cols]
+    :param peaks: Integer (row,col) of the peak in each image, shape [n,2]
+    :param exclude_r: Square radius around the peak which counts as the peak itself
+    :return: Peak-to-sidelobe ratio of each peak, shape [n]
+
+    The sidelobe is everything in the correlation image except the square around the
+    peak. The ratio is how many standard deviations of the sidelobe the peak is above
+    the mean of the sidelobe. A clean match of a reticle mark is around 8 or more,
+    while a box with no mark in it, or a mark mostly outside the box, is around 2 or less.
+    The sidelobe is taken from the whole correlation image rather than just the part
+    searched for the peak, so that a small search window still gives a fair measure.
+    """
+    n,rows,cols=crosses.shape
+    rr=np.arange(rows)[None,:,None]
+    cc=np.arange(cols)[None,None,:]
+    sidelobe=(np.abs(rr-peaks[:,0,None,None])>exclude_r)|(np.abs(cc-peaks[:,1,None,None])>exclude_r)
+    count=np.sum(sidelobe,axis=(1,2))
+    mean=np.sum(crosses*sidelobe,axis=(1,2))/count
+    var=np.sum(((crosses-mean[:,None,None])*sidelobe)**2,axis=(1,2))/count
+    peak=crosses[np.arange(n),peaks[:,0],peaks[:,1]]
+    return (peak-mean)/np.where(var>0,np.sqrt(var),np.inf)
+
+
+def subpixel_peaks(crosses:np.ndarray,peaks:np.ndarray)->np.ndarray:
+    """
+    Refine integer correlation peaks to a fraction of a pixel
+
+    :param crosses: Stack of cross-correlation images, shape [n,rows,cols]
+    :param peaks: Integer (row,col) of the peak in each image, shape [n,2]
+    :return: Refined (row,col) of each peak, shape [n,2]
+
+    A parabola is fit through the peak and its neighbor on either side, separately
+    in each direction, and the peak moves to the vertex of the parabola. The
+    correction is limited to half a pixel, and is zero where the peak is on the
+    edge of the image or the parabola doesn't open downward.
+    """
+    n,rows,cols=crosses.shape
+    i=np.arange(n)
+    result=peaks.astype(np.float64)
+    for axis,size in ((0,rows),(1,cols)):
+        lo=peaks.copy()
+        hi=peaks.copy()
+        lo[:,axis]-=1
+        hi[:,axis]+=1
+        inside=(lo[:,axis]>=0)&(hi[:,axis]<size)
+        lo[:,axis]=np.clip(lo[:,axis],0,size-1)
+        hi[:,axis]=np.clip(hi[:,axis],0,size-1)
+        c0=crosses[i,peaks[:,0],peaks[:,1]]
+        cm=crosses[i,lo[:,0],lo[:,1]]
+        cp=crosses[i,hi[:,0],hi[:,1]]
+        curvature=cm-2*c0+cp
+        ok=inside&(curvature<0)
+        delta=np.where(ok,(cm-cp)/(2*np.where(ok,curvature,-1)),0.0)
+        result[:,axis]+=np.clip(delta,-0.5,0.5)
+    return result
+
+
+def downsample2(ims:np.ndarray)->np.ndarray:
+    """
+    Shrink a stack of images by a factor of two, by averaging each 2x2 block
+
+    :param ims: Images, shape [...,rows,cols]. An odd last row or column is dropped.
+    :return: Images, shape [...,rows//2,cols//2]
+    """
+    rows,cols=(ims.shape[-2]//2)*2,(ims.shape[-1]//2)*2
+    ims=ims[...,:rows,:cols]
+    return (ims[...,0::2,0::2]+ims[...,1::2,0::2]+ims[...,0::2,1::2]+ims[...,1::2,1::2])/4
+
+
+def local_crosses(ims:np.ndarray,im_refs:np.ndarray,centers:np.ndarray,r:int,*,
+                  normalized:bool=False)->np.ndarray:
+    """
+    Evaluate the cross-correlation of each image against its reference only in a small
+    window of offsets, directly rather than by FFT.
+
+    :param ims: Stack of images, shape [n,rows,cols]
+    :param im_refs: Stack of reference images, same shape as ims
+    :param centers: Integer offset (row,col) at the center of each window, shape [n,2]
+    :param r: Square radius of the windows
+    :param normalized: If True, evaluate the normalized cross-correlation, the same as
+                       cross_images() with normalized=True
+    :return: Stack of correlation windows, shape [n,2r+1,2r+1]. Element [i,r+dy,r+dx] is
+             the same as cross_image(ims[i],im_refs[i]) at offset centers[i]+(dy,dx).
+    """
+    ims=np.asarray(ims,dtype=np.float64)
+    im_refs=np.asarray(im_refs,dtype=np.float64)
+    n,rows,cols=ims.shape
+    ims=ims-np.mean(ims,axis=(1,2),keepdims=True)
+    im_refs=im_refs-np.mean(im_refs,axis=(1,2),keepdims=True)
+    pad=int(np.max(np.abs(centers)))+r
+    padded=np.pad(im_refs,((0,0),(pad,pad),(pad,pad)))
+    result=np.zeros((n,2*r+1,2*r+1))
+    for i in range(n):
+        # The correlation at offset d is the sum of im[x]*im_ref[x-d], so the largest
+        # offset in the window uses the slice of the padded reference furthest up and left.
+        y0=pad-centers[i,0]-r
+        x0=pad-centers[i,1]-r
+        views=sliding_window_view(padded[i,y0:y0+rows+2*r,x0:x0+cols+2*r],(rows,cols))
+        result[i]=np.einsum('ijhw,hw->ij',views,ims[i])[::-1,::-1]
+    if normalized:
+        # Pick the window energies at these offsets out of the full map, which is
+        # indexed the same way as the full correlation
+        energy=local_energy(ims,(rows,cols))
+        dy,dx=np.mgrid[-r:r+1,-r:r+1]
+        ys=np.clip(centers[:,0,None,None]+dy+rows//2,0,rows-1)
+        xs=np.clip(centers[:,1,None,None]+dx+cols//2,0,cols-1)
+        result=_normalize(result,energy[np.arange(n)[:,None,None],ys,xs],np.sum(im_refs**2,axis=(1,2)))
+    return result
+
+
+def pyramid_templates(im_refs:np.ndarray,im_shape:tuple[int,int],*,levels:int,workers:int=None)->template_tuple:
+    """
+    Prepare a set of references for the coarse search of pyramid_offsets(), so that
+    references which are used over and over are only shrunk and transformed once.
+
+    :param im_refs: Stack of reference images at full resolution, shape [n,rows,cols]
+    :param im_shape: Shape (rows,cols) of the full resolution images which will be
+                     compared against these references
+    :param levels: Number of halvings, the same as will be passed to pyramid_offsets()
+    :param workers: Number of threads for the FFT, passed to scipy.fft
+    :return: template_tuple to pass to pyramid_offsets() as coarse_templates
+    """
+    im_refs=np.asarray(im_refs,dtype=np.float64)
+    rows,cols=im_shape
+    for _ in range(levels):
+        im_refs=downsample2(im_refs)
+        rows,cols=rows//2,cols//2
+    return prepare_templates(im_refs,(rows,cols),workers=workers)
+
+
+# Peak-to-sidelobe ratio measured on the coarse correlation of pyramid_offsets(), as a
+# fraction of the ratio of the same peak measured at full resolution, indexed by levels.
+# Shrinking blurs the mark into its background, so the coarse peak stands out a bit
+# less. Measured on the synthetic reticle masks in boxes of radius 50, with noise, where
+# the coarse ratio held to this fraction of a threshold of 4 makes the same decision as
+# the full resolution ratio held to 4 on about 98% (1 level) and 97% (2 levels) of boxes.
+pyramid_psr_scale=(1.0,0.95,0.875)
+
+
+def pyramid_offsets(ims:np.ndarray,im_refs:np.ndarray,*,bbox_r:int,levels:int=2,refine_r:int=2,
+                    subpixel:bool=True,confidence:bool=False,normalized:bool=False,
+                    coarse_templates:template_tuple=None,
+                    workers:int=None)->np.ndarray|tuple[np.ndarray,np.ndarray]:
+    """
+    Find the offset of each image from its reference, coarse to fine.
+
+    :param ims: Stack of images, shape [n,rows,cols]
+    :param im_refs: Stack of reference images, same shape as ims
+    :param bbox_r: Look for offsets within this square radius, at full resolution. The
+                   offsets at every level are kept inside it, so the result is in the
+                   same range as img_offsets() with this bbox_r.
+    :param levels: Number of times to halve the images before the coarse search. This
+                   and refine_r are the cost/accuracy knob: each level cuts the cost of
+                   the coarse search by about 16 (4 times fewer pixels, 4 times fewer
+                   offsets), but throws away fine detail, so the coarse offset can be
+                   further off. The confidence comes from the coarse search too, so it
+                   costs nothing extra. 0 is a plain full-resolution search.
+    :param refine_r: Square radius of the window of offsets checked around the
+                     prediction from the level above, at each finer level. Bigger is more
+                     forgiving of a poor coarse offset, and costs more.
+    :param subpixel: If True, refine the final peak to a fraction of a pixel
+    :param confidence: If True, also return the peak-to-sidelobe ratio of each peak. This
+                       is measured on the coarse correlation image, with the square
+                       around the peak shrunk to match, and divided by
+                       pyramid_psr_scale[levels], so that it can be held to the same
+                       threshold as a plain search. Levels past the end of
+                       pyramid_psr_scale use its last entry.
+    :param normalized: If True, use the normalized cross-correlation at every level, see
+                       cross_images()
+    :param coarse_templates: The references already prepared for the coarse search by
+                             pyramid_templates(), with the same levels. Default prepares
+                             them here, on every call.
+    :param workers: Number of threads for the FFTs
+    :return: Array of offsets, shape [n,2], in the same sense as img_offsets(). If
+             confidence is set, a tuple of this and the peak-to-sidelobe ratios.
+
+    The coarsest level is searched over the whole range with one batched FFT
+    correlation, using cross_images() and img_offsets(). Each finer level doubles the
+    offset from the level above and searches only a small window around it, with
+    local_crosses(), which is cheap because the window is small. The offsets are
+    differences between positions, so they double exactly between levels.
+    """
+    ims=np.asarray(ims,dtype=np.float64)
+    im_refs=np.asarray(im_refs,dtype=np.float64)
+    pyramid=[(ims,im_refs)]
+    for _ in range(levels):
+        pyramid.append((downsample2(pyramid[-1][0]),downsample2(pyramid[-1][1])))
+    coarse_ims,coarse_refs=pyramid[-1]
+    coarse_r=max(1,-(-bbox_r//2**levels))
+    if coarse_templates is None:
+        coarse_templates=prepare_templates(coarse_refs,coarse_ims.shape[1:],workers=workers)
+    crosses=cross_images(coarse_ims,coarse_templates,normalized=normalized,workers=workers)
+    center=np.array(crosses.shape[1:])//2
+    offsets=img_offsets(crosses,bbox_r=coarse_r)
+    if confidence:
+        psr=(peak_to_sidelobe(crosses,offsets+center,exclude_r=max(1,-(-5//2**levels)))
+             /pyramid_psr_scale[min(levels,len(pyramid_psr_scale)-1)])
+    if subpixel and levels==0:
+        offsets=subpixel_peaks(crosses,offsets+center)-center
+    for level in range(levels-1,-1,-1):
+        level_ims,level_refs=pyramid[level]
+        # Offsets at this level are searched for from -r to r-1, like img_offsets()
+        r=max(1,-(-bbox_r//2**level))
+        centers=np.clip(2*offsets,-r,r-1)
+        window=local_crosses(level_ims,level_refs,centers,refine_r,normalized=normalized)
+        offsets=np.clip(img_offsets(window)+centers,-r,r-1)
+        if subpixel and level==0:
+            offsets=subpixel_peaks(window,offsets-centers+refine_r)-refine_r+centers
+    if confidence:
+        return offsets,psr
+    return offsets
+
+
+def pyramid_offset(im:np.ndarray,im_ref:np.ndarray,**kwargs)->np.ndarray:
+    """
+    Single-image version of pyramid_offsets(). Takes the same keyword arguments.
+
+    :param im: Image
+    :param im_ref: Reference image, same shape as im
+    :return: 2D vector offset, in the same sense as img_offset(). If confidence is set,
+             a tuple of this and the peak-to-sidelobe ratio.
+    """
+    result=pyramid_offsets(im[None,...],im_ref[None,...],**kwargs)
+    if kwargs.get("confidence",False):
+        return result[0][0],result[1][0]
+    return result[0]
@@ -0,0 +1,191 @@
+"""
+Higher-order model of the vidicon scan distortion, fit to all of the reticle marks.
+
+calc_M_im_lat() and fit_lattice() fit an affine matrix, which is exact for a
+camera that is only shifted, rotated, and scaled. The vidicon scan is not that
+camera. Its deflection depends on how bright the image is (see the readme), so the
+marks of a frame are pushed around a little differently in each part of the
+frame, and the affine fit leaves a residual at the marks that no matrix can take
+out. Here we fit a smooth warp instead, from lattice coordinates to image
+coordinates, which bends to pass (nearly) through every mark:
+
+* poly -- A polynomial in the lattice coordinates, IE for order 2
+  x=c0+c1*u+c2*v+c3*u**2+c4*u*v+c5*v**2, and the same form for y. Order 1 is the
+  affine fit.
+* tps -- A thin-plate spline, which is an affine part plus a radial kernel
+  centered on each mark. With no smoothing it passes exactly through every mark,
+  and it bends as little as possible between them.
+
+Unlike an affine matrix, the warp can't be applied to a whole image by working out
+each pixel's source from a few numbers on the fly. Instead, we compute a warp map,
+which holds the source (x,y) in the scaled image imn of every pixel of the output.
+This is done once per frame and kept in the frame cache, and then warp.remap()
+gathers the pixels a block of rows at a time. The map is in imn coordinates, so
+the same map serves any resolution of the raw image: remap() folds in the
+matrix which takes imn to whatever image is being sampled, the same way that
+the reticle search folds M_imn_red into the resampling of its boxes.
+"""
+import hashlib
+from collections import namedtuple
+
+import numpy as np
+
+from frame_cache import cached_array, default_cache_dir, default_max_bytes
+from warp import default_block_rows
+
+distortion_tuple=namedtuple('distortion_tuple','kind,order,coef,knots')
+
+
+def _n_terms(order:int)->int:
+    return (order+1)*(order+2)//2
+
+
+def _poly_terms(points:np.ndarray,order:int)->np.ndarray:
+    """
+    Every monomial of the coordinates up to a total degree
+
+    :param points: (u,v) coordinates, shape [...,2]
+    :param order: Highest total degree
+    :return: Monomials, shape [...,_n_terms(order)], in the order 1,u,v,u**2,u*v,v**2,u**3...
+    """
+    u,v=points[...,0],points[...,1]
+    return np.stack([u**(d-j)*v**j for d in range(order+1) for j in range(d+1)],axis=-1)
+
+
+def _tps_kernel(points:np.ndarray,knots:np.ndarray)->np.ndarray:
+    """
+    Thin-plate spline radial kernel r**2*log(r) between each point and each knot
+
+    :param points: (u,v) coordinates, shape [...,2]
+    :param knots: (u,v) coordinates of the knots, shape [n,2]
+    :return: Kernel values, shape [...,n]
+    """
+    r2=np.sum((points[...,None,:]-knots)**2,axis=-1)
+    # r**2*log(r)=r2*log(r2)/2, which goes to zero at r=0
+    return 0.5*r2*np.log(np.where(r2>0,r2,1.0))
+
+
+def fit_distortion(reticle_points:np.ndarray,lattice:np.ndarray,*,inliers:np.ndarray=None,
+                   kind:str="poly",order:int=3,smoothing:float=0.0)->distortion_tuple:
+    """
+    Fit a distortion model which takes lattice coordinates to image coordinates
+
+    :param reticle_points: Image coordinates of the reticle marks, shape [n,2]. Points
+                           which are NaN (not found) are ignored.
+    :param lattice: Lattice coordinates of each mark, shape [n,2], IE from get_lattice()
+    :param inliers: True for each mark to use, IE from fit_lattice(). Default uses every
+                    mark which was found. Marks which were rejected from the affine fit
+                    shouldn't be trusted to bend the warp either.
+    :param kind: Either "poly" or "tps", see above
+    :param order: Highest total degree of the polynomial. If there aren't more marks than
+                  the polynomial has coefficients, the order is lowered until there are.
+                  Not used for "tps".
+    :param smoothing: For "tps", how much to trade passing through every mark for a
+                      smoother warp, in square pixels. Zero passes exactly through the marks.
+    :return: distortion_tuple of:
+      * kind - "poly" or "tps"
+      * order - Order of the polynomial actually used. For "tps", 1, the order of its
+                polynomial (affine) part
+      * coef - Coefficients, shape [n_coef,2], for x and y. For "poly", one for each
+               monomial. For "tps", one for each knot, then the three affine ones.
+      * knots - For "tps", lattice coordinates of the marks used, shape [n_used,2]. For
+                "poly", empty.
+    :raises ValueError: if fewer than 3 marks are used, or they are all in a line, which
+                        is too few for even the affine part
+    """
+    points=np.asarray(reticle_points,dtype=np.float64)
+    lattice=np.asarray(lattice,dtype=np.float64)
+    used=np.all(np.isfinite(points),axis=-1)
+    if inliers is not None:
+        used&=inliers
+    points,knots=points[used],lattice[used]
+    n_used=len(points)
+    # Even the affine part needs three marks which aren't all in a line
+    if n_used<_n_terms(1) or np.linalg.matrix_rank(_poly_terms(knots,1))<_n_terms(1):
+        raise ValueError(f"Too few marks to fit a distortion model, {n_used} used")
+    if kind=="poly":
+        while order>1 and _n_terms(order)>=n_used:
+            order-=1
+        coef,*_=np.linalg.lstsq(_poly_terms(knots,order),points,rcond=None)
+        return distortion_tuple(kind=kind,order=order,coef=coef,knots=np.zeros((0,2)))
+    if kind=="tps":
+        # Solve the usual bordered system
+        # [K+s*I P][w]=[points]
+        # [P^T   0][a] [0     ]
+        # where the second row keeps the kernel part from having any affine component.
+        P=_poly_terms(knots,1)
+        A=np.zeros((n_used+3,n_used+3))
+        A[:n_used,:n_used]=_tps_kernel(knots,knots)+smoothing*np.eye(n_used)
+        A[:n_used,n_used:]=P
+        A[n_used:,:n_used]=P.T
+        b=np.zeros((n_used+3,2))
+        b[:n_used]=points
+        return distortion_tuple(kind=kind,order=1,coef=np.linalg.solve(A,b),knots=knots)
+    raise ValueError(f"Unknown distortion model {kind}")
+
+
+def apply_distortion(model:distortion_tuple,lattice_points:np.ndarray)->np.ndarray:
+    """
+    Transform lattice coordinates to image coordinates with a distortion model
+
+    :param model: Model from fit_distortion()
+    :param lattice_points: (u,v) lattice coordinates, shape [...,2]
+    :return: (x,y) image coordinates, shape [...,2]
+    """
+    lattice_points=np.asarray(lattice_points,dtype=np.float64)
+    if model.kind=="poly":
+        return _poly_terms(lattice_points,model.order)@model.coef
+    n_knots=len(model.knots)
+    return (_tps_kernel(lattice_points,model.knots)@model.coef[:n_knots]
+            +_poly_terms(lattice_points,1)@model.coef[n_knots:])
+
+
+def warp_map(model:distortion_tuple,M_lat_out:np.ndarray,output_shape:tuple[int,int],*,
+             block_rows:int=None)->np.ndarray:
+    """
+    Compute where each pixel of an output image comes from in the distorted image
+
+    :param model: Model from fit_distortion(), taking lattice coordinates to image coordinates
+    :param M_lat_out: Matrix which transforms a coordinate in the output image to lattice
+                      coordinates, IE inv(M_im1_lat) to rectify into the space of TAB 1
+    :param output_shape: Shape (rows,cols) of the output image
+    :param block_rows: Number of output rows to compute at once, to bound the size of the
+                       temporaries. Default is about a quarter-megapixel per block.
+    :return: float32 map, shape [2,rows,cols]. map[:,y,x] is the (x,y) image coordinate
+             which output pixel [y,x] samples, ready for warp.remap()
+    """
+    rows,cols=output_shape
+    result=np.empty((2,rows,cols),dtype=np.float32)
+    (a,b,c),(d,e,f)=M_lat_out[0,:],M_lat_out[1,:]
+    outx=np.arange(cols,dtype=np.float64)
+    if block_rows is None:
+        block_rows=default_block_rows(cols)
+    for row0 in range(0,rows,block_rows):
+        row1=min(row0+block_rows,rows)
+        outy=np.arange(row0,row1,dtype=np.float64)[:,None]
+        lattice_points=np.stack((a*outx+(b*outy+c),d*outx+(e*outy+f)),axis=-1)
+        result[:,row0:row1]=np.moveaxis(apply_distortion(model,lattice_points),-1,0)
+    return result
+
+
+def cached_warp_map(model:distortion_tuple,M_lat_out:np.ndarray,output_shape:tuple[int,int],*,
+                    cache_dir:str=default_cache_dir,max_bytes:int=default_max_bytes)->np.ndarray:
+    """
+    Get the warp map of a model through the frame cache, computing it only once
+
+    :param model: Model from fit_distortion()
+    :param M_lat_out: Passed to warp_map()
+    :param output_shape: Passed to warp_map()
+    :param cache_dir: Cache folder
+    :param max_bytes: Size limit of the cache
+    :return: Read-only memory map of the warp map, same as warp_map() would give
+
+    The key is a hash of everything the map is computed from, so a map is only
+    ever reused for the very same fit.
+    """
+    h=hashlib.sha256(model.kind.encode())
+    for arr in (np.array([model.order],dtype=np.int64),model.coef,model.knots,M_lat_out,
+                np.array(output_shape,dtype=np.int64)):
+        h.update(np.ascontiguousarray(arr,dtype=np.int64 if arr.dtype.kind=='i' else np.float64).tobytes())
+    return cached_array(f"{h.hexdigest()}_warpmap",lambda:warp_map(model,M_lat_out,output_shape),
+                        cache_dir=cache_dir,max_bytes=max_bytes)
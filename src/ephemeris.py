@@ -0,0 +1,178 @@
+"""
+Compact Chebyshev ephemeris of the Earth and Sun relative to the Moon over the
+Ranger 7 mission.
+
+The three-body propagation needs the position of the Earth at every force
+evaluation. Calling spkezr() for each one means that DE440 (115MB) has to be
+loaded in every process that propagates, and the propagator ends up tied to
+whatever time grid the positions were looked up on ahead of time. Here we fit
+piecewise Chebyshev series (see cheby.py) to the position of each body once,
+over the whole mission window, and save them to a small file. Evaluating the
+fit at any array of times needs nothing but NumPy, and the velocity comes from
+the derivative of the same series.
+
+Make the file from the root of the repository, with the kernels in place:
+
+python src/ephemeris.py
+
+and then anything can use load_ephemeris() or get_ephemeris() without loading
+any kernels.
+"""
+import os
+from argparse import ArgumentParser
+from collections import namedtuple
+from collections.abc import Callable
+from datetime import datetime, timezone, timedelta
+
+import numpy as np
+from spiceypy import spkezr, furnsh
+
+from cheby import cheby_tuple, cheby_sample_times, fit_cheby, eval_cheby, cheby_check_times
+from gmt import tdb, calc_et
+
+ephemeris_tuple=namedtuple('ephemeris_tuple','body,center,frame,pos,pos_error,vel_error')
+
+default_ephemeris_path="scratch/ephemeris_7.npz"
+
+# Mission window, from an hour before the first geocentric state in tables/geocentric_7.csv
+# to an hour after impact
+r7_et0=calc_et(datetime(year=1964,month=7,day=28,hour=16,minute=19,second=56,
+                        tzinfo=timezone.utc).astimezone(tdb))
+r7_et1=calc_et((datetime(year=1964,month=7,day=31,hour=13,minute=25,second=48,microsecond=799_000,
+                         tzinfo=timezone.utc)+timedelta(hours=1)).astimezone(tdb))
+
+
+def fit_ephemeris(body:str,et0:float,et1:float,*,center:str="301",frame:str="ECI_TOD",
+                  seg_len:float=43200.0,degree:int=12,
+                  sampler:Callable[[str,float,str,str,str],tuple[np.ndarray,float]]=spkezr,
+                  check:bool=True)->ephemeris_tuple:
+    """
+    Fit the position of one body relative to another over a time window
+
+    :param body: Spice ID of body to fit, IE 399 for Earth or 10 for the Sun
+    :param et0: Start of window in Spice ET
+    :param et1: End of window in Spice ET
+    :param center: Spice ID of body the position is relative to. Default is the Moon.
+    :param frame: Frame of the position vectors
+    :param seg_len: Longest length of each Chebyshev segment in seconds. The window is cut
+                    into the fewest equal segments no longer than this.
+    :param degree: Degree of the Chebyshev series in each segment
+    :param sampler: Function which gives the geometric state of the body at one time, with
+                    the same signature as spkezr()
+    :param check: If true, compare the fit to the sampler at times between the fit nodes
+    :return: ephemeris_tuple of:
+      * body, center, frame - Same as passed in
+      * pos - cheby_tuple fit of the position in km
+      * pos_error - Largest difference of any component of the position from the
+                    sampler at the check times, in km. NaN if not checked.
+      * vel_error - Same for the velocity, in km/s
+    """
+    n_seg=max(1,int(np.ceil((et1-et0)/seg_len)))
+    breaks,ets=cheby_sample_times(et0,et1,n_seg=n_seg,degree=degree)
+    states=np.array([sampler(body,et,frame,'NONE',center)[0] for et in ets.ravel()])
+    result=ephemeris_tuple(body=body,center=center,frame=frame,
+                           pos=fit_cheby(breaks,states[:,:3].reshape(ets.shape+(3,))),
+                           pos_error=np.nan,vel_error=np.nan)
+    if check:
+        check_ets=cheby_check_times(result.pos)
+        check_states=np.array([sampler(body,et,frame,'NONE',center)[0] for et in check_ets])
+        rs,vs=ephemeris_state(result,check_ets)
+        result=result._replace(pos_error=np.max(np.abs(rs.T-check_states[:,:3])),
+                               vel_error=np.max(np.abs(vs.T-check_states[:,3:])))
+    return result
+
+
+def ephemeris_position(eph:ephemeris_tuple,ets:np.ndarray)->np.ndarray:
+    """
+    Position of a body from its fit
+
+    :param eph: Fit from fit_ephemeris() or load_ephemeris()
+    :param ets: Times in Spice ET, shape [n]. Must be within the window of the fit.
+    :return: Position vectors in km, shape 3xn
+    """
+    return eval_cheby(eph.pos,ets).T
+
+
+def ephemeris_state(eph:ephemeris_tuple,ets:np.ndarray)->tuple[np.ndarray,np.ndarray]:
+    """
+    Position and velocity of a body from its fit
+
+    :param eph: Fit from fit_ephemeris() or load_ephemeris()
+    :param ets: Times in Spice ET, shape [n]. Must be within the window of the fit.
+    :return: Tuple of position vectors in km and velocity vectors in km/s, each shape 3xn
+    """
+    return eval_cheby(eph.pos,ets).T,eval_cheby(eph.pos,ets,deriv=1).T
+
+
+def save_ephemeris(fn:str,ephs:list[ephemeris_tuple]):
+    """
+    Write fits to a file
+
+    :param fn: Filename of .npz file to write
+    :param ephs: Fits from fit_ephemeris(), for different bodies
+    """
+    arrays={}
+    for eph in ephs:
+        arrays[f"{eph.body}_ids"]=np.array([eph.center,eph.frame])
+        arrays[f"{eph.body}_breaks"]=eph.pos.breaks
+        arrays[f"{eph.body}_coef"]=eph.pos.coef
+        arrays[f"{eph.body}_error"]=np.array([eph.pos_error,eph.vel_error])
+    np.savez(fn,bodies=np.array([eph.body for eph in ephs]),**arrays)
+
+
+def load_ephemeris(fn:str=default_ephemeris_path)->dict[str,ephemeris_tuple]:
+    """
+    Read fits written by save_ephemeris()
+
+    :param fn: Filename of .npz file
+    :return: Dictionary of fits, keyed by Spice ID of body, IE load_ephemeris()["399"] for Earth
+    """
+    result={}
+    with np.load(fn) as inf:
+        for body in inf["bodies"]:
+            body=str(body)
+            center,frame=[str(x) for x in inf[f"{body}_ids"]]
+            pos_error,vel_error=inf[f"{body}_error"]
+            result[body]=ephemeris_tuple(body=body,center=center,frame=frame,
+                                         pos=cheby_tuple(breaks=inf[f"{body}_breaks"],coef=inf[f"{body}_coef"]),
+                                         pos_error=pos_error,vel_error=vel_error)
+    return result
+
+
+def get_ephemeris(body:str,*,fn:str=default_ephemeris_path,
+                  sampler:Callable[[str,float,str,str,str],tuple[np.ndarray,float]]=spkezr)->ephemeris_tuple:
+    """
+    Fit of one body over the whole Ranger 7 mission window, from the file written by
+    main() if there is one, otherwise fit fresh
+
+    :param body: Spice ID of body, IE 399 for Earth
+    :param fn: Filename of .npz file from save_ephemeris()
+    :param sampler: Passed to fit_ephemeris() if the body isn't in the file. With the
+                    default, the kernels need to be loaded.
+    :return: ephemeris_tuple, valid from r7_et0 to r7_et1
+
+    The window runs an hour past either end of the mission, so times anywhere in the
+    mission are safely inside it, even after roundoff.
+    """
+    if os.path.exists(fn):
+        ephs=load_ephemeris(fn)
+        if body in ephs:
+            return ephs[body]
+    return fit_ephemeris(body,r7_et0,r7_et1,sampler=sampler)
+
+
+def main():
+    parser=ArgumentParser(description="Fit the ephemeris of the Earth and Sun relative to the Moon over the Ranger 7 mission")
+    parser.add_argument("--output",default=default_ephemeris_path,help="File to write")
+    parser.add_argument("--bodies",nargs="+",default=["399","10"],help="Spice IDs of bodies to fit")
+    args=parser.parse_args()
+    furnsh('kernels/Ranger7Background.tm')
+    ephs=[fit_ephemeris(body,r7_et0,r7_et1) for body in args.bodies]
+    for eph in ephs:
+        print(f"{eph.body}: {eph.pos.coef.shape[0]} segments, "
+              f"max error {eph.pos_error*1000:.3g} m, {eph.vel_error*1e6:.3g} mm/s")
+    save_ephemeris(args.output,ephs)
+
+
+if __name__=="__main__":
+    main()
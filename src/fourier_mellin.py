@@ -0,0 +1,237 @@
+"""
+Measure the zoom between consecutive rectified frames from the lunar surface itself.
+
+Consecutive frames of one camera are mostly a zoom about point 1, the point the
+spacecraft is flying straight towards (see Ranger7.processImageA()), plus a small
+rotation and shift. The reticle registration in auto_rectify ignores the surface
+entirely, so this gives an independent measurement of the zoom rate and the focus
+of expansion for every pair of frames, which can be checked against the slant
+range to point 1 in the trajectory tables.
+
+This uses the Fourier-Mellin method:
+
+* The magnitude of the Fourier transform of an image doesn't change when the
+  image shifts, and scaling or rotating the image scales (inversely) or rotates
+  its magnitude spectrum the same way.
+* Resampling the magnitude spectrum onto log-polar coordinates turns that scale
+  and rotation into a plain shift, which phase correlation measures.
+* With the scale and rotation known, the earlier frame is scaled and rotated to
+  match the later one, and phase correlation of the frames themselves gives the
+  remaining shift.
+* The log-polar samples are coarse compared to the zoom between frames early in
+  the sequence, which may be only a few tenths of a percent. So this is repeated
+  a few times, each time warping the earlier frame by everything measured so far
+  and measuring only what is left, which converges to about 0.01%.
+
+All of the pairs are done at once, with each step a batched FFT over the whole
+stack. Run it from the root of the repository on a channel whose frame stack has
+been written by auto_rectify --output stack. Where there is a trajectory table for
+the channel, the zoom expected from it is printed next to the measured zoom:
+
+python src/fourier_mellin.py 7A
+"""
+from argparse import ArgumentParser
+from collections import namedtuple
+
+import numpy as np
+from scipy.fft import rfft2, set_workers
+from scipy.ndimage import map_coordinates, affine_transform
+
+from correlate import phase_crosses, img_offsets, downsample2
+from frame_stack import load_stack
+from tables import load_table
+
+zoom_tuple=namedtuple('zoom_tuple','scale,rotation,shift,foe,M_next_prev')
+
+
+def log_polar_spectra(ims:np.ndarray,*,n_angle:int=360,n_radius:int=256,r_min:float=4.0)->tuple[np.ndarray,float]:
+    """
+    Resample the magnitude spectrum of each image onto log-polar coordinates
+
+    :param ims: Stack of images, shape [n,rows,cols]
+    :param n_angle: Number of angle samples, covering 180 degrees. The magnitude
+                    spectrum of a real image is symmetric, so this is all of it.
+    :param n_radius: Number of log radius samples
+    :param r_min: Smallest spatial frequency to sample, in cycles per frame. The lowest
+                  frequencies are mostly the window and the overall shading.
+    :return: Tuple of the log-polar spectra, shape [n,n_angle,n_radius], and the step
+             in natural log of radius between radius samples.
+    """
+    n,rows,cols=ims.shape
+    window=np.outer(np.hanning(rows),np.hanning(cols))
+    # rfft2 keeps only non-negative horizontal frequencies, which is exactly the half
+    # plane from -90 to +90 degrees
+    magnitude=np.abs(rfft2((ims-np.mean(ims,axis=(1,2),keepdims=True))*window))
+    magnitude=np.fft.fftshift(magnitude,axes=1)
+    # High-pass emphasis, so that the finer texture which carries the scale and
+    # rotation isn't swamped by the steep falloff of the spectrum
+    fy=np.fft.fftshift(np.fft.fftfreq(rows))[:,None]
+    fx=np.fft.rfftfreq(cols)[None,:]
+    emphasis=np.cos(np.pi*fy)*np.cos(np.pi*fx)
+    magnitude*=(1-emphasis)*(2-emphasis)
+    r_max=min(rows,cols)/2
+    log_step=np.log(r_max/r_min)/(n_radius-1)
+    radius=r_min*np.exp(log_step*np.arange(n_radius))
+    angle=np.pi*(np.arange(n_angle)/n_angle-0.5)
+    # Spectrum coordinates of each sample. Frequencies are scaled to the frame size
+    # in each direction so that a non-square frame still maps circles to circles.
+    ky=(radius[None,:]*np.sin(angle[:,None]))*rows/min(rows,cols)+rows//2
+    kx=(radius[None,:]*np.cos(angle[:,None]))*cols/min(rows,cols)
+    spectra=np.stack([map_coordinates(m,(ky,kx),order=1) for m in magnitude])
+    return spectra,log_step
+
+
+def similarity_about(scale:float,rotation:float,center:tuple[float,float])->np.ndarray:
+    """
+    Matrix which scales and rotates about a point
+
+    :param scale: Scale factor
+    :param rotation: Rotation angle in radians, positive from +x towards +y (clockwise
+                     on screen, since y is down)
+    :param center: (x,y) of the point which doesn't move
+    :return: 3x3 matrix acting on [x,y,1]
+    """
+    c,s=scale*np.cos(rotation),scale*np.sin(rotation)
+    cx,cy=center
+    M_shift=np.array([[1,0,cx],[0,1,cy],[0,0,1]])
+    return M_shift@np.array([[c,-s,0],[s,c,0],[0,0,1]])@np.linalg.inv(M_shift)
+
+
+def _warp_cubic(img:np.ndarray,M_to_from:np.ndarray)->np.ndarray:
+    """
+    Same as warp.affine_warp(), but with cubic spline interpolation, and filling
+    outside the image with its mean. Bilinear interpolation smooths the warped
+    image by an amount which depends on the warp, which shrinks its spectrum
+    enough to throw the measured scale off by a few hundredths of a percent.
+    """
+    # affine_transform() pulls, and works in (row,col) rather than (x,y)
+    swap=np.array([[0,1,0],[1,0,0],[0,0,1]])
+    M_from_to=swap@np.linalg.inv(M_to_from)@swap
+    return affine_transform(img,M_from_to[0:2,0:2],offset=M_from_to[0:2,2],order=3,cval=np.mean(img))
+
+
+def focus_of_expansion(M_next_prev:np.ndarray)->np.ndarray:
+    """
+    Find the point which a frame-to-frame transform leaves where it is
+
+    :param M_next_prev: Matrices which take coordinates in one frame to the next, shape [...,3,3]
+    :return: (x,y) of the fixed point of each, shape [...,2]. NaN where the transform is
+             too close to a pure shift for the point to be determined, or is itself NaN.
+    """
+    A=np.eye(2)-M_next_prev[...,0:2,0:2]
+    t=M_next_prev[...,0:2,2]
+    # Matrices which couldn't be measured are NaN, and have no fixed point either
+    finite=np.all(np.isfinite(A),axis=(-2,-1))&np.all(np.isfinite(t),axis=-1)
+    det=np.linalg.det(np.where(finite[...,None,None],A,0.0))
+    ok=finite&(np.abs(det)>1e-9)
+    foe=np.full(t.shape,np.nan)
+    foe[ok]=np.linalg.solve(A[ok],t[ok][...,None])[...,0]
+    return foe
+
+
+def register_zoom(ims:np.ndarray,*,levels:int=1,n_angle:int=360,n_radius:int=256,n_pass:int=3)->zoom_tuple:
+    """
+    Measure the scale, rotation, and shift between each pair of consecutive frames
+
+    :param ims: Stack of frames in order, shape [n,rows,cols], IE the frames of a frame stack
+    :param levels: Number of times to halve the frames before measuring. The zoom is a
+                   property of the whole frame, so this loses little and saves a lot.
+    :param n_angle: Number of angle samples of the log-polar spectra
+    :param n_radius: Number of radius samples of the log-polar spectra
+    :param n_pass: Number of passes. Each pass after the first warps the earlier frames
+                   by the transform so far and measures what is left.
+    :return: zoom_tuple with one entry per pair, frame i to frame i+1:
+      * scale - How much bigger the surface looks in the later frame, shape [n-1]
+      * rotation - Rotation of the later frame, radians, shape [n-1]
+      * shift - (x,y) shift left after scaling and rotating about the frame center,
+                in full resolution pixels, shape [n-1,2]
+      * foe - (x,y) of the focus of expansion, the point which stays put, in full
+              resolution pixels, shape [n-1,2]
+      * M_next_prev - Matrix which takes full resolution pixel coordinates in frame i
+                      to frame i+1, shape [n-1,3,3]
+    """
+    ims=np.asarray(ims,dtype=np.float64)
+    for _ in range(levels):
+        ims=downsample2(ims)
+    n,rows,cols=ims.shape
+    center=((cols-1)/2,(rows-1)/2)
+    window=np.outer(np.hanning(rows),np.hanning(cols))
+    spectra,log_step=log_polar_spectra(ims[1:],n_angle=n_angle,n_radius=n_radius)
+    M_next_prev=np.tile(np.eye(3),(n-1,1,1))
+    matched=ims[:-1]
+    for i_pass in range(n_pass):
+        if i_pass>0:
+            # Warp each earlier frame by the transform so far, so that the next pass
+            # measures only what is left over, which it can do more precisely
+            matched=np.stack([_warp_cubic(im,M) for im,M in zip(ims[:-1],M_next_prev)])
+        # A bigger image has a smaller spectrum, so the scale is the shift down in log radius
+        matched_spectra,_=log_polar_spectra(matched,n_angle=n_angle,n_radius=n_radius)
+        d_angle,d_log_r=img_offsets(phase_crosses(spectra,matched_spectra,peak_sigma=2.0),subpixel=True).T
+        M_sim=np.stack([similarity_about(np.exp(-d*log_step),a*np.pi/n_angle,center)
+                        for a,d in zip(d_angle,d_log_r)])
+        M_next_prev=M_sim@M_next_prev
+        # Scale and rotate each earlier frame to match the later one, and measure the shift
+        matched=np.stack([_warp_cubic(im,M) for im,M in zip(ims[:-1],M_next_prev)])
+        offsets=img_offsets(phase_crosses((ims[1:]-np.mean(ims[1:],axis=(1,2),keepdims=True))*window,
+                                          (matched-np.mean(matched,axis=(1,2),keepdims=True))*window,
+                                          peak_sigma=2.0),
+                            subpixel=True)
+        # Offsets are (row,col), shifts are (x,y)
+        M_next_prev[:,0:2,2]+=offsets[:,::-1]
+    # Convert from the reduced frames back to full resolution pixels, the same way as
+    # frame_cache.load_reduced_frame()
+    s=2**levels
+    M_full_red=np.array([[s,0,(s-1)/2],[0,s,(s-1)/2],[0,0,1]])
+    M_next_prev=M_full_red@M_next_prev@np.linalg.inv(M_full_red)
+    A=M_next_prev[:,0:2,0:2]
+    scale=np.sqrt(np.linalg.det(A))
+    rotation=np.arctan2(A[:,1,0],A[:,0,0])
+    full_center=(s*cols/2-0.5,s*rows/2-0.5)
+    M_sim=np.stack([similarity_about(sc,r,full_center) for sc,r in zip(scale,rotation)])
+    return zoom_tuple(scale=scale,rotation=rotation,shift=M_next_prev[:,0:2,2]-M_sim[:,0:2,2],
+                      foe=focus_of_expansion(M_next_prev),M_next_prev=M_next_prev)
+
+
+def table_zoom(mission:int,channel:str,tabs:np.ndarray)->np.ndarray:
+    """
+    Zoom between consecutive TABs expected from the trajectory tables. The surface
+    around point 1 looks bigger in inverse proportion to the slant range to it.
+
+    :param mission: Mission number, IE 7=Ranger 7, etc.
+    :param channel: Camera, IE A
+    :param tabs: TAB numbers in order
+    :return: Expected scale from each TAB to the next, shape [len(tabs)-1]
+    """
+    table=load_table(f"terminal_{mission:1d}{channel.lower()}")
+    srange=np.interp(tabs,table.TAB,table.pt1_srange)
+    return srange[:-1]/srange[1:]
+
+
+def main():
+    parser=ArgumentParser(description="Measure the frame-to-frame zoom of a channel from its frame stack")
+    parser.add_argument("channels",nargs="+",help="Mission and channel to measure, IE 7A 7B 8A 8B")
+    parser.add_argument("--levels",type=int,default=1,help="Number of times to halve the frames first")
+    parser.add_argument("--chunk",type=int,default=32,
+                        help="Number of frame pairs to measure at once, which bounds the memory used")
+    args=parser.parse_args()
+    for arg in args.channels:
+        mission,channel=int(arg[:-1]),arg[-1]
+        stack=load_stack(mission,channel)
+        chunks=[register_zoom(stack.frames[i:i+args.chunk+1],levels=args.levels)
+                for i in range(0,len(stack.tab)-1,args.chunk)]
+        zoom=zoom_tuple(*[np.concatenate(field) for field in zip(*chunks)])
+        np.savez(f"rect_images/{mission:1d}{channel}/zoom.npz",tab=stack.tab,**zoom._asdict())
+        try:
+            expected=table_zoom(mission,channel,stack.tab)
+        except FileNotFoundError:
+            expected=np.full(len(zoom.scale),np.nan)
+        for tab0,tab1,scale,table_scale,rotation,(x,y) in zip(stack.tab[:-1],stack.tab[1:],zoom.scale,expected,
+                                                             zoom.rotation,zoom.foe):
+            print(f"{mission:1d}{channel}{tab0:03d}-{tab1:03d}: scale {scale:8.5f} (table {table_scale:8.5f}), "
+                  f"rotation {np.degrees(rotation):7.3f} deg, focus of expansion ({x:7.1f},{y:7.1f})")
+
+
+if __name__=="__main__":
+    # This is the only process, so let its FFTs use every CPU
+    with set_workers(-1):
+        main()
@@ -0,0 +1,167 @@
+"""
+Persistent on-disk cache of decoded Ranger frames.
+
+Decoding a full-size LPI JPEG takes much longer than reading the same pixels
+back out of an uncompressed .npy file, and an .npy file can be memory-mapped
+so that only the parts we actually touch are read at all. Every entry is keyed
+by a hash of the *content* of the source file, plus whatever parameters were
+used to make it, so editing or replacing a raw image automatically misses the
+cache, and renaming one doesn't.
+
+The cache is bounded in size. Each hit touches the entry, and when the cache
+grows past its limit, the entries which were least recently used are deleted
+first.
+"""
+import hashlib
+import os
+from collections import namedtuple
+from collections.abc import Callable
+from tempfile import NamedTemporaryFile
+
+import numpy as np
+from PIL import Image
+from matplotlib import image as mpimg
+
+default_cache_dir="scratch/frame_cache"
+default_max_bytes=16*1024**3
+
+
+# Hashes already worked out in this process, keyed by (path,st_mtime_ns,st_size)
+_file_hashes={}
+
+
+def file_hash(fn:str)->str:
+    """
+    Hash the content of a file
+
+    :param fn: Filename
+    :return: Hex digest of SHA-256 hash of file content
+
+    The same file is asked about many times in one run (to find the TABs that need
+    doing, and then by each loader), so the hash is remembered for as long as the
+    file's modification time and size stay the same, and the file is only read once.
+    """
+    stat=os.stat(fn)
+    key=(os.path.abspath(fn),stat.st_mtime_ns,stat.st_size)
+    if key not in _file_hashes:
+        h=hashlib.sha256()
+        with open(fn,"rb") as inf:
+            while chunk:=inf.read(1<<20):
+                h.update(chunk)
+        _file_hashes[key]=h.hexdigest()
+    return _file_hashes[key]
+
+
+def evict(cache_dir:str=default_cache_dir,max_bytes:int=default_max_bytes):
+    """
+    Delete least-recently-used entries until the cache is no bigger than max_bytes
+
+    :param cache_dir: Cache folder
+    :param max_bytes: Size limit of all entries together
+    """
+    entries=[]
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".npy"):
+                stat=entry.stat()
+                entries.append((stat.st_mtime,stat.st_size,entry.path))
+    total=sum(size for _,size,_ in entries)
+    for _,size,path in sorted(entries):
+        if total<=max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Someone else (IE another worker process) already evicted it
+            pass
+        total-=size
+
+
+def cached_array(key:str,make:Callable[[],np.ndarray],*,
+                 cache_dir:str=default_cache_dir,max_bytes:int=default_max_bytes)->np.ndarray:
+    """
+    Get an array from the cache, making and storing it if it isn't there yet.
+
+    :param key: Cache key. Must be usable as part of a filename, and must change
+                whenever anything that went into making the array changes.
+    :param make: Function with no arguments which makes the array on a cache miss
+    :param cache_dir: Cache folder, created if needed
+    :param max_bytes: Size limit of the cache
+    :return: Read-only memory map of the cached array. This is a zero-copy view of
+             the cache file, so pixels are only read from disk as they are used.
+
+    Entries are written to a temporary file and renamed into place, so many
+    processes can share one cache without ever seeing a partly-written entry.
+    """
+    fn=os.path.join(cache_dir,f"{key}.npy")
+    try:
+        result=np.load(fn,mmap_mode='r')
+        # Mark as recently used, for eviction
+        os.utime(fn)
+        return result
+    except FileNotFoundError:
+        pass
+    os.makedirs(cache_dir,exist_ok=True)
+    arr=np.ascontiguousarray(make())
+    with NamedTemporaryFile(dir=cache_dir,suffix=".tmp",delete=False) as ouf:
+        np.save(ouf,arr)
+    os.replace(ouf.name,fn)
+    # Map before evicting, so that the mapping survives even if this entry alone is
+    # over the limit and gets evicted right away.
+    result=np.load(fn,mmap_mode='r')
+    evict(cache_dir,max_bytes)
+    return result
+
+
+def load_frame(infn:str,*,cache_dir:str=default_cache_dir,max_bytes:int=default_max_bytes)->np.ndarray:
+    """
+    Load a raw image at full resolution, through the cache
+
+    :param infn: Image filename, IE raw_images/7A/Ranger7A001.jpg
+    :param cache_dir: Cache folder
+    :param max_bytes: Size limit of the cache
+    :return: Read-only memory map of the decoded image, same as mpimg.imread(infn) would give
+    """
+    return cached_array(f"{file_hash(infn)}_full",lambda:mpimg.imread(infn),
+                        cache_dir=cache_dir,max_bytes=max_bytes)
+
+
+reduced_frame_tuple=namedtuple('reduced_frame_tuple','img,M_big_img,big_shape')
+
+
+def load_reduced_frame(infn:str,min_width:int,*,cache_dir:str=default_cache_dir,
+                       max_bytes:int=default_max_bytes)->reduced_frame_tuple:
+    """
+    Load a raw image at reduced resolution, through the cache
+
+    :param infn: Image filename, IE raw_images/7A/Ranger7A001.jpg
+    :param min_width: Smallest acceptable width of the reduced image. The image is reduced
+                      by the largest power of two (up to 8) which keeps it at least this wide.
+    :param cache_dir: Cache folder
+    :param max_bytes: Size limit of the cache
+    :return: reduced_frame_tuple of:
+      * img - Read-only memory map of the reduced image
+      * M_big_img - Matrix which transforms a coordinate in the reduced image to the
+                    matching coordinate in the full-resolution image
+      * big_shape - Shape of the full-resolution image, as load_frame() would give it
+
+    For a JPEG, this uses the codec's own DCT-domain scaling (PIL draft mode), so the
+    full-resolution image is never decoded at all. Each reduced pixel is then
+    the mean of an s by s block of full-resolution pixels. Any other kind of image is
+    loaded at full resolution, with M_big_img the identity.
+    """
+    with Image.open(infn) as im:
+        big_shape=(im.size[1],im.size[0])
+        draft=im.draft(im.mode,(min_width,int(np.ceil(min_width*big_shape[0]/big_shape[1]))))
+        scale=1 if draft is None else round(big_shape[1]/draft[1][2])
+        if scale==1:
+            img=load_frame(infn,cache_dir=cache_dir,max_bytes=max_bytes)
+        else:
+            img=cached_array(f"{file_hash(infn)}_draft{scale}",lambda:np.asarray(im),
+                             cache_dir=cache_dir,max_bytes=max_bytes)
+    # Reduced pixel j is the mean of full-resolution pixels j*s to j*s+s-1, so its
+    # center is at j*s+(s-1)/2.
+    M_big_img=np.array([[scale,0,(scale-1)/2],
+                        [0,scale,(scale-1)/2],
+                        [0,0,1]])
+    return reduced_frame_tuple(img=img,M_big_img=M_big_img,big_shape=big_shape)
@@ -0,0 +1,162 @@
+"""
+Store all of the rectified frames of a channel in one memory-mappable array.
+
+Writing each rectified TAB to its own PNG means that anything downstream has to
+find and decode ~200 files to get at a channel. Instead, the frame stack is one
+uncompressed .npy file per channel, shape [n_tab,1150,1150] uint8, with one
+contiguous frame per TAB. Readers memory-map it, so getting any one frame, or
+the time series of any one pixel across every frame, is a zero-copy view, and
+only the parts actually touched are ever read from disk.
+
+Next to it is a table (an .npz file) with a row for each frame: the TAB number,
+the matrix M_im1_imn which took that TAB into TAB 1 space, and the lattice fit
+residuals and inlier flags of each reticle mark.
+
+The stack is allocated once at full size, with a slot for every TAB, and each
+frame is written into its own slot. Different processes can therefore fill in
+different frames of the same stack at the same time.
+"""
+import os
+from argparse import ArgumentParser
+from collections import namedtuple
+from tempfile import NamedTemporaryFile
+
+import numpy as np
+from PIL import Image
+from numpy.lib.format import open_memmap
+
+frame_shape=(1150,1150)
+
+stack_tuple=namedtuple('stack_tuple','frames,tab,M_im1_imn,residuals,inliers')
+
+
+def stack_path(mission:int,channel:str)->str:
+    return f"rect_images/{mission:1d}{channel}/stack.npy"
+
+
+def table_path(mission:int,channel:str)->str:
+    return f"rect_images/{mission:1d}{channel}/stack_table.npz"
+
+
+def open_stack(mission:int,channel:str,tabs:list[int])->tuple[np.memmap,bool]:
+    """
+    Open the frame stack of a channel for writing, creating it if needed
+
+    :param mission: Mission number, IE 7=Ranger 7, etc.
+    :param channel: Either A, B, or P
+    :param tabs: TAB numbers that the stack must have a slot for, in order
+    :return: Tuple of:
+      * Writable memory map of the stack, shape [len(tabs),1150,1150]
+      * True if the existing stack was reused, with its frames intact, or False if a
+        new blank stack was made, so every frame needs to be written again.
+
+    The existing stack is only reused if its table lists exactly the same TABs, and
+    it was finished. A stack whose table is still marked partial was interrupted
+    while being written, so some of its frames may be blank.
+    """
+    path=stack_path(mission,channel)
+    try:
+        with np.load(table_path(mission,channel)) as table:
+            old_tabs=table["tab"].tolist()
+            partial=bool(table["partial"])
+        if old_tabs==list(tabs) and not partial:
+            frames=open_memmap(path,mode='r+')
+            if frames.shape==(len(tabs),)+frame_shape:
+                return frames,True
+    except FileNotFoundError:
+        pass
+    frames=open_memmap(path,mode='w+',dtype=np.uint8,shape=(len(tabs),)+frame_shape)
+    # Write an empty table right away, so that a stack whose frames are only partly
+    # written is never mistaken for a complete one.
+    save_table(mission,channel,np.array(tabs),
+               M_im1_imn=np.full((len(tabs),3,3),np.nan),
+               residuals=np.zeros((len(tabs),0)),inliers=np.zeros((len(tabs),0),dtype=bool),
+               partial=True)
+    return frames,False
+
+
+def write_frame(mission:int,channel:str,slot:int,rectified:np.ndarray):
+    """
+    Write one rectified frame into its slot in an existing stack. Safe to call from
+    worker processes, as long as each writes different slots.
+
+    :param mission: Mission number, IE 7=Ranger 7, etc.
+    :param channel: Either A, B, or P
+    :param slot: Index of this frame in the stack
+    :param rectified: Rectified image, uint8 1150x1150
+    """
+    frames=open_memmap(stack_path(mission,channel),mode='r+')
+    frames[slot]=rectified
+    frames.flush()
+
+
+def save_table(mission:int,channel:str,tab:np.ndarray,*,M_im1_imn:np.ndarray,
+               residuals:np.ndarray,inliers:np.ndarray,partial:bool=False):
+    """
+    Write the table of per-frame data which goes with a stack, atomically.
+
+    :param tab: TAB number of each frame, shape [n_tab]
+    :param M_im1_imn: Matrix which took each TAB into TAB 1 space, shape [n_tab,3,3]
+    :param residuals: Lattice fit residual of each reticle mark, shape [n_tab,n_reticle]
+    :param inliers: Whether each reticle mark was used in the fit, shape [n_tab,n_reticle]
+    :param partial: True if some frames of the stack are not written yet
+    """
+    path=table_path(mission,channel)
+    with NamedTemporaryFile(dir=os.path.dirname(path),suffix=".npz",delete=False) as ouf:
+        np.savez(ouf,tab=tab,M_im1_imn=M_im1_imn,residuals=residuals,inliers=inliers,partial=partial)
+    os.replace(ouf.name,path)
+
+
+def load_stack(mission:int,channel:str)->stack_tuple:
+    """
+    Open the frame stack of a channel for reading
+
+    :param mission: Mission number, IE 7=Ranger 7, etc.
+    :param channel: Either A, B, or P
+    :return: stack_tuple of:
+      * frames - Read-only memory map of all frames, shape [n_tab,1150,1150]. Frame i is
+                 TAB tab[i], and frames[:,y,x] is the time series of one pixel.
+      * tab - TAB number of each frame
+      * M_im1_imn - Matrix which took each TAB into TAB 1 space, shape [n_tab,3,3]
+      * residuals - Lattice fit residuals, shape [n_tab,n_reticle]
+      * inliers - Lattice fit inlier flags, shape [n_tab,n_reticle]
+    """
+    with np.load(table_path(mission,channel)) as table:
+        if table["partial"]:
+            raise ValueError(f"Frame stack for {mission:1d}{channel} is incomplete, rerun auto_rectify")
+        return stack_tuple(frames=np.load(stack_path(mission,channel),mmap_mode='r'),
+                           tab=table["tab"],M_im1_imn=table["M_im1_imn"],
+                           residuals=table["residuals"],inliers=table["inliers"])
+
+
+def get_frame(stack:stack_tuple,tab:int)->np.ndarray:
+    """
+    Get the rectified frame of one TAB
+
+    :param stack: Stack from load_stack()
+    :param tab: TAB number
+    :return: Read-only view of the frame
+    """
+    return stack.frames[np.flatnonzero(stack.tab==tab)[0]]
+
+
+def export_png(mission:int,channel:str):
+    """
+    Write every frame of a stack out as a separate PNG, the same as auto_rectify
+    writes when using PNG output.
+    """
+    stack=load_stack(mission,channel)
+    for tab,frame in zip(stack.tab,stack.frames):
+        Image.fromarray(np.asarray(frame),mode='L').save(f"rect_images/{mission:1d}{channel}/Rect{mission:1d}{channel}{tab:03d}.png")
+
+
+def main():
+    parser=ArgumentParser(description="Export the frames of a frame stack as PNG images")
+    parser.add_argument("channels",nargs="+",help="Mission and channel to export, IE 7A 7B 8A 8B")
+    args=parser.parse_args()
+    for arg in args.channels:
+        export_png(int(arg[:-1]),arg[-1])
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Fast, batched frame transformations over a mission time window.
+
+SPICE sxform() and pxform() give the transformation between two frames at one
+time per call, and each call works its way through the whole chain of frames
+from the kernels. That is fine for a few hundred table rows, but geometry for
+each scanline or pixel needs millions of these. Here we instead sample the
+transformation once on a grid across the window, and fit a piecewise Chebyshev
+series (see cheby.py) to each component of its quaternion. After that, the
+transformation at any array of times is a vectorized evaluation with no SPICE
+calls at all.
+
+The rotation matrix is rebuilt from the normalized quaternion, so it is always
+exactly orthonormal, and its rate of change (the lower-left block of the 6x6 state
+transformation) comes from the derivative of the same series, so position and
+velocity are always consistent with each other. Every fit is checked against the
+sampler at times between the fit nodes, and the worst error is kept with the fit.
+
+The sampler has the same signature as spiceypy.sxform(), which is the default, so
+the kernels for the frames in question need to be loaded before fitting. Any other
+function with that signature can be passed in, IE a synthetic rotation for testing.
+"""
+from collections import namedtuple
+from collections.abc import Callable
+
+import numpy as np
+from spiceypy import sxform
+
+from cheby import cheby_sample_times, fit_cheby, eval_cheby, cheby_check_times
+
+frame_tuple=namedtuple('frame_tuple','from_frame,to_frame,quat,rot_error,rate_error')
+
+
+def matrix_to_quat(M:np.ndarray)->np.ndarray:
+    """
+    Convert rotation matrices to quaternions
+
+    :param M: Rotation matrices, shape [...,3,3]
+    :return: Unit quaternions (w,x,y,z), shape [...,4], such that quat_to_matrix() gives M back.
+             The sign of each is arbitrary.
+
+    Each element of the symmetric matrix S below is 4*q_i*q_j. For numerical accuracy, q is
+    taken from the row of S with the biggest diagonal element, IE the biggest component of q.
+    """
+    M=np.asarray(M,dtype=np.float64)
+    m00,m01,m02=M[...,0,0],M[...,0,1],M[...,0,2]
+    m10,m11,m12=M[...,1,0],M[...,1,1],M[...,1,2]
+    m20,m21,m22=M[...,2,0],M[...,2,1],M[...,2,2]
+    S=np.stack((np.stack((1+m00+m11+m22,m21-m12      ,m02-m20      ,m10-m01      ),axis=-1),
+                np.stack((m21-m12      ,1+m00-m11-m22,m01+m10      ,m02+m20      ),axis=-1),
+                np.stack((m02-m20      ,m01+m10      ,1-m00+m11-m22,m12+m21      ),axis=-1),
+                np.stack((m10-m01      ,m02+m20      ,m12+m21      ,1-m00-m11+m22),axis=-1)),axis=-2)
+    i_big=np.argmax(np.diagonal(S,axis1=-2,axis2=-1),axis=-1)
+    row=np.take_along_axis(S,i_big[...,None,None],axis=-2)[...,0,:]
+    return row/(2*np.sqrt(np.take_along_axis(row,i_big[...,None],axis=-1)))
+
+
+def _quat_bilinear(p:np.ndarray,q:np.ndarray)->np.ndarray:
+    """
+    Symmetric bilinear form B such that B(q,q) is the rotation matrix of unit quaternion q
+
+    :param p: Quaternions, shape [...,4]
+    :param q: Quaternions, shape [...,4]
+    :return: Matrices, shape [...,3,3]
+    """
+    P=p[...,:,None]*q[...,None,:]
+    S=(P+np.swapaxes(P,-1,-2))/2
+    (ww,wx,wy,wz),(_,xx,xy,xz),(_,_,yy,yz),(_,_,_,zz)=[[S[...,i,j] for j in range(4)] for i in range(4)]
+    return np.stack((np.stack((ww+xx-yy-zz,2*(xy-wz)  ,2*(xz+wy)  ),axis=-1),
+                     np.stack((2*(xy+wz)  ,ww-xx+yy-zz,2*(yz-wx)  ),axis=-1),
+                     np.stack((2*(xz-wy)  ,2*(yz+wx)  ,ww-xx-yy+zz),axis=-1)),axis=-2)
+
+
+def quat_to_matrix(q:np.ndarray)->np.ndarray:
+    """
+    Convert unit quaternions to rotation matrices
+
+    :param q: Unit quaternions (w,x,y,z), shape [...,4]
+    :return: Rotation matrices, shape [...,3,3]
+    """
+    return _quat_bilinear(q,q)
+
+
+def _continuous(q:np.ndarray)->np.ndarray:
+    """
+    Flip the signs of a time series of quaternions so that each is on the same side as
+    the one before it. q and -q are the same rotation, but only a series which doesn't
+    jump between them is smooth enough to fit.
+
+    :param q: Quaternions in time order, shape [n,4]
+    :return: Same quaternions, with signs flipped as needed
+    """
+    flip=np.where(np.sum(q[1:]*q[:-1],axis=-1)<0,-1.0,1.0)
+    return q*np.concatenate(([1.0],np.cumprod(flip)))[:,None]
+
+
+def fit_frame(from_frame:str,to_frame:str,et0:float,et1:float,*,seg_len:float=21600.0,degree:int=12,
+              sampler:Callable[[str,str,float],np.ndarray]=sxform,check:bool=True)->frame_tuple:
+    """
+    Fit the transformation between two frames over a time window
+
+    :param from_frame: Name of frame to transform from, IE IAU_MOON
+    :param to_frame: Name of frame to transform to, IE ECI_TOD
+    :param et0: Start of window in Spice ET
+    :param et1: End of window in Spice ET
+    :param seg_len: Longest length of each Chebyshev segment in seconds. The window is cut
+                    into the fewest equal segments no longer than this.
+    :param degree: Degree of the Chebyshev series in each segment
+    :param sampler: Function which returns the 6x6 state transformation matrix from
+                    from_frame to to_frame at one time, with the same signature as sxform()
+    :param check: If true, compare the fit to the sampler at times between the fit nodes
+    :return: frame_tuple of:
+      * from_frame, to_frame - Names of the frames
+      * quat - cheby_tuple fit of the quaternion of the rotation, components (w,x,y,z)
+      * rot_error - Largest difference of any element of the rotation matrix from the
+                    sampler at the check times. Multiply by a distance to get the
+                    worst position error at that distance. NaN if not checked.
+      * rate_error - Same for the rate of change of the rotation matrix, in 1/s
+    """
+    n_seg=max(1,int(np.ceil((et1-et0)/seg_len)))
+    breaks,ets=cheby_sample_times(et0,et1,n_seg=n_seg,degree=degree)
+    Ms=np.array([sampler(from_frame,to_frame,et) for et in ets.ravel()])
+    qs=_continuous(matrix_to_quat(Ms[:,:3,:3]))
+    result=frame_tuple(from_frame=from_frame,to_frame=to_frame,
+                       quat=fit_cheby(breaks,qs.reshape(ets.shape+(4,))),rot_error=np.nan,rate_error=np.nan)
+    if check:
+        check_ets=cheby_check_times(result.quat)
+        M_checks=np.array([sampler(from_frame,to_frame,et) for et in check_ets])
+        M_fits=frame_xform(result,check_ets)
+        result=result._replace(rot_error=np.max(np.abs(M_fits[:,:3,:3]-M_checks[:,:3,:3])),
+                               rate_error=np.max(np.abs(M_fits[:,3:,:3]-M_checks[:,3:,:3])))
+    return result
+
+
+def frame_rotation(frame:frame_tuple,ets:np.ndarray)->np.ndarray:
+    """
+    Rotation matrix of a fitted frame transformation, like pxform()
+
+    :param frame: Fit from fit_frame()
+    :param ets: Times in Spice ET, shape [n]. Must be within the window of the fit.
+    :return: Rotation matrices, shape [n,3,3]
+    """
+    q=eval_cheby(frame.quat,ets)
+    q/=np.linalg.norm(q,axis=-1,keepdims=True)
+    return quat_to_matrix(q)
+
+
+def frame_xform(frame:frame_tuple,ets:np.ndarray)->np.ndarray:
+    """
+    State transformation matrix of a fitted frame transformation, like sxform()
+
+    :param frame: Fit from fit_frame()
+    :param ets: Times in Spice ET, shape [n]. Must be within the window of the fit.
+    :return: 6x6 state transformation matrices, shape [n,6,6]
+    """
+    q=eval_cheby(frame.quat,ets)
+    dq=eval_cheby(frame.quat,ets,deriv=1)
+    q_len=np.linalg.norm(q,axis=-1,keepdims=True)
+    q/=q_len
+    # Derivative of the normalized quaternion
+    dq=(dq-q*np.sum(q*dq,axis=-1,keepdims=True))/q_len
+    R=quat_to_matrix(q)
+    result=np.zeros(R.shape[:-2]+(6,6))
+    result[...,:3,:3]=R
+    result[...,3:,3:]=R
+    result[...,3:,:3]=2*_quat_bilinear(q,dq)
+    return result
+
+
+def transform_states(frame:frame_tuple,ets:np.ndarray,rs:np.ndarray,vs:np.ndarray)->tuple[np.ndarray,np.ndarray]:
+    """
+    Transform a stack of state vectors from one frame to another
+
+    :param frame: Fit from fit_frame()
+    :param ets: Time of each state in Spice ET, shape [n]
+    :param rs: Position vectors in from_frame, shape 3xn
+    :param vs: Velocity vectors in from_frame, shape 3xn
+    :return: Tuple of position and velocity vectors in to_frame, each shape 3xn
+    """
+    M=frame_xform(frame,ets)
+    s=np.concatenate((rs,vs),axis=0).T[...,None]
+    result=(M@s)[...,0].T
+    return result[:3],result[3:]
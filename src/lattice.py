@@ -0,0 +1,131 @@
+"""
+The reticle marks on a Ranger A or B image form a regular lattice. We describe
+each mark by its integer lattice coordinates, and fit an affine matrix which
+takes lattice coordinates to image coordinates.
+
+The fit is linear in the six unknown matrix elements, so we solve it in closed
+form with linear least squares rather than with a general minimizer. The
+solution is done with stacked arrays, so that the reticle points of every TAB
+of a channel can be fit in one call.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+# Lattice coordinates of the reticle marks used for each mission and channel. The first
+# tuple is the x (horizontal) coordinates of each column of marks, the second is the y
+# (vertical, downward) coordinates of each row. Marks are numbered left to right along
+# each row, then top to bottom.
+lattice_config={7:{"A":((-2,-1,0,1,2),(-1,0,1,2)),
+                   "B":((-2,-1,0,1,2),(-1,0,1,2))},
+                8:{"A":((-2,-1,0,1,2),(-1,0,1,2)),
+                   "B":((-2,-1,0,1,2),(-1,0,1,2))}}
+
+
+def get_lattice(mission:int,channel:str)->list[tuple[int,int]]:
+    """
+    Get the lattice coordinates of each reticle mark
+
+    :param mission: Mission number, IE 7=Ranger 7, etc.
+    :param channel: Either A, B, or P
+    :return: List of (x,y) lattice coordinates, in the same order as the reticle
+             points from get_manual_reticle()
+    """
+    xlattice,ylattice=lattice_config[mission][channel]
+    n_lattice=len(xlattice)*len(ylattice)
+    lattice=[None]*n_lattice
+    for i_y, y in enumerate(ylattice):
+        for i_x, x in enumerate(xlattice):
+            i = i_y * len(xlattice) + i_x
+            lattice[i]=(x,y)
+    return lattice
+
+
+lattice_fit_tuple=namedtuple('lattice_fit_tuple','M_im_lat,residuals,inliers')
+
+
+def _solve(design:np.ndarray,points:np.ndarray,weights:np.ndarray)->np.ndarray:
+    """
+    Weighted linear least squares for a stack of problems which share a design matrix
+
+    :param design: Design matrix, shape [n,3], one row [x,y,1] per lattice point
+    :param points: Observed image points, shape [...,n,2]
+    :param weights: Weight of each point, shape [...,n]. Zero means ignore the point.
+    :return: Matrix M_im_lat, shape [...,3,3]
+    """
+    # Normal equations: (A^T W A) p = A^T W b, with one 3x3 system per stack
+    # element, shared between the x and y rows of the matrix.
+    AtWA=np.einsum('ni,...n,nj->...ij',design,weights,design)
+    AtWb=np.einsum('ni,...n,...nk->...ik',design,weights,points)
+    rows=np.linalg.solve(AtWA,AtWb)
+    M=np.zeros(points.shape[:-2]+(3,3))
+    M[...,0:2,:]=np.swapaxes(rows,-1,-2)
+    M[...,2,2]=1
+    return M
+
+
+def fit_lattice(reticle_points:np.ndarray,lattice:np.ndarray,*,
+                reject_sigma:float=3.0,reject_floor:float=1.0,
+                min_inliers:int=6,max_iter:int=5)->lattice_fit_tuple:
+    """
+    Find the best-fit affine matrix which maps lattice coordinates to reticle image
+    coordinates, rejecting marks which don't fit.
+
+    :param reticle_points: Image coordinates of the reticle marks, shape [n,2] for one
+                           image or [n_tab,n,2] for a whole channel. Points which are NaN
+                           (not found) are ignored.
+    :param lattice: Lattice coordinates of each mark, shape [n,2], IE from get_lattice()
+    :param reject_sigma: A mark is rejected if its residual is more than this many times
+                         the robust RMS residual of the marks in the current fit.
+    :param reject_floor: Never reject a mark with a residual smaller than this many pixels.
+                         This keeps a near-perfect fit from rejecting marks which are off
+                         by only roundoff.
+    :param min_inliers: Stop rejecting marks when only this many are left
+    :param max_iter: Maximum number of fit-and-reject passes
+    :return: lattice_fit_tuple of:
+      * M_im_lat - Matrix which transforms [x,y,1] lattice coordinates to image coordinates,
+                   shape [3,3] (or [n_tab,3,3])
+      * residuals - Distance in pixels from each mark to where the fit puts it, shape [n]
+                    (or [n_tab,n]). Rejected marks still get a residual, marks which
+                    were not found get NaN.
+      * inliers - True for each mark used in the final fit, same shape as residuals
+
+    If the data were perfect, we would have for each lattice point
+    [a b c][x] [xd]
+    [d e f][y]=[yd]
+    [0 0 1][1] [1 ]
+    where xd, yd are the image coordinates of the reticle points. The top two rows
+    are independent linear problems in (a,b,c) and (d,e,f) with the same design
+    matrix, so each is solved by the normal equations.
+
+    Outliers are rejected by iteratively reweighted fitting. After each fit, the
+    RMS residual is estimated robustly from the median residual, and any mark
+    further away than reject_sigma times this is given zero weight in the next fit.
+    A single bad correlation therefore no longer pulls the whole frame out of
+    alignment.
+    """
+    points=np.asarray(reticle_points,dtype=np.float64)
+    lattice=np.asarray(lattice,dtype=np.float64)
+    design=np.hstack((lattice,np.ones((lattice.shape[0],1))))
+    found=np.all(np.isfinite(points),axis=-1)
+    inliers=found
+    points=np.where(found[...,None],points,0.0)
+    for i_iter in range(max_iter):
+        M=_solve(design,points,inliers.astype(np.float64))
+        residuals=np.linalg.norm(np.einsum('...ij,nj->...ni',M[...,0:2,:],design)-points,axis=-1)
+        if i_iter==max_iter-1:
+            break
+        masked=np.where(inliers,residuals,np.nan)
+        # The residuals are 2D distances, so for normally distributed errors they follow
+        # a Rayleigh distribution, whose RMS is 1.2011 times its median.
+        sigma=1.2011*np.nanmedian(masked,axis=-1,keepdims=True)
+        # Judge every found mark against the current fit, so that a good mark which was
+        # thrown out while a bad one was still pulling the fit around can come back.
+        new_inliers=found & (residuals<=np.maximum(reject_sigma*sigma,reject_floor))
+        # Don't take away so many marks that the fit is poorly determined
+        new_inliers=np.where(np.sum(new_inliers,axis=-1,keepdims=True)>=min_inliers,new_inliers,inliers)
+        if np.array_equal(new_inliers,inliers):
+            break
+        inliers=new_inliers
+    residuals=np.where(found,residuals,np.nan)
+    return lattice_fit_tuple(M_im_lat=M,residuals=residuals,inliers=inliers)
@@ -0,0 +1,184 @@
+"""
+Streaming pipeline of stages connected by bounded queues.
+
+Each stage is a function applied to every item flowing through the pipeline,
+run by its own pool of threads. Stages are connected by queues with a fixed
+maximum size, so a fast stage can only get a few items ahead of the slow stage
+after it before it blocks (backpressure), and the number of items in flight,
+and therefore the memory in use, stays bounded.
+
+Threads are the right tool here because the heavy lifting in each of our
+stages (file I/O, JPEG decode, PNG encode, NumPy and FFT work) releases the
+GIL, so the stages really do run at the same time.
+
+Each stage keeps counters of how many items it processed, and how long its
+threads spent working, waiting for input (starved), and waiting for room in
+the next queue (blocked). The stage with the most busy time per thread and
+the least starved time is the bottleneck.
+"""
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Stage:
+    """
+    One stage of a pipeline
+
+    :param name: Name of the stage, for the statistics report
+    :param func: Function to apply to each item. Takes one item and returns one item.
+    :param n_threads: Number of threads running this stage
+    :param maxsize: Maximum number of items waiting in the queue feeding this stage
+    """
+    name:str
+    func:Callable
+    n_threads:int=1
+    maxsize:int=4
+    n_items:int=0
+    busy:float=0.0
+    starved:float=0.0
+    blocked:float=0.0
+    lock:threading.Lock=field(default_factory=threading.Lock,repr=False)
+
+    def report(self,wall:float)->str:
+        """
+        :param wall: Wall-clock time the pipeline has been running
+        :return: One line summary of this stage's counters
+        """
+        rate=self.n_items/wall if wall>0 else 0.0
+        return (f"{self.name:>10s}: {self.n_items:5d} items, {rate:7.2f}/s, "
+                f"busy {self.busy:8.2f}s, starved {self.starved:8.2f}s, blocked {self.blocked:8.2f}s "
+                f"over {self.n_threads:2d} threads")
+
+
+# Longest time a thread waits on a queue before checking whether the pipeline was cancelled
+_poll=0.1
+
+
+class _Done:
+    """
+    End-of-stream marker
+    """
+
+
+class _Failed:
+    """
+    Carries an exception from a worker thread to the consumer
+    """
+    def __init__(self,exc:BaseException):
+        self.exc=exc
+
+
+def run_pipeline(source:Iterable,stages:list[Stage],*,report_every:float=None)->Iterator:
+    """
+    Run items from source through each stage in turn.
+
+    :param source: Items to feed to the first stage. Consumed by a separate thread,
+                   so it may itself be slow (IE reading a directory).
+    :param stages: Stages to run, in order
+    :param report_every: If set, print the statistics of every stage this often, in seconds
+    :return: Generator of items coming out of the last stage. Items are *not* necessarily
+             in the same order they went in, when any stage has more than one thread.
+
+    If any stage raises an exception, the exception is re-raised out of this generator,
+    once every thread has stopped. The same happens if the generator is closed early.
+    """
+    queues=[queue.Queue(maxsize=stage.maxsize) for stage in stages]+[queue.Queue(maxsize=stages[-1].maxsize)]
+    cancel=threading.Event()
+    t0=time.perf_counter()
+    last_report=t0
+
+    # Every thread waits on its queues in short slices, so that once the pipeline is
+    # cancelled, none of them is left blocked on a queue that nobody will ever touch again.
+    def put(q:queue.Queue,item)->bool:
+        while not cancel.is_set():
+            try:
+                q.put(item,timeout=_poll)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q:queue.Queue):
+        while not cancel.is_set():
+            try:
+                return q.get(timeout=_poll)
+            except queue.Empty:
+                pass
+        return _Done
+
+    def feed():
+        try:
+            for item in source:
+                if not put(queues[0],item):
+                    return
+        except BaseException as e:
+            put(queues[-1],_Failed(e))
+        for _ in range(stages[0].n_threads):
+            put(queues[0],_Done)
+
+    def work(i_stage:int,remaining:list[int]):
+        stage=stages[i_stage]
+        q_in,q_out=queues[i_stage],queues[i_stage+1]
+        while True:
+            t_wait=time.perf_counter()
+            item=get(q_in)
+            t_start=time.perf_counter()
+            if item is _Done:
+                break
+            try:
+                result=stage.func(item)
+            except BaseException as e:
+                q_out=queues[-1]
+                result=_Failed(e)
+            t_end=time.perf_counter()
+            if not put(q_out,result):
+                return
+            t_put=time.perf_counter()
+            with stage.lock:
+                stage.n_items+=1
+                stage.starved+=t_start-t_wait
+                stage.busy+=t_end-t_start
+                stage.blocked+=t_put-t_end
+        # The last thread of this stage to finish passes the end-of-stream on
+        with stage.lock:
+            remaining[0]-=1
+            last=remaining[0]==0
+        if last:
+            n_next=stages[i_stage+1].n_threads if i_stage+1<len(stages) else 1
+            for _ in range(n_next):
+                put(q_out,_Done)
+
+    threads=[threading.Thread(target=feed,daemon=True)]
+    for i_stage,stage in enumerate(stages):
+        remaining=[stage.n_threads]
+        threads+=[threading.Thread(target=work,args=(i_stage,remaining),daemon=True)
+                  for _ in range(stage.n_threads)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            try:
+                item=queues[-1].get(timeout=report_every)
+            except queue.Empty:
+                item=None
+            if report_every is not None and time.perf_counter()-last_report>=report_every:
+                last_report=time.perf_counter()
+                for stage in stages:
+                    print(stage.report(last_report-t0))
+            if item is None:
+                continue
+            if item is _Done:
+                break
+            if isinstance(item,_Failed):
+                raise item.exc
+            yield item
+    finally:
+        # On an error, or if the consumer stops early, stop every thread before going
+        # on. Each one finishes the item it is working on, then drops everything else.
+        cancel.set()
+        for thread in threads:
+            thread.join()
@@ -4,18 +4,19 @@ Process the terminal trajectory as listed in
 We will focus on Camera A first.
 
 """
-from collections import namedtuple
 from datetime import datetime, timezone
-from typing import Iterable
 
 import numpy as np
 from bmw import su_to_cu, gauss, kepler
-from kwanmath.geodesy import llr2xyz, ray_sphere_intersect
-from kwanmath.vector import vcross, vlength, vdecomp
+from kwanmath.vector import vlength, vdecomp
 from matplotlib import pyplot as plt
-from spiceypy import furnsh, gdpool, sxform
+from spiceypy import furnsh, gdpool
 
+from ephemeris import get_ephemeris
+from frames import fit_frame, transform_states
 from gmt import tdb, calc_et
+from propagator import three_body_accel, propagate
+from tables import load_table, apply_offsets
 
 furnsh('kernels/Ranger7Background.tm')
 
@@ -24,9 +25,6 @@ furnsh('kernels/Ranger7Background.tm')
 mu_moon =gdpool("BODY301_GM",0,1)[0]  #DE431 value of gravitational parameter of Moon in km and s
 mu_earth=gdpool("BODY399_GM",0,1)[0] #DE431 value of gravitational parameter of Earth in km and s
 
-# third basis vector
-zhat=np.array([[0],[0],[1]])
-
 # Documented Ranger 7 impact points. All seem to be in Mean-Earth-Pole coordinates
 # From Image A, last row (value is actually from point 1 from the previous row, 2.5s before impact)
 # lat: -10.630   lon: -20.588   r: 1735.455   GMT: 1961-Jul-31 13:25:48.799
@@ -49,49 +47,65 @@ TrajLLR=(-10.693,-20.676,1735.600)
 r_moon=ImageALLR[2]
 
 
-image_a_tuple = namedtuple('image_a_tuple',
-                           'TAB, POD,Timp    ,alt       ,ssc_lat,ssc_lon,v    ,pth    ,az     ,pt1_lat,pt1_lon,pt1_srange,pt2_lat,pt2_lon,pt2_srange,p18_lat,p18_lon,p18_srange')
 timp_r7 = datetime(year=1964, month=7, day=31,
                    hour=13, minute=25, second=48, microsecond=799_000,
                    tzinfo=timezone.utc).astimezone(tdb)
 etimp_r7 = calc_et(timp_r7)
 
 
-def readImageA(latofs: float = 0.0, lonofs: float = 0.0, rofs: float = 0.0) -> list[image_a_tuple]:
+def readImageA(latofs: float = 0.0, lonofs: float = 0.0, rofs: float = 0.0) -> np.recarray:
     """
     Read the Image A table.
 
+    :param float latofs: offset in latitude to subtract from all latitudes in the file.
     :param float lonofs: offset in longitude to subtract from all longitudes in the file. This is used to make the trajectory
                          match a given impact longitude from another source.
-    :rtype: list of namedtuple
+    :param float rofs: offset to subtract from all altitudes in the file.
+    :return: Record array with one record per row of the table. Each column is also a
+             whole array, IE image_a.pt1_lat, see tables.load_table().
+    """
+    return apply_offsets(load_table("terminal_7a"), latofs=latofs, lonofs=lonofs, rofs=rofs)
+
+
+def _llr_stack(lat: np.ndarray, lon: np.ndarray, r: float | np.ndarray = 1.0) -> np.ndarray:
+    """
+    Convert columns of latitude and longitude to a stack of vectors
+
+    :param lat: Latitudes in degrees, shape n
+    :param lon: Longitudes in degrees, shape n
+    :param r: Length of each vector, either a scalar or shape n
+    :return: Stack of vectors, shape 3xn. Same as llr2xyz(deg=True) on each row.
+    """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return r * np.stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+def _ray_sphere_intersect_stack(r: np.ndarray, vbar: np.ndarray, r_sphere: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Intersect a stack of rays with a sphere centered on the origin
+
+    :param r: Ray origins, shape 3xn
+    :param vbar: Ray directions, unit vectors, shape 3xn
+    :param r_sphere: Radius of sphere
+    :return: Tuple of the distance along each ray to its nearer intersection, shape n, and the
+             intersection points, shape 3xn. Rays which miss the sphere get NaN.
+
+    Same as ray_sphere_intersect() on each column. The intersection is where
+    |r+t*vbar|**2=r_sphere**2, a quadratic in t with leading coefficient 1 since vbar is a unit vector.
     """
-    result = []
-
-    with open('tables/terminal_7a.csv', 'rt') as inf:
-        # Read the header line
-        header = [field.strip() for field in inf.readline().strip().split(",")]
-        # Read the rows
-        for line in inf:
-            row = line.strip().split(",")
-            values = {}
-            for name, value in zip(header, row):
-                this_value = int(value) if name == "TAB" else float(value)
-                if "lat" in name:
-                    this_value -= latofs
-                if "lon" in name:
-                    this_value -= lonofs
-                if name == "alt":
-                    this_value -= rofs
-                values[name] = this_value
-            result.append(image_a_tuple(**values))
-    return result
-
-
-def processImageA(image_a: Iterable[image_a_tuple], plot: bool = False) -> tuple[np.array, np.array]:
+    b = np.sum(r * vbar, axis=0)
+    c = np.sum(r * r, axis=0) - r_sphere ** 2
+    disc = b ** 2 - c
+    t = -b - np.sqrt(np.where(disc >= 0, disc, np.nan))
+    return t, r + t * vbar
+
+
+def processImageA(image_a: np.recarray, plot: bool = False) -> tuple[np.array, np.array]:
     """
     Convert Image A table to usable state vectors, and calculate the check values
 
-    :param array of namedtuple image_a: Rows from original table, n elements
+    :param image_a: Table from readImageA(), n rows
     :param bool plot: If true, plot the check value residuals
     :return: First element is stack of position vectors in Moon-fixed mean-earth-polar frame, shape 3xn
              Second element is stack of velocity vectors in same frame, shape 3xn
@@ -142,78 +156,51 @@ def processImageA(image_a: Iterable[image_a_tuple], plot: bool = False) -> tuple
     10m drew my attention, and any larger than 20m indicated a transcription error, which was corrected.
 
     """
-    n = len(image_a)
-    rs_mep = np.zeros((3, n), np.float64)
-    vs_mep = np.zeros((3, n), np.float64)
+    # Every quantity below is a whole column of the table at once. Vectors are stacks of shape 3xn, one column per row
+    # of the table, and scalars are arrays of shape n.
+    alt = image_a.alt
+    # Zenith vector
+    rbar = _llr_stack(image_a.ssc_lat, image_a.ssc_lon)
+    # Position in selenocentric moon-fixed mean-earth/pole coordinates
+    rs_mep = rbar * (alt + r_moon)
+    # Size of 1 millidegree of latitude at the current spacecraft altitude. This is an idea of the precision we can expect
+    # in using vectors with latitudes and longitudes specified in millidegree precision.
+    mds = (alt + r_moon) * np.pi * 2.0 / 360000.0
+    # East vector, zhat x rbar normalized. Since rbar is a unit vector, that is just the unit vector along the
+    # direction of increasing longitude.
+    lon = np.radians(image_a.ssc_lon)
+    ebar = np.stack((-np.sin(lon), np.cos(lon), np.zeros_like(lon)))
+    # North vector
+    nbar = np.cross(rbar, ebar, axis=0)
+    # Velocity in selenocentric moon-fixed mean-earth/pole coordinates. The topocentric direction has the flight path
+    # angle as its latitude and the azimuth measured clockwise from north, so its components are east, north, zenith.
+    (vbare, vbarn, vbarr) = _llr_stack(image_a.pth, 90 - image_a.az)
+    vbar = vbarr * rbar + vbare * ebar + vbarn * nbar
+    vs_mep = vbar * image_a.v
     # dsrange2 is the difference between the table slant range to point 2 and that calculated from the spacecraft lat/lon/alt
     # and point 2 lat/lon
-    dsrange2s = np.zeros(n, np.float64)
+    p2 = _llr_stack(image_a.pt2_lat, image_a.pt2_lon, r=r_moon)
+    dsrange2s = image_a.pt2_srange - np.linalg.norm(rs_mep - p2, axis=0)
     # dsrange1a is the difference between the table slant range to point 1 and that calculated from the spacecraft lat/lon/alt
-    dsrange1as = np.zeros(n, np.float64)
+    p1a = _llr_stack(image_a.pt1_lat, image_a.pt1_lon, r=r_moon)
+    dsrange1as = image_a.pt1_srange - np.linalg.norm(rs_mep - p1a, axis=0)
     # dsrange1b is the difference between the table slant range to point 1 and that calculated from the spacecraft pos/vel
     # and the quadratic method (quadratic parameter t is the calculated distance between the ray origin and the ray/sphere
-    # intersect point)
-    dsrange1bs = np.zeros(n, np.float64)
+    # intersect point). Since vbar is a unit vector, and r is measured in units of km, t has units of km itself,
+    # and is therefore directly comparable to p1_srange.
+    (t, p1c) = _ray_sphere_intersect_stack(rs_mep, vbar, r_moon)
+    dsrange1bs = image_a.pt1_srange - t
     # dsrange1c is the distance between the table point 1 calculated from lat/lon and that calculated by the quadratic
     # method. This isn't a difference in srange like the others are, but it is measured in the same units. However, dsrange1c
     # will always be positive, while the other measures can be positive or negative.
-    dsrange1cs = np.zeros(n, np.float64)
+    dsrange1cs = np.linalg.norm(p1c - p1a, axis=0)
+    ts = etimp_r7 - image_a.Timp
     # dv is the difference between the table velocity and that calculated by dividing the distance from the previous row's
-    # position to this row's position by the difference in time. Keep track of last row position in r_last, use constant
-    # 5.12s as dt. Note that this will be biased from zero because it doesn't take into account the acceleration of gravity
-    # over the time step.
-    dvs = np.zeros(n, np.float64)
-    dvs[0] = float('NaN')
-    r_last = None
-    # Size of 1 millidegree of latitude at the current spacecraft altitude. This is an idea of the precision we can expect
-    # in using vectors with latitudes and longitudes specified in millidegree precision.
-    mds = np.zeros(n, dtype=np.float64)
-    ts = np.zeros(n, dtype=np.float64)
-    for i, row in enumerate(image_a):
-        # Zenith vector
-        rbar = llr2xyz(lat=row.ssc_lat, lon=row.ssc_lon, deg=True)
-        # Position in selenocentric moon-fixed mean-earth/pole coordinates
-        r = rbar * (row.alt + r_moon)
-        mds[i] = (row.alt + r_moon) * np.pi * 2.0 / 360000.0
-        rs_mep[:, None, i] = r
-        # East vector
-        e = vcross(zhat, rbar)
-        ebar = e / vlength(e)
-        # North vector
-        nbar = vcross(rbar, ebar)
-        # Velocity in selenocentric moon-fixed mean-earth/pole coordinates
-        vbar_topo = llr2xyz(lat=row.pth, lon=90 - row.az, deg=True)
-        (vbare, vbarn, vbarr) = vdecomp(vbar_topo)
-        vbar = vbarr * rbar + vbare * ebar + vbarn * nbar
-        v = vbar * row.v
-        vs_mep[:, None, i] = v
-        # p2 position
-        p2 = llr2xyz(lat=row.pt2_lat, lon=row.pt2_lon, deg=True, r=r_moon)
-        pt2_srange_calc = vlength(r-p2)
-        dsrange2 = row.pt2_srange - pt2_srange_calc
-        dsrange2s[i] = dsrange2
-        # p1 position from table
-        p1a = llr2xyz(lat=row.pt1_lat, lon=row.pt1_lon, deg=True, r=r_moon)
-        p1a_srange_calc = vlength(r-p1a)
-        dsrange1a = row.pt1_srange - p1a_srange_calc
-        dsrange1as[i] = dsrange1a
-        # p1 position from velocity vector
-        (t, p1c) = ray_sphere_intersect(r, vbar, r_moon)
-        # Since vbar is a unit vector, and r is measured in units of km, t has units of km itself,
-        # and is therefore directly comparable to p1_srange.
-        dsrange1b = row.pt1_srange - t
-        dsrange1bs[i] = dsrange1b
-        dsrange1c = vlength(p1c-p1a)
-        dsrange1cs[i] = dsrange1c
-        # Calculate velocity from last row
-        ts[i] = etimp_r7 - row.Timp
-        if r_last is not None:
-            dt = ts[-1] - ts[-2]
-            dr = vlength(r - r_last)
-            dv = dr / dt - row.v
-            dvs[i] = dv
-        r_last = r
-        # print(row.GMT, gmt, etcal(gmt), mjd,tai_utc,tai,et, etcal(et))
+    # position to this row's position by the difference in time between those two rows. The first row has no previous
+    # row, so its dv is NaN. Note that this will be biased from zero because it doesn't take into account the acceleration
+    # of gravity over the time step.
+    dvs = np.full(len(ts), np.nan)
+    dvs[1:] = np.linalg.norm(np.diff(rs_mep, axis=1), axis=0) / np.diff(ts) - image_a.v[1:]
 
     if plot:
         # This plot is meant to duplicate the residual plot on the spreadsheet
@@ -245,19 +232,10 @@ def convertImageACanonical(rs_a_mep:np.ndarray, vs_a_mep:np.ndarray, ets_a:np.nd
       * Velocity vectors in same frame
       * Time from initial state in canonical time units.
     """
-    n=len(ets_a)
-    rcus_a_mcetod=np.zeros((3,n))
-    vcus_a_mcetod=np.zeros((3,n))
-    tcus         =np.zeros(   n )
-    for i in range(n):
-        r_a_mep= rs_a_mep[:, None, i]
-        v_a_mep= vs_a_mep[:, None, i]
-        et_a=ets_a[i]
-        M_mcetod_mep=sxform("IAU_MOON","ECI_TOD",et_a)
-        s_a_mep=np.concatenate((r_a_mep,v_a_mep))
-        s_a_mcetod=M_mcetod_mep @ s_a_mep
-        rcus_a_mcetod[:,None,i]=su_to_cu(s_a_mcetod[0:3],r_moon,mu_moon,1, 0)
-        vcus_a_mcetod[:,None,i]=su_to_cu(s_a_mcetod[3:6],r_moon,mu_moon,1,-1)
+    frame=fit_frame("IAU_MOON","ECI_TOD",np.min(ets_a),np.max(ets_a))
+    rs_a_mcetod,vs_a_mcetod=transform_states(frame,ets_a,rs_a_mep,vs_a_mep)
+    rcus_a_mcetod=su_to_cu(rs_a_mcetod,r_moon,mu_moon,1, 0)
+    vcus_a_mcetod=su_to_cu(vs_a_mcetod,r_moon,mu_moon,1,-1)
     tcus=su_to_cu(ets_a-ets_a[0],r_moon,mu_moon,0, 1)
     return rcus_a_mcetod, vcus_a_mcetod, tcus
 
@@ -382,6 +360,13 @@ def main():
     (rs_kepler_cua_mcetod,vs_kepler_cua_mcetod)=wrap_kepler(rs_cua_mcetod[:,None,0],v0_gauss_cua_mcetod,ts_cua)
     plt.figure(0)
     plot_residuals(rs_kepler_cua_mcetod,vs_kepler_cua_mcetod,rs_cua_mcetod,vs_cua_mcetod,ts_cua,subplot=211,title='Kepler propagation')
+
+    #Same initial state, but with the tide from the Earth
+    earth=get_ephemeris('399')
+    accel=three_body_accel(earth,et0=ts_a[0],r_moon=r_moon,mu_moon=mu_moon,mu_earth=mu_earth)
+    (rs_3b_cua_mcetod,vs_3b_cua_mcetod)=propagate(rs_cua_mcetod[:,None,0],v0_gauss_cua_mcetod,ts_cua,accel=accel)
+    plt.figure(1)
+    plot_residuals(rs_3b_cua_mcetod,vs_3b_cua_mcetod,rs_cua_mcetod,vs_cua_mcetod,ts_cua,subplot=211,title='Three-body propagation')
     plt.show()
 
 
@@ -0,0 +1,111 @@
+"""
+Propagate a trajectory around the Moon, including the tide from the Earth.
+
+The propagation is one adaptive integration with the 8th-order Dormand-Prince
+method (DOP853 in scipy.integrate.solve_ivp), which picks its own steps to meet
+the tolerance, and keeps a dense output: an interpolant valid everywhere along the
+integration with the same order of accuracy as the steps themselves. The cost is
+then set by the dynamics and the tolerance, not by how many times the trajectory
+is wanted at. The 200 TAB times, a thousand points for a plot, or one for each
+scanline all come from the same integration.
+
+Everything here is in lunar canonical units, where the distance unit is the
+radius of the Moon, the time unit is such that the gravitational parameter of
+the Moon is 1, and time is counted from the initial state, the same as with
+bmw.kepler(). propagate() has the (r0,v0,ts)->(rs,vs) signature of wrap_kepler(),
+so it can be passed anywhere that is.
+
+The gravity of the Earth is a tide: the difference between its pull on the
+spacecraft and on the Moon, since the frame is centered on the Moon. The position
+of the Earth comes from an ephemeris fit (see ephemeris.py), so nothing here
+calls Spice.
+"""
+from collections.abc import Callable
+
+import numpy as np
+from scipy.integrate import solve_ivp
+
+from ephemeris import ephemeris_tuple, ephemeris_position
+
+
+def two_body_accel(t:float,r:np.ndarray)->np.ndarray:
+    """
+    Acceleration from the Moon alone, in canonical units
+
+    :param t: Time in canonical units, not used
+    :param r: Position vector in canonical units, shape 3
+    :return: Acceleration vector in canonical units, shape 3
+    """
+    return -r/np.linalg.norm(r)**3
+
+
+def three_body_accel(earth:ephemeris_tuple,*,et0:float,r_moon:float,mu_moon:float,
+                     mu_earth:float)->Callable[[float,np.ndarray],np.ndarray]:
+    """
+    Make the acceleration function for the Moon plus the tide of the Earth
+
+    :param earth: Fit of the position of the Earth relative to the Moon, from fit_ephemeris()
+                  or load_ephemeris(), in the same frame as the trajectory
+    :param et0: Spice ET of the initial state, IE canonical time zero
+    :param r_moon: Canonical distance unit, in km
+    :param mu_moon: Gravitational parameter of the Moon, in km**3/s**2
+    :param mu_earth: Gravitational parameter of the Earth, in km**3/s**2
+    :return: Function which takes canonical time and position, and returns acceleration,
+             with the same signature as two_body_accel()
+    """
+    tu=np.sqrt(r_moon**3/mu_moon)
+    mu_ratio=mu_earth/mu_moon
+    def accel(t:float,r:np.ndarray)->np.ndarray:
+        r_earth=ephemeris_position(earth,[et0+t*tu])[:,0]/r_moon
+        dr_earth=r-r_earth
+        # Pull of the Earth on the spacecraft, less its pull on the Moon
+        return (two_body_accel(t,r)
+                -mu_ratio*dr_earth/np.linalg.norm(dr_earth)**3
+                -mu_ratio*r_earth/np.linalg.norm(r_earth)**3)
+    return accel
+
+
+def dense_trajectory(r0:np.ndarray,v0:np.ndarray,t1:float,*,accel:Callable[[float,np.ndarray],np.ndarray]=two_body_accel,
+                     rtol:float=1e-12,atol:float=1e-12)->Callable[[np.ndarray],np.ndarray]:
+    """
+    Integrate a trajectory once, and keep its dense output
+
+    :param r0: Initial position in canonical units, shape 3 or 3x1
+    :param v0: Initial velocity in canonical units, same shape as r0
+    :param t1: End time of integration in canonical units. May be negative, to integrate backwards.
+    :param accel: Acceleration function, IE two_body_accel() or from three_body_accel()
+    :param rtol: Relative tolerance of each step
+    :param atol: Absolute tolerance of each step, in canonical units
+    :return: Function which takes an array of n times between 0 and t1, and returns the
+             state vectors (position and velocity) at each time, shape 6xn
+    """
+    def f(t:float,y:np.ndarray)->np.ndarray:
+        return np.concatenate((y[3:],accel(t,y[:3])))
+    y0=np.concatenate((np.ravel(r0),np.ravel(v0))).astype(np.float64)
+    sol=solve_ivp(f,(0.0,t1),y0,method='DOP853',dense_output=True,rtol=rtol,atol=atol)
+    if not sol.success:
+        raise RuntimeError(f"Propagation failed: {sol.message}")
+    return sol.sol
+
+
+def propagate(r0:np.ndarray,v0:np.ndarray,ts:np.ndarray,*,accel:Callable[[float,np.ndarray],np.ndarray]=two_body_accel,
+              rtol:float=1e-12,atol:float=1e-12)->tuple[np.ndarray,np.ndarray]:
+    """
+    Evaluate a trajectory at many times, with one integration each way from the initial state
+
+    :param r0: Initial position in canonical units, shape 3 or 3x1
+    :param v0: Initial velocity in canonical units, same shape as r0
+    :param ts: Times to evaluate at, in canonical units from the initial state, any order
+    :param accel: Acceleration function, IE two_body_accel() or from three_body_accel()
+    :param rtol: Relative tolerance, passed to dense_trajectory()
+    :param atol: Absolute tolerance, passed to dense_trajectory()
+    :return: Tuple of position and velocity vectors at each time, each shape 3xn
+    """
+    ts=np.asarray(ts,dtype=np.float64)
+    result=np.zeros((6,len(ts)))
+    result[:,ts==0]=np.concatenate((np.ravel(r0),np.ravel(v0)))[:,None]
+    for side in (ts<0,ts>0):
+        if np.any(side):
+            t1=ts[side][np.argmax(np.abs(ts[side]))]
+            result[:,side]=dense_trajectory(r0,v0,t1,accel=accel,rtol=rtol,atol=atol)(ts[side])
+    return result[:3],result[3:]
@@ -0,0 +1,117 @@
+"""
+Manifest of rectified images, so that auto_rectify only redoes the TABs
+which actually need it.
+
+Each channel folder in rect_images/ gets a manifest.json, which records for
+each TAB everything that went into making its rectified image: the hash of
+the raw image, the key of the TAB 1 setup (TAB 1 image and manual reticle
+clicks) it was registered against, and the version of the rectification
+algorithm. It also records what came out: the reticle positions found, the
+fitted matrix M_im1_imn, and the lattice fit residuals. If none of the inputs
+changed and the output image is still there, the TAB can be skipped.
+"""
+import hashlib
+import json
+import os
+from tempfile import NamedTemporaryFile
+
+import numpy as np
+
+
+def manifest_path(mission:int,channel:str)->str:
+    return f"rect_images/{mission:1d}{channel}/manifest.json"
+
+
+def setup_key(tab1_hash:str,manual_tab1_reticle:list[tuple[float,float]],distortion:str=None)->str:
+    """
+    Make a key which changes whenever the TAB 1 setup changes
+
+    :param tab1_hash: Hash of the TAB 1 raw image
+    :param manual_tab1_reticle: Reticle points clicked on TAB 1
+    :param distortion: Kind of distortion model fit to each TAB, if any. None leaves the
+                       key of an affine-only setup the same as it always was.
+    :return: Hex digest identifying this setup
+    """
+    h=hashlib.sha256(tab1_hash.encode())
+    h.update(json.dumps([[float(x),float(y)] for x,y in manual_tab1_reticle]).encode())
+    if distortion is not None:
+        h.update(distortion.encode())
+    return h.hexdigest()
+
+
+def load_manifest(path:str)->dict:
+    """
+    Load a manifest
+
+    :param path: Manifest filename
+    :return: Manifest dictionary, with TAB records keyed by integer TAB number.
+             If there is no manifest yet, an empty one.
+    """
+    try:
+        with open(path,"rt") as inf:
+            manifest=json.load(inf)
+    except FileNotFoundError:
+        return {"tabs":{}}
+    # JSON only has string keys
+    manifest["tabs"]={int(tab):record for tab,record in manifest["tabs"].items()}
+    return manifest
+
+
+def save_manifest(path:str,manifest:dict):
+    """
+    Write a manifest, atomically so that an interrupted run never leaves a broken one.
+
+    :param path: Manifest filename
+    :param manifest: Manifest dictionary
+    """
+    with NamedTemporaryFile("wt",dir=os.path.dirname(path),suffix=".tmp",delete=False) as ouf:
+        json.dump(manifest,ouf,indent=1)
+    os.replace(ouf.name,path)
+
+
+def _floats(values:np.ndarray)->list:
+    """
+    Convert an array of floats to nested lists. JSON can't represent NaN, so values
+    which aren't finite (IE marks which weren't found) become null.
+    """
+    values=np.asarray(values,dtype=np.float64)
+    if values.ndim==0:
+        return None if not np.isfinite(values) else float(values)
+    return [_floats(v) for v in values]
+
+
+def make_record(*,input_hash:str,setup_key:str,pipeline_version:int,
+                reticle:np.ndarray,M_im1_imn:np.ndarray,
+                residuals:np.ndarray,inliers:np.ndarray,confidence:np.ndarray)->dict:
+    """
+    Make the manifest record for one TAB
+
+    :return: Dictionary of plain JSON-able values
+    """
+    return {"input_hash":input_hash,
+            "setup_key":setup_key,
+            "pipeline_version":pipeline_version,
+            "reticle":_floats(reticle),
+            "M_im1_imn":np.asarray(M_im1_imn).tolist(),
+            "residuals":_floats(residuals),
+            "inliers":[bool(i) for i in inliers],
+            "confidence":_floats(confidence)}
+
+
+def is_current(record:dict|None,*,input_hash:str,setup_key:str,pipeline_version:int,oufn:str|None)->bool:
+    """
+    Check if a TAB needs to be redone
+
+    :param record: Manifest record for this TAB, or None if there isn't one
+    :param input_hash: Hash of the raw image now
+    :param setup_key: Key of the TAB 1 setup now
+    :param pipeline_version: Version of the rectification algorithm now
+    :param oufn: Rectified image filename, or None if the output isn't a separate file
+    :return: True if the record matches all of the current inputs and the output
+             image exists, so the TAB can be skipped.
+    """
+    return (record is not None
+            and record["input_hash"]==input_hash
+            and record["setup_key"]==setup_key
+            and record["pipeline_version"]==pipeline_version
+            and (oufn is None or os.path.exists(oufn)))
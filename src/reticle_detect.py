@@ -0,0 +1,169 @@
+"""
+Find the reticle marks in TAB 1 automatically, instead of having someone click them.
+
+This is done in two steps:
+
+* Matched filter -- Correlate the whole frame against each distinct synthetic
+  reticle mask, with one FFT of the frame. The correlation is normalized, so
+  the response doesn't depend on how bright or contrasty the scene is around
+  each mark, and one threshold on it works for every mark and every frame. A
+  real mark responds at about 0.7, while the scene away from the marks stays
+  below about 0.1.
+* Lattice assignment -- The peaks alone can't be trusted to say which mark is
+  which, since many marks share the same mask, and craters and the frame edge
+  make peaks of their own. Instead, we know that the marks lie on the lattice
+  from lattice.lattice_config. We try many random hypotheses, each made by taking
+  three marks, guessing which of the strongest peaks of their masks they are, and
+  solving for the affine matrix M_im_lat which puts those three marks on those
+  three peaks. Each hypothesis is scored by how strongly every mark's own mask
+  responds where the hypothesis puts that mark. The winner is then refined by
+  looking for the peak of each mark near where the lattice puts it, and fitting
+  the lattice again.
+
+The result takes the place of the clicks from get_manual_reticle(), so a new
+mission or channel can be set up without anyone at the screen.
+"""
+from collections import namedtuple
+
+import numpy as np
+from scipy.ndimage import maximum_filter
+
+from correlate import prepare_templates, cross_images, subpixel_peaks
+from lattice import fit_lattice
+
+reticle_detect_tuple=namedtuple('reticle_detect_tuple','points,confidence,M_im_lat')
+
+
+def match_masks(img:np.ndarray,masks:np.ndarray)->tuple[np.ndarray,np.ndarray]:
+    """
+    Correlate a whole image against every distinct reticle mask
+
+    :param img: Image with dark reticle marks on a brighter scene, shape [rows,cols]
+    :param masks: Synthetic mask of each reticle mark, bright mark on a dark
+                  background, shape [n,mask_rows,mask_cols]
+    :return: Tuple of:
+      * Normalized correlation of each distinct mask, shape [n_distinct,rows,cols].
+        Pixel [y,x] is the response to the mask with its center pixel
+        [mask_rows//2,mask_cols//2] on image pixel [y,x].
+      * Index into the responses of the mask used by each mark, shape [n]
+    """
+    masks=np.asarray(masks)
+    distinct,mask_index=np.unique(masks,axis=0,return_inverse=True)
+    # Invert so the marks are bright like the masks. The correlation is normalized, so
+    # that bright or contrasty terrain doesn't respond more strongly than the marks do.
+    img=255-np.asarray(img,dtype=np.float64)
+    responses=cross_images(img,prepare_templates(distinct,img.shape),normalized=True)
+    return responses,mask_index.ravel()
+
+
+def find_peaks(response:np.ndarray,n_peaks:int,min_distance:int)->np.ndarray:
+    """
+    Find the strongest separate peaks of a response image
+
+    :param response: Response image, shape [rows,cols]
+    :param n_peaks: Number of peaks to find
+    :param min_distance: Peaks must be at least this far apart, in pixels
+    :return: Integer (x,y) of each peak, strongest first, shape [n_peaks,2]. There may
+             be fewer if the image doesn't have that many.
+    """
+    is_max=(response==maximum_filter(response,size=2*min_distance+1))
+    rows,cols=np.nonzero(is_max)
+    order=np.argsort(response[rows,cols])[::-1][:n_peaks]
+    return np.stack((cols[order],rows[order]),axis=1)
+
+
+def detect_reticle(img:np.ndarray,masks:np.ndarray,lattice:np.ndarray,*,
+                   n_candidates:int=6,n_trials:int=4000,search_r:int=10,
+                   min_response:float=0.3,min_found:int=6,
+                   seed:int=3217)->reticle_detect_tuple:
+    """
+    Find the reticle marks of an image automatically
+
+    :param img: Image with dark reticle marks, IE the scaled TAB 1 image
+    :param masks: Synthetic mask of each reticle mark, IE from get_synthetic_masks()
+    :param lattice: Lattice coordinates of each mark, shape [n,2], IE from get_lattice()
+    :param n_candidates: Number of strongest peaks of each mask which a mark may
+                         be on in a hypothesis
+    :param n_trials: Number of random hypotheses to try
+    :param search_r: Once the lattice is known, look this far around where it puts
+                     each mark for that mark's peak
+    :param min_response: Marks whose normalized correlation peak is weaker than this
+                         are not trusted, and are placed where the fit lattice puts them
+    :param min_found: Least number of trusted marks for the detection to succeed
+    :param seed: Random seed for the hypotheses, so that the result is repeatable
+    :return: reticle_detect_tuple of:
+      * points - (x,y) image coordinates of each mark, shape [n,2]
+      * confidence - Normalized correlation of each mark's mask at its point, shape [n]
+      * M_im_lat - Matrix which transforms lattice coordinates to image coordinates
+    :raises ValueError: if not enough marks could be found
+    """
+    masks=np.asarray(masks)
+    lattice=np.asarray(lattice,dtype=np.float64)
+    n=len(lattice)
+    mask_r=masks.shape[1]//2
+    responses,mask_index=match_masks(img,masks)
+    _,rows,cols=responses.shape
+    candidates=[find_peaks(response,n_candidates,mask_r) for response in responses]
+    design=np.hstack((lattice,np.ones((n,1))))
+
+    def lookup(points:np.ndarray)->np.ndarray:
+        # Response of each mark's own mask at points, shape [...,n,2]. Zero off the image.
+        xi=np.round(points[...,0]).astype(int)
+        yi=np.round(points[...,1]).astype(int)
+        inside=(xi>=0)&(xi<cols)&(yi>=0)&(yi<rows)
+        values=responses[np.broadcast_to(mask_index,xi.shape),np.clip(yi,0,rows-1),np.clip(xi,0,cols-1)]
+        return np.where(inside,values,0.0)
+
+    # Make all of the hypotheses at once. Each one picks three different marks, and
+    # a candidate peak of each mark's mask.
+    rng=np.random.default_rng(seed)
+    marks=np.argsort(rng.random((n_trials,n)),axis=1)[:,:3]
+    picks=rng.random((n_trials,3))
+    sample=np.zeros((n_trials,3,2))
+    for j in range(3):
+        for i_mask,cands in enumerate(candidates):
+            use=mask_index[marks[:,j]]==i_mask
+            sample[use,j]=cands[(picks[use,j]*len(cands)).astype(int)]
+    A=design[marks]
+    # Three marks on one lattice line can't determine the matrix
+    ok=np.abs(np.linalg.det(A))>0.5
+    rows_M=np.zeros((n_trials,3,2))
+    rows_M[ok]=np.linalg.solve(A[ok],sample[ok])
+    # The marks must be at least a mask apart, which also throws out hypotheses that
+    # pile several marks onto the same peak.
+    det_M=rows_M[:,0,0]*rows_M[:,1,1]-rows_M[:,0,1]*rows_M[:,1,0]
+    ok&=np.abs(det_M)>=(2*mask_r)**2
+    predicted=np.einsum('nj,tjk->tnk',design,rows_M)
+    # The normalized correlation is at most 1, so one very strong peak can't outvote
+    # the rest of the marks
+    scores=np.where(ok,np.sum(np.clip(lookup(predicted),0,None),axis=1),-np.inf)
+    best=int(np.argmax(scores))
+    if not np.isfinite(scores[best]):
+        raise ValueError("No usable reticle hypothesis")
+
+    # Refine, by finding the peak of each mark's own mask near where the lattice puts it
+    M=np.eye(3)
+    M[0:2,:]=rows_M[best].T
+    for i_pass in range(2):
+        predicted=(design@M[0:2,:].T)
+        centers=np.round(predicted).astype(int)
+        r=search_r
+        dy,dx=np.mgrid[-r:r+1,-r:r+1]
+        ys=np.clip(centers[:,1,None,None]+dy,0,rows-1)
+        xs=np.clip(centers[:,0,None,None]+dx,0,cols-1)
+        patches=responses[mask_index[:,None,None],ys,xs]
+        i_peak=patches.reshape(n,-1).argmax(axis=1)
+        peaks=np.stack(np.unravel_index(i_peak,patches.shape[1:]),axis=1)
+        confidence=patches[np.arange(n),peaks[:,0],peaks[:,1]]
+        # Peaks are (row,col) in the patches, points are (x,y) in the image
+        points=(subpixel_peaks(patches,peaks)-r)[:,::-1]+centers
+        trusted=np.where((confidence>=min_response)[:,None],points,np.nan)
+        if np.sum(confidence>=min_response)<min_found:
+            raise ValueError(f"Only found {np.sum(confidence>=min_response)} reticle marks, need {min_found}")
+        fit=fit_lattice(trusted,lattice)
+        M=fit.M_im_lat
+    predicted=design@M[0:2,:].T
+    # Anything not trusted goes where the lattice says it should be
+    points=np.where(fit.inliers[:,None],points,predicted)
+    confidence=np.where(fit.inliers,confidence,lookup(predicted))
+    return reticle_detect_tuple(points=points,confidence=confidence,M_im_lat=M)
@@ -0,0 +1,107 @@
+"""
+Track the reticle lattice from one TAB to the next.
+
+The camera drifts smoothly from frame to frame, so once we have fit the lattice
+in a few TABs, we can predict quite well where the marks will be in the next
+one. This lets us search much smaller boxes around the predicted marks, rather
+than wide boxes around the TAB 1 clicks.
+
+The state being tracked is the six parameters of the matrix M_imn_lat, which
+takes lattice coordinates to image coordinates. Each parameter is tracked by its
+own alpha-beta filter, which is the steady-state form of a Kalman filter with a
+constant-velocity model. TAB numbers are the time coordinate, so skipped or
+missing TABs are handled naturally.
+
+The tracker also keeps a running average of the RMS residual of the lattice fits.
+The real reticle marks are never exactly on a lattice, so the residual of even a
+perfect match is not zero. A tracked search is judged to have failed when its
+residual spikes well above this usual level.
+"""
+import numpy as np
+
+
+class ReticleTracker:
+    """
+    Constant-velocity predictor of the lattice matrix of a channel
+
+    :param alpha: Fraction of the prediction error applied to the position
+    :param beta: Fraction of the prediction error applied to the velocity
+    :param min_history: Number of TABs that must have been seen before predicting
+    :param rms_gain: Weight of each new fit in the running average RMS residual
+    """
+    def __init__(self,*,alpha:float=0.85,beta:float=0.3,min_history:int=2,rms_gain:float=0.2):
+        self.alpha=alpha
+        self.beta=beta
+        self.min_history=min_history
+        self.rms_gain=rms_gain
+        self.typical_rms=None
+        self.tab=None
+        self.x=None
+        self.v=np.zeros(6)
+        self.n_seen=0
+        self.n_tracked=0
+        self.n_fallback=0
+
+    def predict(self,tab:int)->np.ndarray|None:
+        """
+        Predict the lattice matrix of a TAB
+
+        :param tab: TAB number. Should be after any TAB already seen.
+        :return: Predicted matrix M_imn_lat, or None if there isn't enough history yet
+        """
+        if self.n_seen<self.min_history:
+            return None
+        M=np.eye(3)
+        M[0:2,:]=(self.x+self.v*(tab-self.tab)).reshape(2,3)
+        return M
+
+    def update(self,tab:int,M_imn_lat:np.ndarray,rms:float=None,*,tracked:bool=False):
+        """
+        Feed the fitted lattice matrix of a TAB to the tracker
+
+        :param tab: TAB number
+        :param M_imn_lat: Fitted matrix which takes lattice coordinates to this TAB's
+                          image coordinates
+        :param rms: RMS residual of the inliers of the fit, if known
+        :param tracked: True if the fit came from a search around the prediction of
+                        this tracker, and so counts in n_tracked
+        """
+        if tracked:
+            self.n_tracked+=1
+        if rms is not None and np.isfinite(rms):
+            if self.typical_rms is None:
+                self.typical_rms=rms
+            else:
+                self.typical_rms+=self.rms_gain*(rms-self.typical_rms)
+        z=np.asarray(M_imn_lat)[0:2,:].ravel()
+        if self.x is None:
+            self.x=z
+        elif self.n_seen==1:
+            # Second point, start the velocity off as the difference
+            self.v=(z-self.x)/(tab-self.tab)
+            self.x=z
+        else:
+            dt=tab-self.tab
+            x_pred=self.x+self.v*dt
+            r=z-x_pred
+            self.x=x_pred+self.alpha*r
+            self.v=self.v+self.beta*r/dt
+        self.tab=tab
+        self.n_seen+=1
+
+    def is_spike(self,rms:float,max_excess:float)->bool:
+        """
+        Check if the residual of a fit is suspiciously high
+
+        :param rms: RMS residual of the inliers of the fit
+        :param max_excess: How far above the usual RMS residual is too far, in pixels
+        :return: True if rms is more than max_excess above the usual level
+        """
+        return self.typical_rms is not None and rms>self.typical_rms+max_excess
+
+    def fall_back(self):
+        """
+        Count a TAB whose search around the prediction failed, and which was searched
+        for in full instead. Its result is still fed in with update() as usual.
+        """
+        self.n_fallback+=1
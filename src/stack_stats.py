@@ -0,0 +1,178 @@
+"""
+Per-pixel statistics over time of a rectified frame stack, and the blemish mask
+made from them.
+
+Every frame of a stack has been warped so that its reticle marks land on those of
+TAB 1. The reticle is part of the vidicon tube, so anything else which is part of
+the tube (burned-in spots, dust, the residue left where the reticle marks were
+patched) stays put from frame to frame too, while the lunar surface streams past
+underneath as the spacecraft falls. Over the whole stack, then, the median of each
+pixel is a smooth blur of the surface everywhere except where something is stuck
+to the tube, and that is how the blemishes are found: wherever the median stands
+out from its own smoothed self, or the pixel hardly changes while its neighbours do.
+
+A stack is several hundred megabytes, and the median needs every frame of a pixel
+at once, so the statistics are done a chunk of rows at a time. Each chunk reads
+the same few rows of every frame out of the memory-mapped stack, which are
+contiguous in each frame, so memory use depends on the chunk size and the number
+of frames, never on the whole stack. The chunks are independent, so they are
+spread over a pool of worker processes, each of which maps the stack for itself.
+
+Pixels which are exactly zero are where the warp fell off the edge of the raw
+image (see warp.affine_warp()), and don't count.
+
+Run it from the root of the repository on a channel whose frame stack has been
+written by auto_rectify --output stack:
+
+python src/stack_stats.py 7A
+"""
+from argparse import ArgumentParser
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.ndimage import median_filter, binary_dilation
+
+from frame_stack import load_stack
+
+stack_stats_tuple=namedtuple('stack_stats_tuple','median,mean,var,min,max,count')
+
+
+def blemish_path(mission:int,channel:str)->str:
+    return f"rect_images/{mission:1d}{channel}/blemish.npz"
+
+
+def chunk_stats(frames:np.ndarray)->stack_stats_tuple:
+    """
+    Statistics over time of each pixel of a chunk of a stack
+
+    :param frames: Chunk of frames, shape [n_tab,rows,cols]
+    :return: stack_stats_tuple of float32 arrays, shape [rows,cols]. Pixels which are
+             zero in every frame have a count of 0 and NaN statistics.
+    """
+    chunk=np.asarray(frames,dtype=np.float32)
+    chunk[chunk==0]=np.nan
+    count=np.sum(np.isfinite(chunk),axis=0)
+    covered=count>0
+    result={}
+    for name,func in (("median",np.nanmedian),("mean",np.nanmean),("var",np.nanvar),
+                      ("min",np.nanmin),("max",np.nanmax)):
+        stat=np.full(chunk.shape[1:],np.nan,dtype=np.float32)
+        stat[covered]=func(chunk[:,covered],axis=0)
+        result[name]=stat
+    return stack_stats_tuple(count=count.astype(np.int32),**result)
+
+
+def _stack_chunk_stats(mission:int,channel:str,row0:int,row1:int)->stack_stats_tuple:
+    """
+    Statistics of one chunk of rows of a channel's stack. This is the unit of work in
+    the worker processes, which each map the stack for themselves.
+    """
+    return chunk_stats(load_stack(mission,channel).frames[:,row0:row1,:])
+
+
+def stack_stats(mission:int,channel:str,*,chunk_rows:int=32,n_workers:int=None)->stack_stats_tuple:
+    """
+    Statistics over time of each pixel of a channel's frame stack
+
+    :param mission: Mission number, IE 7=Ranger 7, etc.
+    :param channel: Either A, B, or P
+    :param chunk_rows: Number of rows of every frame to work on at once. Each chunk takes
+                       about 4*chunk_rows*cols*n_tab bytes in a worker.
+    :param n_workers: Number of worker processes. Default is one per CPU. Pass 1 to do
+                      everything in this process without a pool.
+    :return: stack_stats_tuple of the median, mean, variance, minimum, and maximum of each
+             pixel over all frames where it is covered, and the number of such frames,
+             each shape [rows,cols]
+    """
+    rows=load_stack(mission,channel).frames.shape[1]
+    bounds=[(row0,min(row0+chunk_rows,rows)) for row0 in range(0,rows,chunk_rows)]
+    if n_workers==1:
+        chunks=[_stack_chunk_stats(mission,channel,row0,row1) for row0,row1 in bounds]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures=[pool.submit(_stack_chunk_stats,mission,channel,row0,row1) for row0,row1 in bounds]
+            chunks=[future.result() for future in futures]
+    return stack_stats_tuple(*[np.concatenate(parts,axis=0) for parts in zip(*chunks)])
+
+
+def _background(img:np.ndarray,size:int)->np.ndarray:
+    """
+    Local background of an image, which anything smaller than half the window doesn't
+    affect. This is a median filter along the rows and then along the columns, which is
+    many times faster than a full 2D median filter of the same size.
+    """
+    return median_filter(median_filter(img,size=(1,size)),size=(size,1))
+
+
+def blemish_mask(stats:stack_stats_tuple,*,smooth_r:int=10,threshold:float=6.0,
+                 var_fraction:float=0.1,min_count:int=5,grow_r:int=1)->np.ndarray:
+    """
+    Find the pixels which are stuck to the tube rather than moving with the surface
+
+    :param stats: Statistics from stack_stats()
+    :param smooth_r: Radius of the median filter which gives the local background of the
+                     median image. Should be bigger than the biggest blemish.
+    :param threshold: A pixel is a blemish if its median stands out from the background
+                      by more than this many times the robust RMS of that difference
+                      over the whole frame.
+    :param var_fraction: A pixel is also a blemish if its variance over time is less than
+                         this fraction of the local typical variance, IE it doesn't change
+                         while the surface around it does.
+    :param min_count: Pixels covered by fewer frames than this can't be judged, and are
+                      never called blemishes
+    :param grow_r: Grow the mask by this many pixels, to cover the soft edges of each blemish
+    :return: Boolean mask, shape [rows,cols], True for bad pixels. Later stages should skip
+             these pixels, or give them little weight.
+    """
+    judged=stats.count>=min_count
+    # Fill the pixels that can't be judged with something bland, so they don't disturb the filters
+    median=np.where(judged,stats.median,np.nanmedian(stats.median[judged]))
+    var=np.where(judged,stats.var,np.nanmedian(stats.var[judged]))
+    size=2*smooth_r+1
+    excess=median-_background(median,size)
+    # 1.4826*MAD is the RMS of normally distributed data
+    sigma=1.4826*np.median(np.abs(excess[judged]))
+    mask=np.abs(excess)>threshold*max(sigma,1e-3)
+    mask|=var<var_fraction*_background(var,size)
+    mask&=judged
+    if grow_r>0:
+        mask=binary_dilation(mask,iterations=grow_r)
+    return mask
+
+
+def save_blemish(mission:int,channel:str,stats:stack_stats_tuple,mask:np.ndarray):
+    """
+    Write the statistics and blemish mask of a channel to rect_images/
+    """
+    np.savez(blemish_path(mission,channel),mask=mask,**stats._asdict())
+
+
+def load_blemish_mask(mission:int,channel:str)->np.ndarray:
+    """
+    Read the blemish mask of a channel, written by save_blemish()
+
+    :return: Boolean mask, shape [rows,cols], True for bad pixels
+    """
+    with np.load(blemish_path(mission,channel)) as blemish:
+        return blemish["mask"]
+
+
+def main():
+    parser=ArgumentParser(description="Find the blemishes of each channel from the statistics of its frame stack")
+    parser.add_argument("channels",nargs="+",help="Mission and channel to process, IE 7A 7B 8A 8B")
+    parser.add_argument("--workers",type=int,default=None,help="Number of worker processes, default is one per CPU")
+    parser.add_argument("--chunk-rows",dest="chunk_rows",type=int,default=32,help="Rows of each frame to read at once")
+    parser.add_argument("--threshold",type=float,default=6.0,help="Blemish threshold, in robust standard deviations")
+    args=parser.parse_args()
+    for arg in args.channels:
+        mission,channel=int(arg[:-1]),arg[-1]
+        stats=stack_stats(mission,channel,chunk_rows=args.chunk_rows,n_workers=args.workers)
+        mask=blemish_mask(stats,threshold=args.threshold)
+        save_blemish(mission,channel,stats,mask)
+        print(f"{mission:1d}{channel}: {np.sum(mask)} blemish pixels ({100*np.mean(mask):.2f}%), "
+              f"{np.sum(stats.count==0)} pixels never covered")
+
+
+if __name__=="__main__":
+    main()
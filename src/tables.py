@@ -0,0 +1,89 @@
+"""
+Load the transcribed mission tables in tables/ as whole columns.
+
+Every table there is a CSV file with one header line of column names, and the
+fields padded with spaces to line up. Each is loaded into a NumPy record array,
+so that a column is one array (table.pt1_lat, or table["pt1_lat"]) for
+vectorized math, and a row still reads like the namedtuple rows this code used
+to build one field at a time (table[i].pt1_lat).
+
+Each column is converted in one go: integer if every field is an integer, float
+if every field is a number, and otherwise left as a string (IE the GMT time
+stamps). The parsed array is kept in a binary sidecar cache, keyed by a hash of
+the content of the CSV, so editing a table automatically misses the cache and
+it is parsed again.
+"""
+import numpy as np
+
+from frame_cache import cached_array, file_hash
+
+default_table_cache_dir="scratch/table_cache"
+
+
+def table_path(name:str)->str:
+    return f"tables/{name}.csv"
+
+
+def parse_table(fn:str)->np.ndarray:
+    """
+    Parse a table, without the cache
+
+    :param fn: Filename of CSV table
+    :return: Structured array, one field for each column, named from the header
+    """
+    with open(fn,"rt") as inf:
+        names=[name.strip() for name in inf.readline().split(",")]
+    fields=np.char.strip(np.loadtxt(fn,delimiter=",",skiprows=1,dtype=str,ndmin=2))
+    columns=[]
+    for i_col in range(len(names)):
+        column=fields[:,i_col]
+        for dtype in (np.int64,np.float64):
+            try:
+                column=column.astype(dtype)
+                break
+            except ValueError:
+                pass
+        columns.append(column)
+    result=np.empty(len(fields),dtype=[(name,column.dtype) for name,column in zip(names,columns)])
+    for name,column in zip(names,columns):
+        result[name]=column
+    return result
+
+
+def load_table(name:str,*,cache_dir:str=default_table_cache_dir)->np.recarray:
+    """
+    Load a table from tables/, through the sidecar cache
+
+    :param name: Name of table, IE terminal_7a for tables/terminal_7a.csv
+    :param cache_dir: Cache folder. If None, always parse the CSV.
+    :return: Read-only record array, one record per row of the table
+    """
+    fn=table_path(name)
+    if cache_dir is None:
+        table=parse_table(fn)
+    else:
+        table=cached_array(f"{file_hash(fn)}_table",lambda:parse_table(fn),cache_dir=cache_dir)
+    return table.view(np.recarray)
+
+
+def apply_offsets(table:np.ndarray,*,latofs:float=0.0,lonofs:float=0.0,rofs:float=0.0)->np.recarray:
+    """
+    Subtract offsets from every latitude, longitude, and altitude column of a table
+
+    :param table: Table from load_table()
+    :param latofs: Offset to subtract from every column with lat in its name
+    :param lonofs: Offset to subtract from every column with lon in its name
+    :param rofs: Offset to subtract from the alt column
+    :return: New record array with the offsets applied. The original is unchanged.
+
+    This is used to make a trajectory match a given impact point from another source.
+    """
+    result=np.array(table).view(np.recarray)
+    for name in result.dtype.names:
+        if "lat" in name:
+            result[name]-=latofs
+        if "lon" in name:
+            result[name]-=lonofs
+        if name=="alt":
+            result[name]-=rofs
+    return result
@@ -0,0 +1,155 @@
+"""
+Affine resampling of images, done a block of rows at a time so that we never
+need a full-size coordinate array for either the input or the output.
+
+The full-size LPI scans are several thousand pixels on a side. Building a
+coordinate stack for every pixel and then sampling it with
+scipy.interpolate.RegularGridInterpolator needs many times the memory of the
+image itself, all in float64. Here we compute the source coordinate of each
+output pixel on the fly for one block of output rows, sample the input with a
+bilinear kernel, and write the result straight into the output array.
+"""
+import numpy as np
+
+
+def default_block_rows(cols:int,block_pixels:int=1<<18)->int:
+    """
+    Pick a number of output rows per block such that each block has roughly
+    block_pixels pixels. This keeps the float64 coordinate temporaries for one
+    block down to a few megabytes no matter how wide the output is.
+
+    :param cols: Width of the output
+    :param block_pixels: Rough number of pixels in each block
+    :return: Number of rows in each block, at least 1
+    """
+    return max(1,block_pixels//max(cols,1))
+
+
+def bilinear_sample(img:np.ndarray,xs:np.ndarray,ys:np.ndarray,*,fill:float=0)->np.ndarray:
+    """
+    Sample an image at arbitrary (fractional) pixel coordinates with a bilinear kernel
+
+    :param img: Image to sample, shape [rows,cols] or [rows,cols,channels]
+    :param xs: Horizontal (column) coordinate of each sample point. Any shape.
+    :param ys: Vertical (row) coordinate of each sample point. Same shape as xs.
+    :param fill: Value to use for sample points outside of the image
+    :return: float32 array of samples, same shape as xs (plus the channel axis if img has one)
+
+    This matches RegularGridInterpolator(...,bounds_error=False,fill_value=fill)
+    on a grid of integer pixel coordinates: a point is inside the image if
+    0<=x<=cols-1 and 0<=y<=rows-1, and is linearly interpolated between the
+    four surrounding pixel centers.
+    """
+    rows,cols=img.shape[:2]
+    flat=img.reshape((rows*cols,)+img.shape[2:])
+    inside=(xs>=0)&(xs<=cols-1)&(ys>=0)&(ys<=rows-1)
+    # Clip so that x0+1 and y0+1 are always valid indexes. A point exactly on the
+    # right or bottom edge then lands at fx=1 or fy=1 on the last pixel pair.
+    x0=np.clip(np.floor(xs),0,max(cols-2,0)).astype(np.intp)
+    y0=np.clip(np.floor(ys),0,max(rows-2,0)).astype(np.intp)
+    fx=(xs-x0).astype(np.float32)
+    fy=(ys-y0).astype(np.float32)
+    dx=1 if cols>1 else 0
+    dy=cols if rows>1 else 0
+    i00=y0*cols+x0
+    if img.ndim>2:
+        fx=fx[...,None]
+        fy=fy[...,None]
+    p00=flat[i00   ].astype(np.float32)
+    p01=flat[i00+dx].astype(np.float32)
+    p10=flat[i00+dy].astype(np.float32)
+    p11=flat[i00+dy+dx].astype(np.float32)
+    top=p00+(p01-p00)*fx
+    bot=p10+(p11-p10)*fx
+    result=top+(bot-top)*fy
+    if img.ndim>2:
+        inside=inside[...,None]
+    return np.where(inside,result,np.float32(fill))
+
+
+def _to_dtype(block:np.ndarray,dtype:np.dtype)->np.ndarray:
+    """
+    Convert a block of float32 samples to the output dtype, rounding and
+    saturating if the output is an integer type.
+    """
+    if np.issubdtype(dtype,np.integer):
+        info=np.iinfo(dtype)
+        return np.clip(np.rint(block),info.min,info.max).astype(dtype)
+    return block.astype(dtype,copy=False)
+
+
+def affine_warp(img:np.ndarray,M_to_from:np.ndarray,*,output_shape:tuple[int,int]=None,
+                dtype:np.dtype=np.float32,block_rows:int=None,fill:float=0,
+                out:np.ndarray=None)->np.ndarray:
+    """
+    Perform an affine transform on an image, one block of output rows at a time.
+
+    :param img: Image to transform, shape [rows,cols] or [rows,cols,channels]
+    :param M_to_from: 3x3 matrix which transforms a coordinate [x,y,1] in the *from*
+                      (input) image to the corresponding coordinate in the *to* (output)
+                      image. Same convention as auto_rectify.transform_image().
+    :param output_shape: Shape (rows,cols) of output image. Default is same as input.
+    :param dtype: Output pixel type. Integer types are rounded and saturated, so
+                  np.uint8 gives a ready-to-save 8-bit image.
+    :param block_rows: Number of output rows to compute at once. Default is enough
+                       rows to make about a quarter-megapixel per block.
+    :param fill: Value for output pixels which map to outside the input image
+    :param out: Optional preallocated output array, which must have the right shape
+                and dtype. Useful for writing directly into a memory-mapped stack.
+    :return: Transformed image
+    """
+    if output_shape is None:
+        output_shape=img.shape[:2]
+    rows,cols=output_shape
+    if out is None:
+        out=np.empty((rows,cols)+img.shape[2:],dtype=dtype)
+    # Coordinates of each output pixel in input space. We will sample the input image at each point.
+    M_from_to=np.linalg.inv(M_to_from)
+    (a,b,c),(d,e,f)=M_from_to[0,:],M_from_to[1,:]
+    outx=np.arange(cols,dtype=np.float64)
+    # Parts of the source coordinate which only depend on the column
+    xfrom_x=a*outx
+    yfrom_x=d*outx
+    if block_rows is None:
+        block_rows=default_block_rows(cols)
+    for row0 in range(0,rows,block_rows):
+        row1=min(row0+block_rows,rows)
+        outy=np.arange(row0,row1,dtype=np.float64)[:,None]
+        xfrom=xfrom_x+(b*outy+c)
+        yfrom=yfrom_x+(e*outy+f)
+        out[row0:row1]=_to_dtype(bilinear_sample(img,xfrom,yfrom,fill=fill),out.dtype)
+    return out
+
+
+def remap(img:np.ndarray,map_xy:np.ndarray,*,M_src_map:np.ndarray=None,dtype:np.dtype=np.float32,
+          block_rows:int=None,fill:float=0,out:np.ndarray=None)->np.ndarray:
+    """
+    Resample an image through a precomputed warp map, one block of output rows at a time.
+
+    :param img: Image to sample, shape [rows,cols] or [rows,cols,channels]
+    :param map_xy: Warp map, shape [2,out_rows,out_cols]. map_xy[:,y,x] is the (x,y)
+                   coordinate which output pixel [y,x] samples, IE from distortion.warp_map().
+                   May be a memory map, since only one block of rows is read at a time.
+    :param M_src_map: Optional 3x3 matrix which transforms a coordinate in the space of
+                      the map to the matching coordinate in img. This lets one map be
+                      used for any resolution of the same image. Default is the identity.
+    :param dtype: Output pixel type, same as affine_warp()
+    :param block_rows: Number of output rows to compute at once, same as affine_warp()
+    :param fill: Value for output pixels which map to outside the input image
+    :param out: Optional preallocated output array, same as affine_warp()
+    :return: Resampled image, shape [out_rows,out_cols] (plus the channel axis if img has one)
+    """
+    rows,cols=map_xy.shape[1:]
+    if out is None:
+        out=np.empty((rows,cols)+img.shape[2:],dtype=dtype)
+    if block_rows is None:
+        block_rows=default_block_rows(cols)
+    for row0 in range(0,rows,block_rows):
+        row1=min(row0+block_rows,rows)
+        xs=map_xy[0,row0:row1].astype(np.float64)
+        ys=map_xy[1,row0:row1].astype(np.float64)
+        if M_src_map is not None:
+            (a,b,c),(d,e,f)=M_src_map[0,:],M_src_map[1,:]
+            xs,ys=a*xs+b*ys+c,d*xs+e*ys+f
+        out[row0:row1]=_to_dtype(bilinear_sample(img,xs,ys,fill=fill),out.dtype)
+    return out
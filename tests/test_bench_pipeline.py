@@ -0,0 +1,18 @@
+import numpy as np
+
+from auto_rectify import batch_rectify, get_manual_reticle
+from bench_pipeline import make_synthetic_channel, registration_error
+
+
+def test_synthetic_registration(tmp_path,monkeypatch):
+    # Rectify a few synthetic frames end to end, and check that the registration
+    # recovers the known distortion of each one.
+    monkeypatch.chdir(tmp_path)
+    (tmp_path/"rect_images").mkdir()
+    synth=make_synthetic_channel(7,"A",4,scale=1.5)
+    results=batch_rectify(((7,"A"),),n_workers=1)[(7,"A")]
+    assert sorted(results)==synth.tabs
+    M_im1_imn=np.stack([results[tab].M_im1_imn for tab in synth.tabs])
+    error=registration_error(M_im1_imn,synth.M_imn_im1,np.array(get_manual_reticle(7,"A",None)))
+    assert np.all(error<0.2)
+    assert (tmp_path/"rect_images"/"7A"/"Rect7A004.png").exists()
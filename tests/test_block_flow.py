@@ -0,0 +1,109 @@
+from functools import partial
+
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+import block_flow
+from block_flow import tile_centers, fit_expansion, stack_flow, project_pinhole, table_foe
+from fourier_mellin import similarity_about
+from tables import load_table
+from warp import affine_warp
+
+
+@pytest.mark.parametrize("scale,rotation",[(1.08,0.01),(1.01,-0.003)])
+def test_stack_flow(scale,rotation):
+    # Zoom in on a random surface about a fixed point, frame after frame. The first
+    # zoom moves the corners of the frame much further than the search box.
+    rng=np.random.default_rng(1964)
+    surface=gaussian_filter(rng.normal(size=(700,700)),2)+0.5*gaussian_filter(rng.normal(size=(700,700)),8)
+    foe=(250.0,290.0)
+    M_step=similarity_about(scale,rotation,foe)
+    frames=[]
+    M=np.eye(3)
+    for _ in range(4):
+        frames.append(affine_warp(surface,M,output_shape=(600,600)))
+        M=M_step@M
+    flow,fit=stack_flow(np.stack(frames),chunk=2)
+    assert flow.flow.shape==(3,len(flow.centers),2)
+    assert np.allclose(fit.scale,scale,atol=1e-3)
+    assert np.allclose(fit.rotation,rotation,atol=1e-3)
+    assert np.allclose(fit.foe,foe,atol=1.0 if scale>1.05 else 3.0)
+    # Nearly every tile which stays in the frame should be found
+    assert np.all(np.sum(fit.inliers,axis=1)>0.9*np.sum(flow.psr>0,axis=1))
+
+
+def test_stack_flow_blank_frame():
+    # A frame with nothing in it can't be fit against either neighbour, but doesn't
+    # spoil the pairs around it
+    rng=np.random.default_rng(1965)
+    surface=gaussian_filter(rng.normal(size=(500,500)),2)
+    M_step=similarity_about(1.02,0.0,(200.0,200.0))
+    frames=[]
+    M=np.eye(3)
+    for _ in range(4):
+        frames.append(affine_warp(surface,M,output_shape=(400,400)))
+        M=M_step@M
+    frames[2][:]=0
+    frames=np.stack(frames)
+    flow,fit=stack_flow(frames,chunk=2)
+    assert np.isfinite(fit.scale[0])
+    assert np.all(np.isnan(fit.scale[1:]))
+    assert not np.any(fit.inliers[1:])
+
+
+def test_project_pinhole():
+    # A camera looking along a tilted axis, with the picture rotated a little
+    rng=np.random.default_rng(7)
+    R=np.linalg.qr(rng.normal(size=(3,3)))[0]
+    R*=np.sign(np.linalg.det(R))
+    f=900.0
+    pix0=np.array((560.0,480.0))
+    theta=0.02
+    rot=np.array([[np.cos(theta),-np.sin(theta)],[np.sin(theta),np.cos(theta)]])
+
+    def picture(uv):
+        return pix0+f*(rot@uv)
+
+    def direction(uv):
+        return R@np.array((uv[0],uv[1],1.0))*rng.uniform(500,800)
+    uvs=[np.array((0.0,0.0)),np.array((0.5,0.0)),np.array((0.3,-0.1)),np.array((-0.2,0.25))]
+    dirs=np.array([direction(uv) for uv in uvs])
+    n=len(uvs)-2
+    pix=project_pinhole(dirs[2:],np.tile(dirs[0],(n,1)),np.tile(dirs[1],(n,1)),picture(uvs[0]),picture(uvs[1]))
+    assert np.allclose(pix,[picture(uv) for uv in uvs[2:]])
+
+
+def test_table_foe(tmp_path,monkeypatch):
+    # Point 1 of Ranger 7 is inside the frame, to the right of the center mark, and
+    # moves only a little from one TAB to the next
+    monkeypatch.setattr(block_flow,"load_table",partial(load_table,cache_dir=str(tmp_path)))
+    M_im1_lat=np.array([[246.0,1.0,565.0],[-0.5,245.0,478.0],[0,0,1]])
+    tabs=np.arange(1,200)
+    foe=table_foe(7,"A",tabs,M_im1_lat)
+    assert np.all((foe>0)&(foe<1150))
+    assert np.all(foe[:,0]>565)
+    assert np.max(np.linalg.norm(np.diff(foe,axis=0),axis=-1))<10
+
+
+def test_fit_expansion_outliers():
+    centers=tile_centers((400,500),16,40).astype(float)
+    M=np.stack([similarity_about(1.05,0.02,(200,150)),similarity_about(0.98,0.0,(-50,300))])
+    flow=np.einsum('nij,mj->nmi',M[:,0:2,0:2],centers)+M[:,None,0:2,2]-centers
+    valid=np.ones(flow.shape[:2],dtype=bool)
+    flow[0,::7]+=(30,-20)
+    valid[1,3]=False
+    flow[1,3]=np.nan
+    fit=fit_expansion(centers,flow,valid)
+    assert np.allclose(fit.M_next_prev,M,atol=1e-9)
+    assert not np.any(fit.inliers[0,::7])
+    assert not fit.inliers[1,3]
+    assert np.allclose(fit.foe,[(200,150),(-50,300)])
+
+
+def test_tile_centers():
+    centers=tile_centers((100,130),10,20)
+    assert np.all(centers-10>=0)
+    assert np.all(centers[:,0]+10<=130)
+    assert np.all(centers[:,1]+10<=100)
+    assert len(centers)==5*6
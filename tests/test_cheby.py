@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from cheby import cheby_sample_times, fit_cheby, eval_cheby, cheby_check_times
+
+
+def f(t):
+    return np.stack((np.sin(t/1000),np.cos(t/3000)+t/1e4),axis=-1)
+
+
+def df(t):
+    return np.stack((np.cos(t/1000)/1000,-np.sin(t/3000)/3000+1e-4),axis=-1)
+
+
+def test_fit_cheby():
+    breaks,ts=cheby_sample_times(100.0,20100.0,n_seg=4,degree=14)
+    assert breaks.shape==(5,)
+    assert ts.shape==(4,15)
+    assert np.all(np.diff(ts.ravel())>0)
+    model=fit_cheby(breaks,f(ts))
+    assert model.coef.shape==(4,15,2)
+    check=cheby_check_times(model)
+    assert np.max(np.abs(eval_cheby(model,check)-f(check)))<1e-10
+    assert np.max(np.abs(eval_cheby(model,check,deriv=1)-df(check)))<1e-12
+    # Segment boundaries and both ends of the span
+    assert np.allclose(eval_cheby(model,breaks),f(breaks),atol=1e-10)
+    # Any shape of times
+    assert eval_cheby(model,check.reshape(-1,4)).shape==(len(check)//4,4,2)
+
+
+def test_eval_outside():
+    breaks,ts=cheby_sample_times(0.0,10.0,n_seg=1,degree=3)
+    model=fit_cheby(breaks,ts**2)
+    assert np.allclose(eval_cheby(model,[2.0,3.0]),[4.0,9.0])
+    with pytest.raises(ValueError):
+        eval_cheby(model,[11.0])
@@ -0,0 +1,196 @@
+import time
+
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter, shift, fourier_shift
+
+from correlate import (cross_image, img_offset, prepare_templates, cross_images, img_offsets,
+                       local_crosses, pyramid_offsets, pyramid_offset, pyramid_templates, peak_to_sidelobe,
+                       phase_crosses)
+
+
+@pytest.mark.parametrize("im_shape,ref_shape",[((100,100),(100,100)),((64,80),(31,20))])
+def test_cross_images(im_shape,ref_shape):
+    rng=np.random.default_rng(3217)
+    n=5
+    im_refs=rng.integers(0,256,size=(n,)+ref_shape).astype(np.uint8)
+    ims=rng.integers(0,256,size=(n,)+im_shape).astype(np.uint8)
+    templates=prepare_templates(im_refs,im_shape)
+    crosses=cross_images(ims,templates)
+    offsets=img_offsets(crosses,bbox_r=10)
+    for i in range(n):
+        cross=cross_image(ims[i],im_refs[i])
+        assert np.allclose(crosses[i],cross)
+        assert np.array_equal(offsets[i],img_offset(cross=cross,bbox_r=10))
+    # One image against every reference
+    crosses=cross_images(ims[0],templates)
+    assert crosses.shape==(n,)+im_shape
+    for i in range(n):
+        assert np.allclose(crosses[i],cross_image(ims[0],im_refs[i]))
+
+
+def test_img_offsets_roll():
+    rng=np.random.default_rng(1964)
+    img_ref=rng.normal(size=(100,100))
+    rolls=[(3,-7),(-12,5),(0,0)]
+    ims=np.stack([np.roll(img_ref,roll,axis=(0,1)) for roll in rolls])
+    templates=prepare_templates(np.stack([img_ref]*len(rolls)),img_ref.shape)
+    offsets=img_offsets(cross_images(ims,templates),bbox_r=20)
+    assert np.array_equal(offsets,np.array(rolls))
+
+
+def test_local_crosses():
+    rng=np.random.default_rng(7)
+    ims=rng.normal(size=(3,40,50))
+    im_refs=rng.normal(size=(3,40,50))
+    centers=np.array([[2,-3],[0,0],[-5,4]])
+    windows=local_crosses(ims,im_refs,centers,2)
+    for i in range(3):
+        cross=cross_image(ims[i],im_refs[i])
+        cy,cx=20+centers[i,0],25+centers[i,1]
+        assert np.allclose(windows[i],cross[cy-2:cy+3,cx-2:cx+3])
+
+
+@pytest.mark.parametrize("levels",[0,1,2])
+def test_pyramid_offsets(levels):
+    rng=np.random.default_rng(1964)
+    img_ref=gaussian_filter(rng.normal(size=(100,100)),2)
+    shifts=[(3.3,-7.6),(-12.2,5.5),(0,0),(17.7,-15.1)]
+    ims=np.stack([shift(img_ref,s,order=3) for s in shifts])
+    offsets=pyramid_offsets(ims,np.stack([img_ref]*len(shifts)),bbox_r=20,levels=levels)
+    assert np.allclose(offsets,shifts,atol=0.1)
+    # References prepared ahead of time give the same result
+    coarse_templates=pyramid_templates(np.stack([img_ref]*len(shifts)),img_ref.shape,levels=levels)
+    assert np.array_equal(pyramid_offsets(ims,np.stack([img_ref]*len(shifts)),bbox_r=20,levels=levels,
+                                          coarse_templates=coarse_templates),offsets)
+    # Subpixel refinement is also available at a single scale
+    assert np.allclose(img_offset(ims[0],img_ref,bbox_r=20,subpixel=True),shifts[0],atol=0.1)
+    assert np.allclose(pyramid_offset(ims[1],img_ref,bbox_r=20,levels=levels),shifts[1],atol=0.1)
+
+
+@pytest.mark.parametrize("levels",[1,2])
+def test_pyramid_offsets_bbox(levels):
+    # Shifts just past the search radius must not be followed out of it by the refinement
+    rng=np.random.default_rng(1964)
+    img_ref=gaussian_filter(rng.normal(size=(100,100)),2)
+    shifts=[(11.0,-3.0),(-11.0,12.0),(4.0,-11.0)]
+    ims=np.stack([shift(img_ref,s,order=3) for s in shifts])
+    offsets=pyramid_offsets(ims,np.stack([img_ref]*len(shifts)),bbox_r=10,levels=levels,refine_r=3)
+    assert np.all(offsets>=-10.5)
+    assert np.all(offsets<=9.5)
+
+
+def test_pyramid_cheaper():
+    # The point of the pyramid is to cost less than the plain search it replaces,
+    # confidence included, on boxes the size of the escalated reticle search
+    rng=np.random.default_rng(1964)
+    im_refs=gaussian_filter(rng.normal(size=(20,100,100)),(0,2,2))
+    ims=np.stack([shift(im_ref,rng.uniform(-15,15,2),order=1) for im_ref in im_refs])
+    templates=prepare_templates(im_refs,(100,100))
+    coarse_templates=pyramid_templates(im_refs,(100,100),levels=2)
+
+    def plain():
+        return img_offsets(cross_images(ims,templates,normalized=True),bbox_r=20,subpixel=True,confidence=True)
+
+    def pyramid():
+        return pyramid_offsets(ims,im_refs,bbox_r=20,levels=2,confidence=True,normalized=True,
+                               coarse_templates=coarse_templates)
+
+    def best_time(f):
+        times=[]
+        for _ in range(5):
+            t0=time.perf_counter()
+            f()
+            times.append(time.perf_counter()-t0)
+        return min(times)
+    assert np.allclose(pyramid()[0],plain()[0],atol=0.1)
+    assert best_time(pyramid)<best_time(plain)
+
+
+def test_peak_to_sidelobe():
+    rng=np.random.default_rng(3217)
+    img_ref=gaussian_filter(rng.normal(size=(100,100)),2)
+    # A shifted copy of the reference matches, pure noise doesn't
+    ims=np.stack([np.roll(img_ref,(4,-6),axis=(0,1))+0.3*rng.normal(size=(100,100)),
+                  gaussian_filter(rng.normal(size=(100,100)),2)])
+    templates=prepare_templates(np.stack([img_ref]*2),ims.shape[1:])
+    crosses=cross_images(ims,templates)
+    offsets,psr=img_offsets(crosses,bbox_r=20,confidence=True)
+    assert np.array_equal(offsets[0],(4,-6))
+    assert psr[0]>8
+    assert psr[1]<4
+    # Same as measured directly at the peak, in full-array coordinates
+    peaks=offsets.astype(int)+np.array(ims.shape[1:])//2
+    assert np.allclose(peak_to_sidelobe(crosses,peaks),psr)
+    # The pyramid measures it on the coarse correlation, scaled to match
+    offsets_pyr,pyramid_psr=pyramid_offsets(ims,np.stack([img_ref]*2),bbox_r=20,levels=1,confidence=True)
+    assert np.allclose(offsets_pyr[0],(4,-6),atol=0.1)
+    assert pyramid_psr[0]>8
+    assert pyramid_psr[1]<4
+
+
+def test_normalized_cross_images():
+    rng=np.random.default_rng(7)
+    ims=rng.normal(size=(2,40,50))
+    im_refs=rng.normal(size=(2,21,16))
+    ncc=cross_images(ims,prepare_templates(im_refs,(40,50)),normalized=True)
+    # Brute force, with the window under the reference zero-padded like the correlation
+    ref_rows,ref_cols=im_refs.shape[1:]
+    for i in range(2):
+        im=ims[i]-np.mean(ims[i])
+        ref=im_refs[i]-np.mean(im_refs[i])
+        padded=np.pad(im,((ref_rows,ref_rows),(ref_cols,ref_cols)))
+        for y,x in ((0,0),(20,25),(39,49),(5,44)):
+            y0=y+1+(ref_rows-1)//2
+            x0=x+1+(ref_cols-1)//2
+            window=padded[y0:y0+ref_rows,x0:x0+ref_cols]
+            expected=np.sum(window*ref)/np.sqrt(np.sum((window-np.mean(window))**2)*np.sum(ref**2))
+            assert np.isclose(ncc[i,y,x],expected)
+    assert np.all(np.abs(ncc)<=1+1e-9)
+    # The same windows, evaluated directly
+    ims=rng.normal(size=(3,40,50))
+    im_refs=rng.normal(size=(3,40,50))
+    full=cross_images(ims,prepare_templates(im_refs,(40,50)),normalized=True)
+    centers=np.array([[2,-3],[0,0],[-5,4]])
+    windows=local_crosses(ims,im_refs,centers,2,normalized=True)
+    for i in range(3):
+        cy,cx=20+centers[i,0],25+centers[i,1]
+        assert np.allclose(windows[i],full[i,cy-2:cy+3,cx-2:cx+3])
+
+
+def test_normalized_brightness():
+    # A mark on a steep brightness ramp, next to a bright patch that pulls the plain
+    # correlation peak off the mark
+    mark=np.zeros((21,21))
+    mark[8:13,:]=1
+    mark[:,8:13]=1
+    img=np.tile(np.linspace(0,50,100),(100,1))
+    img[40:61,30:51]+=10*mark
+    img[70:95,75:100]+=200
+    templates=prepare_templates(mark[None,...],img.shape)
+    cross=cross_images(img[None,...],templates)[0]
+    assert not np.array_equal(np.unravel_index(np.argmax(cross),cross.shape),(50,40))
+    ncc=cross_images(img[None,...],templates,normalized=True)[0]
+    assert np.array_equal(np.unravel_index(np.argmax(ncc),ncc.shape),(50,40))
+    assert np.max(ncc)>0.8
+    # Brightness and contrast changes don't change the normalized correlation
+    assert np.allclose(cross_images(3*img[None,...]+100,templates,normalized=True)[0],ncc)
+
+
+def test_phase_crosses():
+    rng=np.random.default_rng(1964)
+    im_refs=gaussian_filter(rng.normal(size=(2,64,80)),(0,2,2))
+    # Shift the second one exactly, by a phase ramp
+    shifted=np.fft.ifft2(fourier_shift(np.fft.fft2(im_refs[1]),(-7.3,2.6))).real
+    ims=np.stack([np.roll(im_refs[0],(3,-5),axis=(0,1)),shifted])
+    assert np.array_equal(img_offsets(phase_crosses(ims,im_refs))[0],(3,-5))
+    # A widened peak can be located between pixels
+    offsets=img_offsets(phase_crosses(ims,im_refs,peak_sigma=2.0),subpixel=True)
+    assert np.allclose(offsets,[(3,-5),(-7.3,2.6)],atol=0.05)
+    # Each pair is normalized on its own: a much brighter pair, or a blank one, doesn't
+    # change the others
+    crosses=phase_crosses(np.concatenate((ims,1e6*ims[:1],np.zeros((1,64,80)))),
+                          np.concatenate((im_refs,1e6*im_refs[:1],np.zeros((1,64,80)))))
+    assert np.allclose(crosses[:2],phase_crosses(ims,im_refs))
+    assert np.allclose(crosses[2],crosses[0])
+    assert np.all(crosses[3]==0)
@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import pytest
+
+from distortion import fit_distortion, apply_distortion, warp_map, cached_warp_map
+from lattice import get_lattice
+
+
+def distort(lattice):
+    # Affine lattice plus a smooth bend, the way a brightness-dependent scan deflection might push the marks
+    u,v=lattice[...,0],lattice[...,1]
+    x=575+180*u+4*v+1.5*u*v-0.4*u**3
+    y=540-3*u+175*v+0.8*u**2-0.5*v**2*u
+    return np.stack((x,y),axis=-1)
+
+
+def test_poly():
+    lattice=np.array(get_lattice(7,"A"),dtype=np.float64)
+    points=distort(lattice)
+    model=fit_distortion(points,lattice,order=3)
+    assert model.order==3
+    # The bend is a cubic, so the fit should be exact everywhere, not only at the marks
+    test_points=np.random.default_rng(3217).uniform(lattice.min(axis=0),lattice.max(axis=0),size=(50,2))
+    assert np.allclose(apply_distortion(model,test_points),distort(test_points),atol=1e-6)
+    # An outlier which is not an inlier shouldn't pull the fit
+    points[3]+=(20,-10)
+    inliers=np.ones(len(points),dtype=bool)
+    inliers[3]=False
+    points[5]=np.nan
+    model=fit_distortion(points,lattice,inliers=inliers,order=3)
+    assert np.allclose(apply_distortion(model,test_points),distort(test_points),atol=1e-6)
+    # With too few marks for a cubic, fall back to a lower order
+    assert fit_distortion(points[:9],lattice[:9],order=3).order==2
+
+
+@pytest.mark.parametrize("smoothing",[0.0,1.0])
+def test_tps(smoothing):
+    lattice=np.array(get_lattice(7,"A"),dtype=np.float64)
+    points=distort(lattice)+np.random.default_rng(3217).normal(scale=0.3,size=(len(lattice),2))
+    model=fit_distortion(points,lattice,kind="tps",smoothing=smoothing)
+    fit=apply_distortion(model,lattice)
+    if smoothing==0:
+        assert np.allclose(fit,points,atol=1e-6)
+    else:
+        assert np.max(np.linalg.norm(fit-points,axis=-1))<1.0
+    # Between the marks, it should stay close to the true bend
+    mid=(lattice[:-1]+lattice[1:])/2
+    assert np.max(np.linalg.norm(apply_distortion(model,mid)-distort(mid),axis=-1))<1.5
+
+
+@pytest.mark.parametrize("kind",["poly","tps"])
+def test_too_few_marks(kind):
+    lattice=np.array(get_lattice(7,"A"),dtype=np.float64)
+    points=distort(lattice)
+    corner=[0,1,5]
+    assert fit_distortion(points[corner],lattice[corner],kind=kind).order==1
+    with pytest.raises(ValueError):
+        fit_distortion(points[:2],lattice[:2],kind=kind)
+    # Three marks along one row don't pin down the affine part either
+    with pytest.raises(ValueError):
+        fit_distortion(points[:3],lattice[:3],kind=kind)
+
+
+def test_unknown_model():
+    lattice=np.array(get_lattice(7,"A"),dtype=np.float64)
+    with pytest.raises(ValueError):
+        fit_distortion(distort(lattice),lattice,kind="spline")
+
+
+def test_warp_map(tmp_path):
+    lattice=np.array(get_lattice(7,"A"),dtype=np.float64)
+    model=fit_distortion(distort(lattice),lattice,kind="tps")
+    M_lat_out=np.array([[1/180,0,-3],[0,1/175,-3],[0,0,1]])
+    map_xy=warp_map(model,M_lat_out,(60,70),block_rows=7)
+    assert map_xy.shape==(2,60,70)
+    assert map_xy.dtype==np.float32
+    y,x=13,41
+    lattice_point=(M_lat_out@[x,y,1])[0:2]
+    assert np.allclose(map_xy[:,y,x],apply_distortion(model,lattice_point),atol=1e-3)
+    cache_dir=str(tmp_path)
+    cached=cached_warp_map(model,M_lat_out,(60,70),cache_dir=cache_dir)
+    assert np.array_equal(cached,map_xy)
+    assert len(os.listdir(cache_dir))==1
+    cached_warp_map(model,M_lat_out,(60,70),cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir))==1
+    # A different fit is a different map
+    cached_warp_map(model._replace(coef=model.coef*1.01),M_lat_out,(60,70),cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir))==2
@@ -0,0 +1,48 @@
+import numpy as np
+
+from ephemeris import fit_ephemeris, ephemeris_position, ephemeris_state, save_ephemeris, load_ephemeris, \
+    get_ephemeris, r7_et0, r7_et1
+
+n=2*np.pi/(27.32*86400)
+
+
+def sampler(body,et,frame,abcorr,center):
+    """
+    Synthetic spkezr(): the Earth on a slightly eccentric, inclined orbit around the Moon
+    """
+    a=384400.0*(1+0.05*np.cos(n*et))
+    da=-384400.0*0.05*n*np.sin(n*et)
+    u=np.array([np.cos(n*et),np.sin(n*et)*np.cos(0.4),np.sin(n*et)*np.sin(0.4)])
+    du=n*np.array([-np.sin(n*et),np.cos(n*et)*np.cos(0.4),np.cos(n*et)*np.sin(0.4)])
+    return np.concatenate((a*u,da*u+a*du)),a/299792.458
+
+
+def test_fit_ephemeris(tmp_path):
+    eph=fit_ephemeris("399",r7_et0,r7_et1,sampler=sampler)
+    assert eph.pos_error<1e-6
+    assert eph.vel_error<1e-9
+    ets=np.linspace(r7_et0,r7_et1,777)
+    states=np.array([sampler("399",et,"ECI_TOD","NONE","301")[0] for et in ets])
+    assert np.allclose(ephemeris_position(eph,ets),states[:,:3].T,rtol=0,atol=1e-6)
+    rs,vs=ephemeris_state(eph,ets)
+    assert rs.shape==(3,777)
+    assert np.allclose(vs,states[:,3:].T,rtol=0,atol=1e-9)
+    fn=tmp_path/"eph.npz"
+    save_ephemeris(fn,[eph,eph._replace(body="10")])
+    ephs=load_ephemeris(fn)
+    assert sorted(ephs)==["10","399"]
+    loaded=ephs["399"]
+    assert (loaded.body,loaded.center,loaded.frame)==("399","301","ECI_TOD")
+    assert loaded.pos_error==eph.pos_error
+    assert np.array_equal(ephemeris_position(loaded,ets),ephemeris_position(eph,ets))
+
+
+def test_get_ephemeris(tmp_path):
+    fn=tmp_path/"eph.npz"
+    # No file yet, so it is fit over the whole mission
+    eph=get_ephemeris("399",fn=fn,sampler=sampler)
+    assert (eph.pos.breaks[0],eph.pos.breaks[-1])==(r7_et0,r7_et1)
+    save_ephemeris(fn,[eph._replace(pos_error=123.0)])
+    # Now it comes from the file, and only bodies not in it are fit
+    assert get_ephemeris("399",fn=fn,sampler=None).pos_error==123.0
+    assert get_ephemeris("10",fn=fn,sampler=sampler).body=="10"
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+from fourier_mellin import register_zoom, similarity_about, focus_of_expansion
+from warp import affine_warp
+
+
+@pytest.mark.parametrize("scale,rotation",[(1.06,0.01),(1.005,-0.002)])
+def test_register_zoom(scale,rotation):
+    # Zoom in on a random surface about a fixed point, frame after frame
+    rng=np.random.default_rng(1964)
+    surface=gaussian_filter(rng.normal(size=(700,700)),2)+0.5*gaussian_filter(rng.normal(size=(700,700)),8)
+    foe=(250.0,290.0)
+    M_step=similarity_about(scale,rotation,foe)
+    frames=[]
+    M=np.eye(3)
+    for _ in range(3):
+        frames.append(affine_warp(surface,M,output_shape=(600,600)))
+        M=M_step@M
+    zoom=register_zoom(np.stack(frames))
+    assert np.allclose(zoom.scale,scale,atol=2e-4)
+    assert np.allclose(zoom.rotation,rotation,atol=1e-4)
+    assert np.allclose(zoom.M_next_prev,M_step,atol=0.1)
+    # The focus of expansion is only as good as the zoom is big
+    assert np.allclose(zoom.foe,foe,atol=0.5 if scale>1.01 else 2.0)
+
+
+def test_focus_of_expansion():
+    M=np.stack([similarity_about(1.1,0.2,(30,-40)),np.array([[1,0,5],[0,1,3],[0,0,1]])])
+    foe=focus_of_expansion(M)
+    assert np.allclose(foe[0],(30,-40))
+    # A pure shift has no fixed point
+    assert np.all(np.isnan(foe[1]))
@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from frame_cache import cached_array, evict, file_hash, load_frame, load_reduced_frame
+from warp import affine_warp
+
+
+def test_load_frame(tmp_path):
+    rng=np.random.default_rng(3217)
+    img=rng.integers(0,256,size=(60,80)).astype(np.uint8)
+    infn=tmp_path/"Ranger7A001.png"
+    Image.fromarray(img,mode='L').save(infn)
+    cache_dir=str(tmp_path/"cache")
+    frame=load_frame(str(infn),cache_dir=cache_dir)
+    assert isinstance(frame,np.memmap)
+    # PNG is lossless, so this should be exact, after matplotlib's conversion of PNG to float
+    assert np.allclose(frame,img/255.0)
+    assert len(os.listdir(cache_dir))==1
+    # Same content under a different name hits the same entry
+    infn2=tmp_path/"copy.png"
+    infn2.write_bytes(infn.read_bytes())
+    assert np.array_equal(load_frame(str(infn2),cache_dir=cache_dir),frame)
+    assert len(os.listdir(cache_dir))==1
+
+
+def test_file_hash(tmp_path):
+    fn=tmp_path/"a.bin"
+    fn.write_bytes(b"first")
+    h=file_hash(str(fn))
+    stat=os.stat(fn)
+    # Same size and modification time is taken to be the same file, without reading it
+    fn.write_bytes(b"other")
+    os.utime(fn,ns=(stat.st_atime_ns,stat.st_mtime_ns))
+    assert file_hash(str(fn))==h
+    # A new modification time is read again
+    os.utime(fn,ns=(stat.st_atime_ns,stat.st_mtime_ns+1_000_000_000))
+    assert file_hash(str(fn))!=h
+
+
+def test_cached_array(tmp_path):
+    cache_dir=str(tmp_path)
+    calls=[]
+    def make():
+        calls.append(1)
+        return np.arange(1000,dtype=np.float64)
+    a=cached_array("a",make,cache_dir=cache_dir)
+    b=cached_array("a",make,cache_dir=cache_dir)
+    assert len(calls)==1
+    assert np.array_equal(a,b)
+    for key in "bcd":
+        cached_array(key,make,cache_dir=cache_dir)
+    # Make the last-used order a, b, c, d, then touch a again
+    for i,key in enumerate("abcd"):
+        os.utime(os.path.join(cache_dir,f"{key}.npy"),(i,i))
+    cached_array("a",make,cache_dir=cache_dir)
+    # Each entry is 8000 bytes plus a header, so only two fit
+    evict(cache_dir,max_bytes=17000)
+    assert sorted(os.listdir(cache_dir))==["a.npy","d.npy"]
+
+
+def test_load_reduced_frame(tmp_path):
+    # Smooth ramp, so that the JPEG is nearly lossless, and the mean of each block
+    # is the value at the block center
+    ys,xs=np.mgrid[0:256,0:320]
+    img=(40+0.3*xs+0.2*ys).astype(np.uint8)
+    infn=tmp_path/"Ranger7A001.jpg"
+    Image.fromarray(img,mode='L').save(infn,quality=95)
+    cache_dir=str(tmp_path/"cache")
+    reduced=load_reduced_frame(str(infn),80,cache_dir=cache_dir)
+    assert reduced.big_shape==(256,320)
+    assert reduced.img.shape==(64,80)
+    assert np.array_equal(reduced.M_big_img[0],[4,0,1.5])
+    big=load_frame(str(infn),cache_dir=cache_dir)
+    resampled=affine_warp(big,np.linalg.inv(reduced.M_big_img),output_shape=reduced.img.shape)
+    error=np.abs(resampled[1:-1,1:-1]-reduced.img[1:-1,1:-1])
+    # Getting the half-block shift in M_big_img wrong makes the mean error about 0.7
+    assert np.max(error)<=1
+    assert np.mean(error)<0.3
+    # Asking for more than half the width can't reduce at all
+    assert load_reduced_frame(str(infn),200,cache_dir=cache_dir).img.shape==(256,320)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from frame_stack import open_stack, write_frame, save_table, load_stack, get_frame, export_png
+
+
+def test_frame_stack(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path/"rect_images"/"7A").mkdir(parents=True)
+    rng=np.random.default_rng(1964)
+    tabs=[1,2,4]
+    frames,intact=open_stack(7,"A",tabs)
+    assert not intact
+    assert frames.shape==(3,1150,1150)
+    del frames
+    # Not all frames are written yet
+    with pytest.raises(ValueError):
+        load_stack(7,"A")
+    imgs=rng.integers(0,256,size=(3,1150,1150)).astype(np.uint8)
+    for slot in (2,0,1):
+        write_frame(7,"A",slot,imgs[slot])
+    M=np.stack([np.eye(3)*(i+1) for i in range(3)])
+    save_table(7,"A",np.array(tabs),M_im1_imn=M,residuals=rng.random((3,20)),inliers=np.ones((3,20),dtype=bool))
+    stack=load_stack(7,"A")
+    assert np.array_equal(stack.frames,imgs)
+    assert np.array_equal(get_frame(stack,4),imgs[2])
+    assert np.array_equal(stack.frames[:,100,200],imgs[:,100,200])
+    assert np.array_equal(stack.M_im1_imn,M)
+    # Same TABs reuses the stack, different TABs starts over
+    assert open_stack(7,"A",tabs)[1]
+    export_png(7,"A")
+    assert np.array_equal(np.array(Image.open("rect_images/7A/Rect7A004.png")),imgs[2])
+    frames,intact=open_stack(7,"A",tabs+[5])
+    assert not intact
+    assert frames.shape==(4,1150,1150)
+
+
+def test_interrupted_stack(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path/"rect_images"/"7A").mkdir(parents=True)
+    tabs=[1,2,3]
+    frames,intact=open_stack(7,"A",tabs)
+    assert not intact
+    del frames
+    # Interrupted after writing only one frame
+    write_frame(7,"A",0,np.full((1150,1150),7,dtype=np.uint8))
+    # The rerun must not trust any of the frames, even though the TABs match
+    frames,intact=open_stack(7,"A",tabs)
+    assert not intact
+    del frames
+    for slot in range(3):
+        write_frame(7,"A",slot,np.full((1150,1150),slot+1,dtype=np.uint8))
+    save_table(7,"A",np.array(tabs),M_im1_imn=np.stack([np.eye(3)]*3),
+               residuals=np.zeros((3,0)),inliers=np.zeros((3,0),dtype=bool))
+    # Once finished, it is reused
+    assert open_stack(7,"A",tabs)[1]
@@ -0,0 +1,76 @@
+import numpy as np
+
+from frames import matrix_to_quat, quat_to_matrix, fit_frame, frame_rotation, frame_xform, transform_states
+
+w=2.66e-6
+
+
+def rotz(a):
+    c,s=np.cos(a),np.sin(a)
+    return np.array([[c,-s,0],[s,c,0],[0,0,1]])
+
+
+def rotx(a):
+    c,s=np.cos(a),np.sin(a)
+    return np.array([[1,0,0],[0,c,-s],[0,s,c]])
+
+
+def drotz(a):
+    c,s=np.cos(a),np.sin(a)
+    return np.array([[-s,-c,0],[c,-s,0],[0,0,0]])
+
+
+def drotx(a):
+    c,s=np.cos(a),np.sin(a)
+    return np.array([[0,0,0],[0,-s,-c],[0,c,-s]])
+
+
+def sampler(from_frame,to_frame,et):
+    """
+    Synthetic sxform(): a steady spin with a wobble of the spin angle and the tilt
+    """
+    theta=w*et+1e-3*np.sin(et/50000)
+    dtheta=w+1e-3*np.cos(et/50000)/50000
+    eps=0.4+2e-4*np.cos(et/80000)
+    deps=-2e-4*np.sin(et/80000)/80000
+    R=rotx(eps)@rotz(theta)
+    dR=drotx(eps)@rotz(theta)*deps+rotx(eps)@drotz(theta)*dtheta
+    M=np.zeros((6,6))
+    M[:3,:3]=R
+    M[3:,3:]=R
+    M[3:,:3]=dR
+    return M
+
+
+def test_quat_round_trip():
+    rng=np.random.default_rng(3)
+    q=rng.normal(size=(200,4))
+    q/=np.linalg.norm(q,axis=-1,keepdims=True)
+    M=quat_to_matrix(q)
+    assert np.allclose(M@np.swapaxes(M,-1,-2),np.eye(3))
+    assert np.allclose(np.linalg.det(M),1)
+    assert np.allclose(quat_to_matrix(matrix_to_quat(M)),M)
+
+
+def test_fit_frame():
+    et0,et1=-1.1e6,-0.85e6
+    frame=fit_frame("IAU_MOON","ECI_TOD",et0,et1,sampler=sampler)
+    assert frame.rot_error<1e-13
+    assert frame.rate_error<1e-17
+    ets=np.linspace(et0,et1,1001)
+    M_ref=np.array([sampler("IAU_MOON","ECI_TOD",et) for et in ets])
+    assert np.allclose(frame_xform(frame,ets),M_ref,rtol=0,atol=1e-13)
+    assert np.allclose(frame_rotation(frame,ets),M_ref[:,:3,:3],rtol=0,atol=1e-13)
+    rng=np.random.default_rng(4)
+    rs=rng.normal(size=(3,len(ets)))*1800
+    vs=rng.normal(size=(3,len(ets)))
+    rs_to,vs_to=transform_states(frame,ets,rs,vs)
+    s_ref=M_ref@np.concatenate((rs,vs)).T[...,None]
+    assert np.allclose(rs_to,s_ref[:,:3,0].T,rtol=0,atol=1e-9)
+    assert np.allclose(vs_to,s_ref[:,3:,0].T,rtol=0,atol=1e-12)
+
+
+def test_fit_frame_coarse():
+    # Too few terms for the wobble, which the check should report
+    frame=fit_frame("IAU_MOON","ECI_TOD",0.0,1e6,seg_len=1e6,degree=3,sampler=sampler)
+    assert frame.rot_error>1e-6
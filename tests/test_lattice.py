@@ -0,0 +1,41 @@
+import numpy as np
+
+from lattice import get_lattice, fit_lattice
+
+
+def test_get_lattice():
+    lattice=get_lattice(7,"A")
+    assert len(lattice)==20
+    assert lattice[0]==(-2,-1)
+    assert lattice[4]==( 2,-1)
+    assert lattice[5]==(-2, 0)
+    assert lattice[19]==(2, 2)
+
+
+def test_fit_lattice():
+    rng=np.random.default_rng(3217)
+    lattice=np.array(get_lattice(7,"A"),dtype=np.float64)
+    n_tab=50
+    # Random matrices near the Ranger 7A lattice, which has marks about 245 pixels apart
+    M_im_lat=np.zeros((n_tab,3,3))
+    M_im_lat[:,0,:]=[245,0,560]+rng.normal(scale=(5,3,10),size=(n_tab,3))
+    M_im_lat[:,1,:]=[0,245,480]+rng.normal(scale=(3,5,10),size=(n_tab,3))
+    M_im_lat[:,2,2]=1
+    points=np.einsum('tij,nj->tni',M_im_lat[:,0:2,:],np.hstack((lattice,np.ones((20,1)))))
+    points+=rng.normal(scale=0.3,size=points.shape)
+    # One bad correlation per frame, and one mark not found at all on the first frame
+    i_bad=rng.integers(0,20,size=n_tab)
+    points[np.arange(n_tab),i_bad,:]+=30
+    i_missing=(i_bad[0]+1)%20
+    points[0,i_missing,:]=np.nan
+    fit=fit_lattice(points,lattice)
+    assert fit.M_im_lat.shape==(n_tab,3,3)
+    assert np.allclose(fit.M_im_lat,M_im_lat,atol=0.5)
+    assert not np.any(fit.inliers[np.arange(n_tab),i_bad])
+    assert np.isnan(fit.residuals[0,i_missing])
+    assert not fit.inliers[0,i_missing]
+    # Occasionally a good mark lands far enough out in the tail to be rejected too
+    assert np.sum(fit.inliers)>=0.98*(n_tab*19-1)
+    # A single frame gives the same answer as the batch
+    fit0=fit_lattice(points[0],lattice)
+    assert np.allclose(fit0.M_im_lat,fit.M_im_lat[0])
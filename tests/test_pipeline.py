@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+from pipeline import Stage, run_pipeline
+
+
+def test_run_pipeline():
+    stages=[Stage("double",lambda x:2*x,n_threads=3,maxsize=2),
+            Stage("inc",lambda x:x+1,n_threads=2,maxsize=2)]
+    result=sorted(run_pipeline(range(100),stages))
+    assert result==[2*x+1 for x in range(100)]
+    assert [stage.n_items for stage in stages]==[100,100]
+
+
+def test_run_pipeline_backpressure():
+    # A slow last stage should hold back the fast first stage, so that only a few
+    # items are ever in flight at once.
+    started=[]
+    lock=threading.Lock()
+    in_flight=[0,0]
+
+    def fast(x):
+        with lock:
+            in_flight[0]+=1
+            in_flight[1]=max(in_flight[1],in_flight[0])
+        started.append(x)
+        return x
+
+    def slow(x):
+        time.sleep(0.002)
+        with lock:
+            in_flight[0]-=1
+        return x
+
+    stages=[Stage("fast",fast,maxsize=2),Stage("slow",slow,maxsize=2)]
+    assert sorted(run_pipeline(range(50),stages))==list(range(50))
+    # At most: one in each stage, two in the queue between, two in the output queue
+    assert in_flight[1]<=6
+    assert stages[0].blocked>0
+
+
+def test_run_pipeline_error():
+    def fail(x):
+        if x==7:
+            raise ValueError("bad frame")
+        return x
+    with pytest.raises(ValueError,match="bad frame"):
+        list(run_pipeline(range(20),[Stage("fail",fail,n_threads=2)]))
+
+
+def test_run_pipeline_error_stops_threads():
+    # Items pile up behind the failure, with every queue full, and all of the
+    # threads must still be gone by the time the exception comes out.
+    def fail(x):
+        if x==3:
+            raise ValueError("bad frame")
+        time.sleep(0.001)
+        return x
+    before=threading.active_count()
+    stages=[Stage("pass",lambda x:x,n_threads=2,maxsize=1),Stage("fail",fail,n_threads=1,maxsize=1)]
+    with pytest.raises(ValueError,match="bad frame"):
+        for _ in run_pipeline(range(1000),stages):
+            time.sleep(0.01)
+    assert threading.active_count()==before
@@ -0,0 +1,46 @@
+import numpy as np
+from scipy.integrate import solve_ivp
+
+from ephemeris import fit_ephemeris
+from propagator import two_body_accel, three_body_accel, dense_trajectory, propagate
+
+
+def test_propagate_circular():
+    # Circular orbit of radius 2, inclined 30deg
+    a=2.0
+    n=a**-1.5
+    c,s=np.cos(np.radians(30)),np.sin(np.radians(30))
+    ts=np.linspace(-20,50,301)
+    rs_ref=a*np.stack((np.cos(n*ts),np.sin(n*ts)*c,np.sin(n*ts)*s))
+    vs_ref=a*n*np.stack((-np.sin(n*ts),np.cos(n*ts)*c,np.cos(n*ts)*s))
+    rs,vs=propagate(rs_ref[:,None,100],vs_ref[:,None,100],ts-ts[100])
+    assert rs.shape==(3,301)
+    assert np.allclose(rs,rs_ref,rtol=0,atol=1e-10)
+    assert np.allclose(vs,vs_ref,rtol=0,atol=1e-10)
+    # Dense output of one integration matches the same points
+    sol=dense_trajectory(rs_ref[:,100],vs_ref[:,100],ts[-1]-ts[100])
+    assert np.allclose(sol(ts[100:]-ts[100])[:3],rs_ref[:,100:],rtol=0,atol=1e-10)
+
+
+def test_three_body():
+    r_moon,mu_moon,mu_earth=1737.4,4902.8,398600.4
+    r_earth=np.array([384400.0,1000.0,-2000.0])
+    # Earth standing still, which is enough to check the tide
+    earth=fit_ephemeris("399",0.0,1e5,degree=2,sampler=lambda *args:(np.concatenate((r_earth,np.zeros(3))),0.0))
+    accel=three_body_accel(earth,et0=0.0,r_moon=r_moon,mu_moon=mu_moon,mu_earth=mu_earth)
+    r0=np.array([3.0,0.2,0.1])
+    v0=np.array([0.0,0.5,0.1])
+    mu_ratio=mu_earth/mu_moon
+    re=r_earth/r_moon
+    def f(t,y):
+        d=y[:3]-re
+        return np.concatenate((y[3:],-y[:3]/np.linalg.norm(y[:3])**3
+                                     -mu_ratio*(d/np.linalg.norm(d)**3+re/np.linalg.norm(re)**3)))
+    ts=np.linspace(0,10,11)
+    ref=solve_ivp(f,(0,10),np.concatenate((r0,v0)),t_eval=ts,method='Radau',rtol=1e-13,atol=1e-13).y
+    rs,vs=propagate(r0,v0,ts,accel=accel)
+    assert np.allclose(rs,ref[:3],rtol=0,atol=1e-9)
+    assert np.allclose(vs,ref[3:],rtol=0,atol=1e-9)
+    # The tide is big enough to matter
+    rs_2b,_=propagate(r0,v0,ts,accel=two_body_accel)
+    assert np.max(np.abs(rs_2b-rs))>1e-5
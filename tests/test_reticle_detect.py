@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from auto_rectify import get_synthetic_masks, get_manual_reticle
+from bench_pipeline import make_scene
+from lattice import get_lattice
+from reticle_detect import detect_reticle
+from warp import affine_warp
+
+
+@pytest.mark.parametrize("mission,channel",[(7,"A"),(8,"B")])
+def test_detect_reticle(mission,channel):
+    # Move the synthetic scene away from the TAB 1 clicks it was drawn at, so that
+    # the detector can't be getting the right answer from the clicks
+    scene=make_scene(mission,channel)
+    theta=0.02
+    M=np.array([[np.cos(theta),-np.sin(theta),15],[np.sin(theta),np.cos(theta),-20],[0,0,1]])
+    img=affine_warp(scene,M,output_shape=scene.shape)
+    img+=np.random.default_rng(1964).normal(scale=5,size=img.shape).astype(np.float32)
+    clicks=np.array(get_manual_reticle(mission,channel,None))
+    truth=(np.hstack((clicks,np.ones((len(clicks),1))))@M.T)[:,0:2]
+    detected=detect_reticle(img,get_synthetic_masks(mission,channel),get_lattice(mission,channel))
+    assert np.all(np.linalg.norm(detected.points-truth,axis=1)<1.0)
+    assert np.all(detected.confidence>0.5)
+
+
+def test_detect_reticle_blank():
+    scene=np.full((1150,1150),128,dtype=np.float32)
+    scene+=np.random.default_rng(3217).normal(scale=5,size=scene.shape).astype(np.float32)
+    with pytest.raises(ValueError):
+        detect_reticle(scene,get_synthetic_masks(7,"A"),get_lattice(7,"A"))
@@ -0,0 +1,42 @@
+import numpy as np
+
+from reticle_tracker import ReticleTracker
+
+
+def M_at(tab:int)->np.ndarray:
+    # Lattice matrix drifting at a constant rate
+    return np.array([[245+0.1*tab, 2-0.01*tab, 565+1.5*tab],
+                     [-1+0.02*tab, 244,        475-0.7*tab],
+                     [0,0,1]])
+
+
+def test_constant_velocity():
+    tracker=ReticleTracker()
+    assert tracker.predict(1) is None
+    tracker.update(1,M_at(1))
+    assert tracker.predict(2) is None
+    tracker.update(2,M_at(2))
+    # Constant velocity is predicted exactly, including across skipped TABs
+    assert np.allclose(tracker.predict(3),M_at(3))
+    tracker.update(3,M_at(3))
+    assert np.allclose(tracker.predict(7),M_at(7))
+    tracker.update(7,M_at(7))
+    assert np.allclose(tracker.predict(8),M_at(8))
+
+
+def test_spike():
+    tracker=ReticleTracker()
+    assert not tracker.is_spike(10.0,1.0)
+    for tab in range(1,6):
+        tracker.update(tab,M_at(tab),rms=3.0)
+    assert not tracker.is_spike(3.5,1.0)
+    assert tracker.is_spike(4.5,1.0)
+
+
+def test_counts():
+    tracker=ReticleTracker()
+    tracker.update(1,M_at(1))
+    tracker.update(2,M_at(2),tracked=True)
+    tracker.fall_back()
+    tracker.update(3,M_at(3))
+    assert (tracker.n_seen,tracker.n_tracked,tracker.n_fallback)==(3,1,1)
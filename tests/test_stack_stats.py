@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+from frame_stack import open_stack, write_frame, save_table
+from stack_stats import stack_stats, blemish_mask, save_blemish, load_blemish_mask
+
+
+def make_stack(n_tab,rng):
+    # The surface moves under a tube with a few dark spots stuck to it, and the
+    # first frames don't cover the bottom of the frame
+    surface=gaussian_filter(rng.normal(size=(1400,1400)),3)
+    surface=np.clip(128+60*surface/np.std(surface),1,255)
+    yy,xx=np.mgrid[0:1150,0:1150]
+    spots=[(200,300,4),(700,650,2),(1000,100,6)]
+    stuck=np.zeros((1150,1150),dtype=bool)
+    for x,y,r in spots:
+        stuck|=(xx-x)**2+(yy-y)**2<=r**2
+    frames=np.empty((n_tab,1150,1150),dtype=np.uint8)
+    for i in range(n_tab):
+        frame=surface[17*i:17*i+1150,11*i:11*i+1150].copy()
+        frame[stuck]=30
+        if i<3:
+            frame[1100:]=0
+        frames[i]=np.round(frame)
+    return frames,stuck
+
+
+@pytest.mark.parametrize("n_workers",[1,2])
+def test_stack_stats(tmp_path,monkeypatch,n_workers):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path/"rect_images"/"7A").mkdir(parents=True)
+    rng=np.random.default_rng(1964)
+    n_tab=12
+    frames,stuck=make_stack(n_tab,rng)
+    tabs=list(range(1,n_tab+1))
+    open_stack(7,"A",tabs)
+    for slot,frame in enumerate(frames):
+        write_frame(7,"A",slot,frame)
+    save_table(7,"A",np.array(tabs),M_im1_imn=np.tile(np.eye(3),(n_tab,1,1)),
+               residuals=np.zeros((n_tab,20)),inliers=np.ones((n_tab,20),dtype=bool))
+    stats=stack_stats(7,"A",chunk_rows=100,n_workers=n_workers)
+    data=np.where(frames==0,np.nan,frames.astype(np.float64))
+    assert np.array_equal(stats.count,np.sum(frames>0,axis=0))
+    assert np.allclose(stats.median,np.nanmedian(data,axis=0))
+    assert np.allclose(stats.mean,np.nanmean(data,axis=0),atol=1e-3)
+    assert np.allclose(stats.var,np.nanvar(data,axis=0),rtol=1e-4,atol=1e-2)
+    assert np.array_equal(stats.min,np.nanmin(data,axis=0))
+    assert np.array_equal(stats.max,np.nanmax(data,axis=0))
+    mask=blemish_mask(stats)
+    assert np.all(mask[stuck])
+    # Only the spots, grown by a pixel, and hardly anything else
+    assert np.sum(mask&~stuck)<4*np.sum(stuck)
+    save_blemish(7,"A",stats,mask)
+    assert np.array_equal(load_blemish_mask(7,"A"),mask)
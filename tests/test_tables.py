@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+
+from tables import load_table, parse_table, apply_offsets
+
+
+def write_table(tmp_path,text):
+    (tmp_path/"tables").mkdir(exist_ok=True)
+    (tmp_path/"tables"/"test_7a.csv").write_text(text)
+
+
+def test_load_table(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_table(tmp_path,"TAB, POD,Time_GMT                ,alt       ,pt1_lat,pt1_lon\n"
+                         "  1,   8,1964-Jul-31 13:08:52.561,2095.91858,-12.184,-17.369\n"
+                         "  2,  10,1964-Jul-31 13:08:57.681,2086.35226,-12.175,-17.386")
+    table=load_table("test_7a",cache_dir="cache")
+    assert table.dtype.names==("TAB","POD","Time_GMT","alt","pt1_lat","pt1_lon")
+    assert table.TAB.dtype==np.int64
+    assert np.array_equal(table.TAB,[1,2])
+    assert np.array_equal(table.pt1_lat,[-12.184,-12.175])
+    assert table[1].Time_GMT=="1964-Jul-31 13:08:57.681"
+    assert table[0].alt==2095.91858
+    assert len(os.listdir("cache"))==1
+    # Second time comes from the cache, with the same result
+    assert np.array_equal(load_table("test_7a",cache_dir="cache"),table)
+    assert len(os.listdir("cache"))==1
+    # Editing the table misses the cache
+    write_table(tmp_path,"TAB,alt\n  1, 5.5\n")
+    table=load_table("test_7a",cache_dir="cache")
+    assert table.dtype.names==("TAB","alt")
+    assert np.array_equal(table.alt,[5.5])
+    assert np.array_equal(load_table("test_7a",cache_dir=None),table)
+
+
+def test_apply_offsets(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_table(tmp_path,"TAB,alt,ssc_lat,ssc_lon,pt1_lat,pt1_lon,pt1_srange\n"
+                         "  1,100.0,-3.0,-35.0,-12.0,-17.0,2283.0\n"
+                         "  2, 90.0,-3.5,-34.5,-12.5,-17.5,2273.0\n")
+    table=parse_table("tables/test_7a.csv")
+    offset=apply_offsets(table,latofs=0.5,lonofs=-0.25,rofs=1.0)
+    assert np.array_equal(offset.ssc_lat,table["ssc_lat"]-0.5)
+    assert np.array_equal(offset.pt1_lat,table["pt1_lat"]-0.5)
+    assert np.array_equal(offset.pt1_lon,table["pt1_lon"]+0.25)
+    assert np.array_equal(offset.alt,table["alt"]-1.0)
+    assert np.array_equal(offset.pt1_srange,table["pt1_srange"])
+    assert np.array_equal(offset.TAB,table["TAB"])
+    # The original is untouched
+    assert table["ssc_lat"][0]==-3.0
+
+
+def test_mission_tables():
+    # Every table shipped in tables/ loads, with numeric columns where they should be
+    terminal=load_table("terminal_7a",cache_dir=None)
+    assert np.array_equal(terminal.TAB,np.arange(1,len(terminal)+1))
+    assert terminal.pt1_srange.dtype==np.float64
+    reticle=load_table("camera_7a_reticle",cache_dir=None)
+    assert reticle.pt.dtype==np.int64
+    for name in ("geocentric_7","selenocentric_7"):
+        table=load_table(name,cache_dir=None)
+        assert table.Time_GMT.dtype.kind=="U"
+        assert table.vz.dtype==np.float64
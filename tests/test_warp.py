@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from scipy.interpolate import RegularGridInterpolator
+
+from warp import affine_warp, remap
+
+
+def reference_warp(img,M_to_from,output_shape):
+    """
+    The way transform_image() used to do it, with full-size coordinate arrays
+    """
+    rgi=RegularGridInterpolator((np.arange(img.shape[0]),np.arange(img.shape[1])),img,
+                                bounds_error=False,fill_value=0)
+    outy,outx=np.mgrid[0:output_shape[0],0:output_shape[1]]
+    M_from_to=np.linalg.inv(M_to_from)
+    outxfrom=M_from_to[0,0]*outx+M_from_to[0,1]*outy+M_from_to[0,2]
+    outyfrom=M_from_to[1,0]*outx+M_from_to[1,1]*outy+M_from_to[1,2]
+    return rgi((outyfrom,outxfrom))
+
+
+@pytest.mark.parametrize("output_shape,block_rows",[((90,110),None),((90,110),7),((40,35),1)])
+def test_affine_warp(output_shape,block_rows):
+    rng=np.random.default_rng(3217)
+    img=rng.integers(0,256,size=(80,100)).astype(np.uint8)
+    M_to_from=np.array([[ 0.91,0.05,  4.3],
+                        [-0.04,1.07, -2.1],
+                        [ 0   ,0   ,  1  ]])
+    ref=reference_warp(img,M_to_from,output_shape)
+    test=affine_warp(img,M_to_from,output_shape=output_shape,block_rows=block_rows)
+    assert test.dtype==np.float32
+    assert np.allclose(test,ref,atol=1e-3)
+    test8=affine_warp(img,M_to_from,output_shape=output_shape,dtype=np.uint8,block_rows=block_rows)
+    assert test8.dtype==np.uint8
+    assert np.all(np.abs(test8.astype(np.float64)-ref)<=0.5+1e-3)
+
+
+def test_affine_warp_identity():
+    img=np.arange(12*13,dtype=np.float32).reshape(12,13)
+    assert np.array_equal(affine_warp(img,np.eye(3)),img)
+
+
+def test_remap():
+    # A map which is really affine should give the same answer as affine_warp()
+    rng=np.random.default_rng(3217)
+    img=rng.integers(0,256,size=(80,100)).astype(np.uint8)
+    M_to_from=np.array([[ 0.91,0.05,  4.3],
+                        [-0.04,1.07, -2.1],
+                        [ 0   ,0   ,  1  ]])
+    outy,outx=np.mgrid[0:90,0:110]
+    M_from_to=np.linalg.inv(M_to_from)
+    map_xy=np.stack((M_from_to[0,0]*outx+M_from_to[0,1]*outy+M_from_to[0,2],
+                     M_from_to[1,0]*outx+M_from_to[1,1]*outy+M_from_to[1,2])).astype(np.float32)
+    ref=affine_warp(img,M_to_from,output_shape=(90,110))
+    assert np.allclose(remap(img,map_xy,block_rows=7),ref,atol=1e-3)
+    # The same map on an image twice the size, through a matrix to its coordinates
+    big=np.kron(img,np.ones((2,2),dtype=np.uint8))
+    M_big_img=np.array([[2,0,0.5],[0,2,0.5],[0,0,1]])
+    test=remap(big,map_xy,M_src_map=M_big_img)
+    assert np.allclose(test,affine_warp(big,M_to_from@np.linalg.inv(M_big_img),output_shape=(90,110)),atol=1e-2)